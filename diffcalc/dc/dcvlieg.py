@@ -49,14 +49,15 @@ def hkl_to_angles(h, k, l, energy=None):
     return angle_tuple, params
 
 
-def angles_to_hkl(angleTuple, energy=None):
+def angles_to_hkl(angleTuple, energy=None, virtual_angle_names=None):
     """Converts a set of diffractometer angles to an hkl position
     ((h, k, l), paramDict)=angles_to_hkl(self, (a1, a2,aN), energy=None)"""
     if energy is None:
         energy = settings.hardware.get_energy()  # @UndefinedVariable
 
     i_pos = settings.geometry.physical_angles_to_internal_position(angleTuple)  # @UndefinedVariable
-    return hklcalc.anglesToHkl(i_pos, energy_to_wavelength(energy))
+    return hklcalc.anglesToHkl(i_pos, energy_to_wavelength(energy),
+                               virtual_angle_names)
 
 
 settings.ubcalc_strategy = diffcalc.hkl.vlieg.calc.VliegUbCalcStrategy()
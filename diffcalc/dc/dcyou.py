@@ -3,6 +3,7 @@ from diffcalc.dc.common import energy_to_wavelength
 from diffcalc.dc.help import compile_extra_motion_commands_for_help
 
 import diffcalc.hkl.you.calc
+from diffcalc.hkl.you.geometry import YouPosition
 settings.ubcalc_strategy = diffcalc.hkl.you.calc.YouUbCalcStrategy()
 settings.angles_to_hkl_function = diffcalc.hkl.you.calc.youAnglesToHkl
 settings.include_reference = True
@@ -21,14 +22,20 @@ from diffcalc.hardware import *  # @UnusedWildImport
 from diffcalc.hkl.you.hkl import *  # @UnusedWildImport
 
 
-def hkl_to_angles(h, k, l, energy=None):
+def hkl_to_angles(h, k, l, energy=None, seed=None):
     """Convert a given hkl vector to a set of diffractometer angles
     
     return angle tuple and params dictionary
+
+    If given, the solution closest to the seed angle tuple (e.g. the current
+    diffractometer position) is chosen.
     
     """
     if energy is None:
         energy = settings.hardware.get_energy()  # @UndefinedVariable
+    if seed is not None:
+        hklcalc.set_reference_position(
+            settings.geometry.physical_angles_to_internal_position(seed))  # @UndefinedVariable
 
     (pos, params) = hklcalc.hklToAngles(h, k, l, energy_to_wavelength(energy))
     angle_tuple = settings.geometry.internal_position_to_physical_angles(pos)  # @UndefinedVariable
@@ -37,16 +44,67 @@ def hkl_to_angles(h, k, l, energy=None):
     return angle_tuple, params
 
 
-def angles_to_hkl(angleTuple, energy=None):
+def hkl_to_angles_vs_energy(hkl, energies):
+    """Convert a fixed hkl vector to sets of diffractometer angles at each of
+    a sequence of energies, e.g. to drive an energy scan at constant hkl
+
+    return a list with an angle tuple and params dictionary for each energy,
+    or None for energies at which hkl could not be reached. Requires numpy.
+
+    """
+    wavelengths = [energy_to_wavelength(energy) for energy in energies]
+    positions, virtual_angles, status = hklcalc.hkl_to_angles_vs_wavelength(
+        hkl, wavelengths)
+    names = diffcalc.hkl.you.calc.batch.VIRTUAL_ANGLE_NAMES
+    results = []
+    for pos, virtual, point_status in zip(positions, virtual_angles, status):
+        if point_status:
+            results.append(None)
+            continue
+        angle_tuple = settings.geometry.internal_position_to_physical_angles(  # @UndefinedVariable
+            YouPosition(*pos))
+        angle_tuple = settings.hardware.cut_angles(angle_tuple)  # @UndefinedVariable
+        results.append((angle_tuple, dict(zip(names, virtual))))
+    return results
+
+
+def hkl_list_to_angles(hkl_list, energy=None):
+    """Convert each of a list of hkl vectors to a set of diffractometer
+    angles, e.g. to check a whole scan can be reached before moving
+
+    return a list with an angle tuple and params dictionary for each hkl
+    vector, or None for those that could not be reached. Requires numpy.
+
+    """
+    if energy is None:
+        energy = settings.hardware.get_energy()  # @UndefinedVariable
+    positions, virtual_angles, status = hklcalc.hkl_to_angles_batch(
+        hkl_list, energy_to_wavelength(energy))
+    names = diffcalc.hkl.you.calc.batch.VIRTUAL_ANGLE_NAMES
+    results = []
+    for pos, virtual, point_status in zip(positions, virtual_angles, status):
+        if point_status:
+            results.append(None)
+            continue
+        angle_tuple = settings.geometry.internal_position_to_physical_angles(  # @UndefinedVariable
+            YouPosition(*pos))
+        angle_tuple = settings.hardware.cut_angles(angle_tuple)  # @UndefinedVariable
+        results.append((angle_tuple, dict(zip(names, virtual))))
+    return results
+
+
+def angles_to_hkl(angleTuple, energy=None, virtual_angle_names=None):
     """Converts a set of diffractometer angles to an hkl position
     
-    Return hkl tuple and params dictionary
+    Return hkl tuple and params dictionary, containing only the virtual
+    angles in virtual_angle_names if given.
     
     """
     if energy is None:
         energy = settings.hardware.get_energy()  # @UndefinedVariable
     i_pos = settings.geometry.physical_angles_to_internal_position(angleTuple)  # @UndefinedVariable
-    return hklcalc.anglesToHkl(i_pos, energy_to_wavelength(energy))
+    return hklcalc.anglesToHkl(i_pos, energy_to_wavelength(energy),
+                               virtual_angle_names)
 
 
 
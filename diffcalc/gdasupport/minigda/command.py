@@ -21,8 +21,12 @@
 #except ImportError:
 #    from diffcalc.gdasupport.minigda.scannable import Scannable
 from diffcalc.gdasupport.minigda.scannable import Scannable
-from diffcalc.util import getMessageFromException, allnum, bold
+from diffcalc.util import getMessageFromException, allnum, bold, \
+    DiffcalcException
 import math
+import sys
+import threading
+import Queue
 
 
 ROOT_NAMESPACE_DICT = {}
@@ -255,7 +259,8 @@ class Scan(object):
             first = unprocessedGroups[0]
             # If groups starts with a request to loop:
             if first.shouldTriggerLoop():
-                posList = self._frange(first.args[0], first.args[1], first.args[2])
+                posList = self._frangeGenerator(first.args[0], first.args[1],
+                                                first.args[2])
                 for pos in posList:
                     first.scannable.asynchronousMoveTo(pos)
                     # TODO: Should wait. minigda assumes all moves complete immediately
@@ -273,15 +278,21 @@ class Scan(object):
 
     def _moveNonLoopTriggeringGroups(self, groups):
         # TODO: Should wait. minigda assumes all moves complete immediately. groups could be zero lengthed.
+        for scannable, pos in self._nonLoopTriggeringMoves(groups):
+            scannable.asynchronousMoveTo(pos)
+
+    def _nonLoopTriggeringMoves(self, groups):
+        moves = []
         for grp in groups:
             if len(grp.args) == 0:
                 pass
             elif len(grp.args) == 1:
-                grp.scannable.asynchronousMoveTo(grp.args[0])
+                moves.append((grp.scannable, grp.args[0]))
             elif len(grp.args) == 2:
                 raise Exception("Scannables followed by two args not supported by minigda's scan command ")
             else:
                 raise Exception("Scannable: %s args%s" % (grp.scannable, str(grp.args)))
+        return moves
 
     def _samplePositionsOfAllScannables(self, groups):
         posDict = {}
@@ -292,6 +303,11 @@ class Scan(object):
     def _frange(self, limit1, limit2, increment):
         """Range function that accepts floats (and integers).
         """
+        return list(self._frangeGenerator(limit1, limit2, increment))
+
+    def _frangeGenerator(self, limit1, limit2, increment):
+        """Generates the values of _frange one at a time.
+        """
 #        limit1 = float(limit1)
 #        limit2 = float(limit2)
         try:
@@ -300,11 +316,433 @@ class Scan(object):
             raise TypeError(
                 "Only scaler values are supported, not GDA format vectors.")
         count = int(math.ceil(((limit2 - limit1) + increment / 100.) / increment))
+        for n in xrange(count):
+            yield limit1 + n * increment
+
+
+_END = object()  # marks the end of the items in a queue
+_NOT_PREPARED = object()
+BRANCH_FLIP_STEP = 90.  # a prepared axis moving further between points
+MAX_REPORTED_PROBLEMS = 10
+
+
+class _BackgroundIterator(object):
+    """Iterates over iterable on a daemon thread, at most maxsize items
+    ahead of the consumer. Exceptions raised by iterable are re-raised when
+    the consumer reaches them."""
+
+    def __init__(self, iterable, maxsize):
+        self._queue = Queue.Queue(maxsize)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,))
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self, iterable):
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except Exception:
+            self._put((_END, sys.exc_info()))
+            return
+        self._put((_END, None))
+
+    def _put(self, entry):
+        while not self._stopped.isSet():
+            try:
+                self._queue.put(entry, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            item, exc_info = self._queue.get()
+            if item is _END:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                return
+            yield item
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _DataHandlerThread(object):
+    """Passes scan points to the data handlers on a daemon thread through
+    a queue holding at most maxsize points. An exception raised by a data
+    handler is re-raised by the next call to put or finish."""
+
+    def __init__(self, dataHandlers, maxsize):
+        self.dataHandlers = dataHandlers
+        self._queue = Queue.Queue(maxsize)
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            posDict = self._queue.get()
+            if posDict is _END:
+                return
+            if self._exc_info is not None:
+                continue  # discard the remaining points
+            try:
+                for handler in self.dataHandlers:
+                    handler.callWithScanPoint(posDict)
+            except Exception:
+                self._exc_info = sys.exc_info()
+
+    def _raiseHandlerException(self):
+        if self._exc_info is not None:
+            exc_info, self._exc_info = self._exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def put(self, posDict):
+        self._raiseHandlerException()
+        self._queue.put(posDict)
+
+    def finish(self, reraise=True):
+        self._queue.put(_END)
+        self._thread.join()
+        if reraise:
+            self._raiseHandlerException()
+
+
+class PipelinedScan(Scan):
+    """A Scan that prepares each point while the previous one moves.
+
+    Points are generated lazily and their moves prepared on a worker thread,
+    at most lookahead points ahead of the point being moved to and sampled.
+    Sampled points are handed to the data handlers on another thread
+    through a queue holding at most queueSize points.
+
+    A scannable may provide prepareMoveTo(target, previous, **parameters),
+    returning a prepared move for target given that prepared for it at the
+    previous point (or None), and asynchronousMoveToPrepared(prepared) to
+    perform it; e.g. Hkl solves hkl to angles in prepareMoveTo. Moves of the
+    fields of such a scannable are merged into one move, with the fields not
+    moved at a point kept at their previous target. Other scannables are
+    moved with asynchronousMoveTo as in Scan. A point that fails to prepare
+    raises its exception once the points before it have been recorded.
+
+    A preparation can only be made ahead if nothing else moved by the scan
+    changes it. Other scannables at a higher level (moved after it, e.g.
+    counters) are assumed not to. Moves of the others must be accounted for
+    by the preparing scannable's preparationParameters(scannable, target),
+    returning the parameters to pass to prepareMoveTo (e.g. Hkl gives the
+    energy for moves of the energy or wavelength scannables). If any cannot
+    be, the scan makes its moves in order on the calling thread, as Scan
+    does.
+    """
+
+    def __init__(self, scanDataHandlers, lookahead=1, queueSize=16):
+        Scan.__init__(self, scanDataHandlers)
+        self.lookahead = lookahead
+        self.queueSize = queueSize
+
+    def __call__(self, *scanargs):
+        groups = self._parseScanArgsIntoScannableArgGroups(scanargs)
+        groups = self._reorderInnerGroupsAccordingToLevel(groups)
+        points = self._generateScanPoints(groups)
+        preparing = self._findPreparingScannables(groups)
+        if preparing is None:
+            self._performPreparedScan(groups, self._unpreparedPoints(points))
+            return
+        preparer = _BackgroundIterator(
+            self._preparePoints(points, preparing), self.lookahead)
+        try:
+            self._performPreparedScan(groups, preparer)
+        finally:
+            preparer.stop()
+
+    def _findPreparingScannables(self, groups):
+        """Return the scannables moved by the scan that prepare their moves,
+        or None if another moved scannable could change their preparations
+        in a way they cannot account for"""
+        preparing = []
+        others = []
+        for grp in groups:
+            if not grp.args:
+                continue
+            scannable = grp.scannable
+            parent = getattr(scannable, 'parentScannable', None)
+            if parent is not None and hasattr(parent, 'prepareMoveTo'):
+                scannable = parent
+            if hasattr(scannable, 'prepareMoveTo'):
+                if scannable not in preparing:
+                    preparing.append(scannable)
+            else:
+                others.append((scannable, grp.args[0]))
+        for scannable in preparing:
+            for other, target in others:
+                if other.getLevel() > scannable.getLevel():
+                    continue
+                if (not hasattr(scannable, 'preparationParameters') or
+                    scannable.preparationParameters(other, target) is None):
+                    return None
+        return preparing
+
+    def _unpreparedPoints(self, points):
+        for moves in points:
+            yield [(scannable, target, _NOT_PREPARED)
+                   for scannable, target in moves]
+
+    def _updatePreparationParameters(self, parameters, scannable, target):
+        """Account for a move of scannable in the parameters of each
+        preparing scannable"""
+        for preparing in parameters:
+            if hasattr(preparing, 'preparationParameters'):
+                update = preparing.preparationParameters(scannable, target)
+                if update:
+                    parameters[preparing].update(update)
+
+    def _performPreparedScan(self, groups, preparedPoints):
+        # Configure data handlers for a new scan
+        for handler in self.dataHandlers: handler.callAtScanStart(
+            [grp.scannable for grp in groups])
+        # Perform the scan
+        recorder = _DataHandlerThread(self.dataHandlers, self.queueSize)
+        try:
+            for units in preparedPoints:
+                self._performPreparedMoves(units)
+                recorder.put(self._samplePositionsOfAllScannables(groups))
+        except:
+            recorder.finish(reraise=False)
+            raise
+        recorder.finish()
+        # Inform data handlers of scan completion
+        for handler in self.dataHandlers: handler.callAtScanEnd()
+
+    def _generateScanPoints(self, groups, currentRecursionLevel=0):
+        """Generates for each point the list of (scannable, target) moves
+        Scan._performScan would make before sampling it"""
+        unprocessedGroups = groups[currentRecursionLevel:]
+        if len(unprocessedGroups) > 0:
+            first = unprocessedGroups[0]
+            if first.shouldTriggerLoop():
+                for pos in self._frangeGenerator(first.args[0], first.args[1],
+                                                 first.args[2]):
+                    loopMove = [(first.scannable, pos)]
+                    for moves in self._generateScanPoints(
+                            groups, currentRecursionLevel + 1):
+                        yield loopMove + moves
+                        loopMove = []
+                return
+        yield self._nonLoopTriggeringMoves(unprocessedGroups)
+
+    def _preparePoints(self, points, preparing):
+        """Generates for each point a list of (scannable, target, prepared)
+        moves, prepared being _NOT_PREPARED for scannables moved with
+        asynchronousMoveTo"""
+        targets = {}
+        previous = {}
+        parameters = dict((scannable, {}) for scannable in preparing)
+        for moves in points:
+            units = []
+            for scannable, target in self._mergeFieldMoves(moves, targets):
+                if scannable in parameters:
+                    prepared = scannable.prepareMoveTo(
+                        target, previous.get(scannable),
+                        **parameters[scannable])
+                    previous[scannable] = prepared
+                else:
+                    self._updatePreparationParameters(parameters, scannable,
+                                                      target)
+                    prepared = _NOT_PREPARED
+                units.append((scannable, target, prepared))
+            yield units
+
+    def _mergeFieldMoves(self, moves, targets):
+        """Return moves with those of the fields of scannables providing
+        prepareMoveTo merged into one move of that scannable. targets holds
+        the last target of each such scannable, and is updated."""
         result = []
-        for n in range(count):
-            result.append(limit1 + n * increment)
+        merged = {}
+        for scannable, pos in moves:
+            parent = getattr(scannable, 'parentScannable', None)
+            if parent is None or not hasattr(parent, 'prepareMoveTo'):
+                result.append((scannable, pos))
+                continue
+            if parent not in merged:
+                target = targets.get(parent)
+                if target is None:
+                    target = [None] * len(parent.getInputNames())
+                merged[parent] = list(target)
+                result.append((parent, merged[parent]))
+            merged[parent][scannable.index] = pos
+        for parent, target in merged.items():
+            if None in target and hasattr(parent, 'completePosition'):
+                parent.completePosition(target)
+            targets[parent] = target
         return result
 
+    def _performPreparedMoves(self, units):
+        for scannable, target, prepared in units:
+            if prepared is _NOT_PREPARED:
+                scannable.asynchronousMoveTo(target)
+            else:
+                scannable.asynchronousMoveToPrepared(prepared)
+        for scannable, _, _ in units:
+            scannable.waitWhileBusy()
+
+
+class PrecomputedScan(PipelinedScan):
+    """A Scan that prepares every point before moving anything.
+
+    All the points are generated and their moves prepared as for
+    PipelinedScan. A scannable providing prepareMovesTo(targets, parameters),
+    returning a list with a prepared move or a DiffcalcException for each
+    target given a list of prepareMoveTo keyword arguments for each, has all
+    its targets prepared in one call (Hkl solves them together); otherwise
+    each target is prepared in turn with prepareMoveTo. If any
+    point cannot be prepared a DiffcalcException listing those points is
+    raised before any motion. A prepared axis moving by more than
+    BRANCH_FLIP_STEP degrees between consecutive points is reported as a
+    branch flip, and raises a DiffcalcException too if failOnBranchFlip is
+    set. The scan is then performed from the prepared table.
+
+    If other scannables moved by the scan could change the preparations (see
+    PipelinedScan), nothing is prepared ahead and the scan makes its moves
+    in order as Scan does.
+    """
+
+    def __init__(self, scanDataHandlers, failOnBranchFlip=False, queueSize=16):
+        PipelinedScan.__init__(self, scanDataHandlers, queueSize=queueSize)
+        self.failOnBranchFlip = failOnBranchFlip
+
+    def __call__(self, *scanargs):
+        groups = self._parseScanArgsIntoScannableArgGroups(scanargs)
+        groups = self._reorderInnerGroupsAccordingToLevel(groups)
+        preparing = self._findPreparingScannables(groups)
+        if preparing is None:
+            self._performPreparedScan(groups, self._unpreparedPoints(
+                self._generateScanPoints(groups)))
+            return
+        table, prepared = self._prepareScan(groups, preparing)
+
+        problems = self._findUnpreparedPoints(prepared)
+        if problems:
+            raise DiffcalcException(self._formatProblems(
+                'Scan not started: %i of %i points could not be reached' %
+                (len(problems), len(table)), problems))
+        flips = self._findBranchFlips(prepared)
+        if flips:
+            report = self._formatProblems(
+                '%i branch flips found in the scan' % len(flips), flips)
+            if self.failOnBranchFlip:
+                raise DiffcalcException('Scan not started: ' + report)
+            print 'WARNING: ' + report
+
+        self._performPreparedScan(groups, table)
+
+    def _prepareScan(self, groups, preparing):
+        """Return a list with the (scannable, target, prepared) moves of
+        each point, and for each scannable that prepares its moves a list of
+        (point index, target, prepared) tuples"""
+        table = []
+        lastTargets = {}
+        parameters = dict((scannable, {}) for scannable in preparing)
+        units = dict((scannable, []) for scannable in preparing)
+        for index, moves in enumerate(self._generateScanPoints(groups)):
+            point = []
+            for scannable, target in self._mergeFieldMoves(moves,
+                                                           lastTargets):
+                unit = [scannable, target, _NOT_PREPARED]
+                if scannable in parameters:
+                    units[scannable].append(
+                        (index, unit, dict(parameters[scannable])))
+                else:
+                    self._updatePreparationParameters(parameters, scannable,
+                                                      target)
+                point.append(unit)
+            table.append(point)
+
+        prepared = []
+        for scannable in preparing:
+            targets = [unit[1] for _, unit, _ in units[scannable]]
+            kwargs = [params for _, _, params in units[scannable]]
+            if hasattr(scannable, 'prepareMovesTo'):
+                results = scannable.prepareMovesTo(targets, kwargs)
+            else:
+                results = self._prepareEachMove(scannable, targets, kwargs)
+            for (_, unit, _), result in zip(units[scannable], results):
+                unit[2] = result
+            prepared.append((scannable, [(index, unit[1], unit[2]) for
+                                         index, unit, _ in units[scannable]]))
+        table = [[tuple(unit) for unit in point] for point in table]
+        return table, prepared
+
+    def _prepareEachMove(self, scannable, targets, parameters):
+        results = []
+        previous = None
+        for target, kwargs in zip(targets, parameters):
+            try:
+                previous = scannable.prepareMoveTo(target, previous, **kwargs)
+                results.append(previous)
+            except DiffcalcException, e:
+                results.append(e)
+        return results
+
+    def _findUnpreparedPoints(self, prepared):
+        problems = []
+        for scannable, points in prepared:
+            for index, target, result in points:
+                if isinstance(result, Exception):
+                    problems.append((index, '%s %s: %s' % (
+                        scannable.getName(), _formatTarget(target),
+                        getMessageFromException(result))))
+        problems.sort()
+        return [problem for _, problem in problems]
+
+    def _findBranchFlips(self, prepared):
+        flips = []
+        for scannable, points in prepared:
+            try:
+                names = scannable.getPreparedNames()
+            except AttributeError:
+                names = None
+            for (i, target_i, result_i), (j, target_j, result_j) in zip(
+                    points[:-1], points[1:]):
+                if not (_isNumberSequence(result_i) and
+                        _isNumberSequence(result_j)):
+                    continue
+                for axis, (a, b) in enumerate(zip(result_i, result_j)):
+                    # the shortest way round, so crossing a cut is no flip
+                    step = (b - a + 180.) % 360. - 180.
+                    if abs(step) > BRANCH_FLIP_STEP:
+                        name = names[axis] if names else 'axis %i' % axis
+                        flips.append((i, '%s %s to %s: %s moves %.4f' % (
+                            scannable.getName(), _formatTarget(target_i),
+                            _formatTarget(target_j), name, step)))
+        flips.sort()
+        return [flip for _, flip in flips]
+
+    def _formatProblems(self, title, problems):
+        lines = [title + ':']
+        for problem in problems[:MAX_REPORTED_PROBLEMS]:
+            lines.append('  ' + problem)
+        if len(problems) > MAX_REPORTED_PROBLEMS:
+            lines.append('  ... and %i more' %
+                         (len(problems) - MAX_REPORTED_PROBLEMS))
+        return '\n'.join(lines)
+
+
+def _isNumberSequence(value):
+    return isinstance(value, (list, tuple)) and allnum(value)
+
+
+def _formatTarget(target):
+    if isinstance(target, (list, tuple)):
+        return '(%s)' % ' '.join(_formatTarget(v) for v in target)
+    try:
+        return '%g' % target
+    except TypeError:
+        return str(target)
+
 
 def sim(scn, hkl):
     """sim hkl scn -- simulates moving scannable (not all)
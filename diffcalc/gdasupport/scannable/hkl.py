@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
+import inspect
 import platform
 
 DEBUG = False
@@ -26,9 +27,21 @@ except ImportError:
     from diffcalc.gdasupport.minigda.scannable import \
         ScannableMotionWithScannableFieldsBase
 
+from diffcalc.gdasupport.scannable.trajectory import MAX_STEP, \
+    profile_trajectory
 from diffcalc.util import getMessageFromException, DiffcalcException
 
 
+def _accepts_seed(function):
+    """Return False if function has no seed argument. Functions that cannot
+    be inspected (e.g. mocks or Java methods) are assumed to accept one."""
+    try:
+        args, _, keywords, _ = inspect.getargspec(function)
+    except TypeError:
+        return True
+    return 'seed' in args or keywords is not None
+
+
 class _DynamicDocstringMetaclass(type):
 
     def _get_doc(self):
@@ -50,9 +63,16 @@ class Hkl(ScannableMotionWithScannableFieldsBase):
     __doc__ = property(_get_doc)  # @ReservedAssignment
 
     def __init__(self, name, diffractometerObject, diffcalcObject,
-                 virtualAnglesToReport=None):
+                 virtualAnglesToReport=None, energyScannable=None,
+                 energyScannableMultiplierToGetKeV=1):
         self.diffhw = diffractometerObject
         self._diffcalc = diffcalcObject
+        # Scans moving energyScannable, or a wavelength scannable driving it,
+        # can solve their hkl points ahead (see preparationParameters)
+        self.energyScannable = energyScannable
+        self.energyScannableMultiplierToGetKeV = \
+            energyScannableMultiplierToGetKeV
+        self.tracking = False
         if type(virtualAnglesToReport) is str:
             virtualAnglesToReport = (virtualAnglesToReport,)
         self.vAngleNames = virtualAnglesToReport
@@ -68,20 +88,164 @@ class Hkl(ScannableMotionWithScannableFieldsBase):
         self.setAutoCompletePartialMoveToTargets(True)
         self.dynamic_class_doc = 'Hkl Scannable xyz'
 
+    def _get_tracking(self):
+        return self._tracking
+
+    def _set_tracking(self, tracking):
+        if tracking and not _accepts_seed(self._diffcalc.hkl_to_angles):
+            raise DiffcalcException(
+                'Tracking requires a diffcalc engine that accepts a seed '
+                'position (e.g. you)')
+        self._tracking = tracking
+
+    # When tracking, moves are solved close to the current diffractometer
+    # position (requires a diffcalc object accepting a seed, e.g. dcyou)
+    tracking = property(_get_tracking, _set_tracking)
+
     def rawAsynchronousMoveTo(self, hkl):
+        self.diffhw.asynchronousMoveTo(self.prepareMoveTo(hkl))
+
+    def prepareMoveTo(self, hkl, previous=None, energy=None):
+        """Return the diffractometer position a move to hkl would move to.
+
+        When tracking, the solution closest to previous, the position
+        prepared for the previous point of a scan, or else to the current
+        diffractometer position, is chosen. energy (keV) defaults to the
+        current energy. Used by minigda's PipelinedScan to solve the next
+        point while the diffractometer moves.
+        """
         if len(hkl) != 3: raise ValueError('Hkl device expects three inputs')
+        kwargs = {}
+        if energy is not None:
+            kwargs['energy'] = energy
         try:
-            (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2])
+            if self.tracking:
+                if previous is None:
+                    previous = self.diffhw.getPosition()
+                (pos, _) = self._diffcalc.hkl_to_angles(
+                    hkl[0], hkl[1], hkl[2], seed=previous, **kwargs)
+            else:
+                (pos, _) = self._diffcalc.hkl_to_angles(hkl[0], hkl[1], hkl[2],
+                                                        **kwargs)
         except DiffcalcException, e:
             if DEBUG:
                 raise
             else:
                 raise DiffcalcException(e.message)
+        return pos
+
+    def prepareMovesTo(self, hkls, parameters=None):
+        """Return a list with the prepareMoveTo result for each of a list of
+        hkl targets, or a DiffcalcException for those that cannot be reached.
+        parameters is a list of prepareMoveTo keyword arguments (e.g. the
+        energy) for each target.
+
+        Unless tracking, targets at a single energy are solved together using
+        the diffcalc object's hkl_list_to_angles, and a single hkl at a series
+        of energies (an energy scan) using its hkl_to_angles_vs_energy, where
+        it has them (e.g. dcyou with numpy). Targets that fail are solved
+        again one at a time for the reason.
+        """
+        hkls = [list(hkl) for hkl in hkls]
+        if parameters is None:
+            parameters = [{}] * len(hkls)
+        solutions = None
+        energies = [kwargs.get('energy') for kwargs in parameters]
+        if (not self.tracking and len(set(energies)) > 1 and
+            None not in energies and
+            len(set(tuple(hkl) for hkl in hkls)) == 1 and
+            hasattr(self._diffcalc, 'hkl_to_angles_vs_energy')):
+            try:
+                solutions = self._diffcalc.hkl_to_angles_vs_energy(hkls[0],
+                                                                   energies)
+            except DiffcalcException:
+                pass  # e.g. without numpy
+        elif (not self.tracking and len(set(energies)) <= 1 and
+            hasattr(self._diffcalc, 'hkl_list_to_angles')):
+            kwargs = {}
+            if energies and energies[0] is not None:
+                kwargs['energy'] = energies[0]
+            try:
+                solutions = self._diffcalc.hkl_list_to_angles(hkls, **kwargs)
+            except DiffcalcException:
+                pass  # e.g. without numpy
+        if solutions is not None:
+            results = []
+            for hkl, kwargs, solution in zip(hkls, parameters, solutions):
+                if solution is not None:
+                    results.append(solution[0])
+                    continue
+                try:
+                    results.append(self.prepareMoveTo(hkl, None, **kwargs))
+                except DiffcalcException, e:
+                    results.append(e)
+            return results
+        results = []
+        previous = None
+        for hkl, kwargs in zip(hkls, parameters):
+            try:
+                previous = self.prepareMoveTo(hkl, previous, **kwargs)
+                results.append(previous)
+            except DiffcalcException, e:
+                results.append(e)
+        return results
+
+    def getPreparedNames(self):
+        """Return the names of the axes in a prepared move"""
+        return list(self.diffhw.getInputNames())
+
+    def preparationParameters(self, scannable, target):
+        """Return the prepareMoveTo keyword arguments accounting for a move
+        of scannable to target made before a move of this scannable, or None
+        if the move may change the solution in a way they cannot describe.
+
+        Moves of the energy scannable, and of a wavelength scannable driving
+        it, give the energy in keV.
+        """
+        if self.energyScannable is None:
+            return None
+        if scannable is self.energyScannable:
+            return {'energy': target * self.energyScannableMultiplierToGetKeV}
+        if getattr(scannable, 'energyScannable', None) is self.energyScannable:
+            return {'energy': 12.39842 / target}  # from a wavelength
+        return None
+
+    def asynchronousMoveToPrepared(self, pos):
+        """Move the diffractometer to a position from prepareMoveTo"""
         self.diffhw.asynchronousMoveTo(pos)
 
+    def trajectory(self, path, velocity, acceleration=None,
+                   max_step=MAX_STEP):
+        """Return a Trajectory through path, a list of (h, k, l) points (see
+        trajectory.line and trajectory.curve), for a continuous scan.
+
+        velocity, acceleration and max_step apply to every axis or are
+        dictionaries keyed by axis name (see
+        trajectory.profile_trajectory). When tracking, each point is solved
+        close to the previous one, starting from the current diffractometer
+        position. Nothing is moved.
+        """
+        path = list(path)
+        positions = []
+        pos = None
+        for i, hkl in enumerate(path):
+            try:
+                pos = self.prepareMoveTo(hkl, pos)
+            except DiffcalcException, e:
+                if DEBUG:
+                    raise
+                raise DiffcalcException(
+                    'Point %i of the trajectory, (%g %g %g), could not be '
+                    'reached:\n%s' % ((i,) + tuple(hkl) + (e.message,)))
+            positions.append(pos)
+        return profile_trajectory(self.diffhw.getInputNames(), path,
+                                  positions, velocity, acceleration, max_step)
+
     def rawGetPosition(self):
         pos = self.diffhw.getPosition()  # a tuple
-        (hkl , params) = self._diffcalc.angles_to_hkl(pos)
+        # only calculate the virtual angles reported
+        (hkl , params) = self._diffcalc.angles_to_hkl(
+            pos, virtual_angle_names=self.vAngleNames or ())
         result = list(hkl)
         if self.vAngleNames:
             for vAngleName in self.vAngleNames:
@@ -0,0 +1,254 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Motor trajectories for continuous (fly) scans through hkl.
+
+A path is a list of (h, k, l) points, e.g. from line() or curve(). Once each
+point has been solved (see Hkl.trajectory), profile_trajectory unwraps each
+axis to within 180 degrees of its previous position, checks that no axis
+jumps by more than a maximum step between consecutive points and
+times the trajectory with a per-axis velocity and acceleration model: each
+segment takes as long as its slowest axis needs at that axis's maximum
+velocity, and segments are stretched until no axis exceeds its maximum
+acceleration between them. As with LinearProfile in vrmlanimator, all axes
+accelerate from rest over a common ramp time before the first point and
+decelerate over one after the last.
+"""
+
+from math import sqrt
+
+from diffcalc.util import DiffcalcException
+
+MAX_STEP = 5.  # degrees between consecutive points
+LOCAL_PASSES = 10  # segment stretching passes before stretching them all
+SMALL = 1e-9
+
+
+def line(start, end, n):
+    """Return n (h, k, l) points evenly spaced from start to end inclusive"""
+    if n < 2:
+        raise ValueError('A line needs at least two points')
+    return [tuple(s + (e - s) * i / float(n - 1) for s, e in zip(start, end))
+            for i in range(n)]
+
+
+def curve(function, n, start=0., end=1.):
+    """Return n (h, k, l) points given by function(t) for t evenly spaced
+    from start to end inclusive"""
+    if n < 2:
+        raise ValueError('A curve needs at least two points')
+    return [tuple(function(start + (end - start) * i / float(n - 1)))
+            for i in range(n)]
+
+
+def _per_axis(value, names, what):
+    """Return a list with a value for each axis given either a single value
+    or a dictionary keyed by axis name"""
+    if isinstance(value, dict):
+        missing = [name for name in names if name not in value]
+        if missing:
+            raise ValueError('No %s given for %s' % (what, ', '.join(missing)))
+        return [value[name] for name in names]
+    return [value] * len(names)
+
+
+class Trajectory(object):
+    """A timed motor trajectory.
+
+    times holds the time in seconds at which each point is passed, and
+    positions and velocities map each axis name to a list of its positions
+    in degrees and velocities in degrees/s at those times. ramp_time is the
+    time taken to accelerate from rest at run_up (a dictionary of start
+    positions by axis name) to the first point, and to decelerate from the
+    last point to rest at run_down.
+    """
+
+    def __init__(self, names, hkl, times, positions, velocities, ramp_time,
+                 run_up, run_down):
+        self.names = list(names)
+        self.hkl = hkl
+        self.times = times
+        self.positions = positions
+        self.velocities = velocities
+        self.ramp_time = ramp_time
+        self.run_up = run_up
+        self.run_down = run_down
+
+    @property
+    def duration(self):
+        """Return the time from run_up to run_down in seconds"""
+        return self.times[-1] + 2 * self.ramp_time
+
+    def __len__(self):
+        return len(self.times)
+
+    def __str__(self):
+        width = max([9] + [len(name) for name in self.names])
+        header = ('%9s %9s %9s %9s' % ('time', 'h', 'k', 'l') +
+                  ''.join(' %*s' % (width, name) for name in self.names))
+        lines = [header]
+        for i, t in enumerate(self.times):
+            line = '%9.4f %9.5f %9.5f %9.5f' % ((t,) + tuple(self.hkl[i]))
+            line += ''.join(' %*.4f' % (width, self.positions[name][i])
+                            for name in self.names)
+            lines.append(line)
+        lines.append('')
+        lines.append('%i points in %.4fs, plus %.4fs ramps at each end' %
+                     (len(self.times), self.times[-1], self.ramp_time))
+        lines.append('run up from: ' + ', '.join(
+            '%s=%.4f' % (name, self.run_up[name]) for name in self.names))
+        return '\n'.join(lines)
+
+
+def _unwrap(positions):
+    """Return positions with multiples of 360 degrees added to each angle
+    so that it is within 180 degrees of its value at the previous point"""
+    unwrapped = [list(positions[0])]
+    for pos in positions[1:]:
+        previous = unwrapped[-1]
+        unwrapped.append([v + 360. * round((p - v) / 360.)
+                          for v, p in zip(pos, previous)])
+    return unwrapped
+
+
+def _check_continuity(names, hkl, positions, max_steps):
+    for i in range(1, len(positions)):
+        for j, name in enumerate(names):
+            step = positions[i][j] - positions[i - 1][j]
+            if abs(step) > max_steps[j]:
+                raise DiffcalcException(
+                    'The trajectory is discontinuous between points %i %s '
+                    'and %i %s: %s moves %.4f degrees (more than %.4f).\nUse '
+                    'more points, or hkl tracking to keep to one branch of '
+                    'solutions.' % (i - 1, _hkl_str(hkl[i - 1]), i,
+                                    _hkl_str(hkl[i]), name, step,
+                                    max_steps[j]))
+
+
+def _hkl_str(hkl):
+    return '(%g %g %g)' % tuple(hkl)
+
+
+def _segment_velocities(steps, durations):
+    return [[step / dt if dt else 0. for step in segment]
+            for segment, dt in zip(steps, durations)]
+
+
+def _acceleration_ratios(steps, durations, accelerations):
+    """Return for each pair of consecutive segments the factor by which the
+    largest acceleration between them exceeds its axis's limit"""
+    velocities = _segment_velocities(steps, durations)
+    ratios = []
+    for k in range(len(durations) - 1):
+        dt = (durations[k] + durations[k + 1]) / 2.
+        ratio = 0.
+        if dt:
+            for j, a in enumerate(accelerations):
+                if a is not None:
+                    change = abs(velocities[k + 1][j] - velocities[k][j])
+                    ratio = max(ratio, change / dt / a)
+        ratios.append(ratio)
+    return ratios
+
+
+def _stretch_for_acceleration(steps, durations, accelerations):
+    """Lengthen segment durations until no axis accelerates faster than its
+    limit between segments. Slowing a pair of segments by sqrt(ratio) brings
+    the acceleration between them within limits, but may push that between
+    a neighbouring pair out, so after a few local passes any remaining excess
+    is removed by slowing every segment."""
+    durations = list(durations)
+    for _ in range(LOCAL_PASSES):
+        ratios = _acceleration_ratios(steps, durations, accelerations)
+        if max(ratios or [0.]) <= 1 + SMALL:
+            return durations
+        for k, ratio in enumerate(ratios):
+            if ratio > 1 + SMALL:
+                factor = sqrt(ratio)
+                durations[k] *= factor
+                durations[k + 1] *= factor
+    ratios = _acceleration_ratios(steps, durations, accelerations)
+    worst = max(ratios or [0.])
+    if worst > 1:
+        factor = sqrt(worst)
+        durations = [dt * factor for dt in durations]
+    return durations
+
+
+def profile_trajectory(names, hkl, positions, velocity, acceleration=None,
+                       max_step=MAX_STEP):
+    """Return a Trajectory through positions, a list with a tuple of axis
+    positions in degrees for each (h, k, l) point in hkl.
+
+    velocity (degrees/s), acceleration (degrees/s^2, or None for unlimited)
+    and max_step (degrees between consecutive points) are either single
+    values for all axes or dictionaries keyed by axis name. Positions are
+    unwrapped, so an angle crossing its cut continues beyond it rather than
+    jumping by 360 degrees. Raises DiffcalcException if an axis moves by
+    more than max_step between consecutive points.
+    """
+    names = list(names)
+    if len(positions) < 2:
+        raise ValueError('A trajectory needs at least two points')
+    velocities = [float(v) for v in _per_axis(velocity, names, 'velocity')]
+    if [v for v in velocities if v <= 0]:
+        raise ValueError('Axis velocities must be positive')
+    accelerations = _per_axis(acceleration, names, 'acceleration')
+    if [a for a in accelerations if a is not None and a <= 0]:
+        raise ValueError('Axis accelerations must be positive')
+    max_steps = _per_axis(max_step, names, 'max_step')
+
+    positions = _unwrap([[float(v) for v in pos] for pos in positions])
+    _check_continuity(names, hkl, positions, max_steps)
+
+    steps = [[b - a for a, b in zip(previous, pos)]
+             for previous, pos in zip(positions[:-1], positions[1:])]
+    durations = [max(abs(step) / v for step, v in zip(segment, velocities))
+                 for segment in steps]
+    durations = _stretch_for_acceleration(steps, durations, accelerations)
+    segment_velocities = _segment_velocities(steps, durations)
+
+    times = [0.]
+    for dt in durations:
+        times.append(times[-1] + dt)
+    # constant velocity through the end points, the average between segments
+    point_velocities = [segment_velocities[0]]
+    for previous, following in zip(segment_velocities[:-1],
+                                   segment_velocities[1:]):
+        point_velocities.append([(a + b) / 2.
+                                 for a, b in zip(previous, following)])
+    point_velocities.append(segment_velocities[-1])
+
+    first, last = point_velocities[0], point_velocities[-1]
+    ramp_time = 0.
+    for j, a in enumerate(accelerations):
+        if a is not None:
+            ramp_time = max(ramp_time, abs(first[j]) / a, abs(last[j]) / a)
+    # each axis accelerates uniformly over the common ramp time
+    run_up = dict((name, positions[0][j] - first[j] * ramp_time / 2.)
+                  for j, name in enumerate(names))
+    run_down = dict((name, positions[-1][j] + last[j] * ramp_time / 2.)
+                    for j, name in enumerate(names))
+
+    return Trajectory(
+        names, [tuple(point) for point in hkl], times,
+        dict((name, [pos[j] for pos in positions])
+             for j, name in enumerate(names)),
+        dict((name, [v[j] for v in point_velocities])
+             for j, name in enumerate(names)),
+        ramp_time, run_up, run_down)
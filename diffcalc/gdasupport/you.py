@@ -20,7 +20,7 @@ except:
 if not GDA:
     from diffcalc.gdasupport.minigda import command
     _pos = command.Pos()
-    _scan = command.Scan(command.ScanDataPrinter())
+    _scan = command.PrecomputedScan(command.ScanDataPrinter())
 
     def pos(*args):
         """
@@ -49,7 +49,9 @@ _diff_scn = DiffractometerScannableGroup(_diff_scn_name, _dc, _scn_group)
 globals()[_diff_scn_name] = _diff_scn
 
 # Create hkl scannables
-hkl = Hkl('hkl', _scn_group, _dc)
+hkl = Hkl('hkl', _scn_group, _dc, energyScannable=_energy_scannable,
+          energyScannableMultiplierToGetKeV=
+          settings.energy_scannable_multiplier_to_get_KeV)
 h = hkl.h
 k = hkl.k
 l = hkl.l
@@ -58,7 +60,9 @@ Hkl.dynamic_docstring = format_command_help(hkl_commands_for_help)  # must be on
 ub.__doc__ = format_command_help(ub_commands_for_help)
 
 _virtual_angles = ('theta', 'qaz', 'alpha', 'naz', 'tau', 'psi', 'beta')
-hklverbose = Hkl('hklverbose', _scn_group, _dc, _virtual_angles)
+hklverbose = Hkl('hklverbose', _scn_group, _dc, _virtual_angles,
+                 _energy_scannable,
+                 settings.energy_scannable_multiplier_to_get_KeV)
 
 
 # Create wavelength scannable
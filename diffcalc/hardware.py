@@ -18,7 +18,7 @@
 
 from __future__ import absolute_import
 
-from diffcalc.util import DiffcalcException
+from diffcalc.util import DiffcalcException, timed
 from diffcalc import settings
 
 SMALL = 1e-8
@@ -99,6 +99,7 @@ class HardwareAdapter(object):
         self._upperLimitDict = {}
         self._lowerLimitDict = {}
         self._cut_angles = {}
+        self._limits_version = 0
         self._configure_cuts(defaultCuts)
         self.energyScannableMultiplierToGetKeV = \
             energyScannableMultiplierToGetKeV
@@ -144,6 +145,13 @@ class HardwareAdapter(object):
 
 ### Limits ###
 
+    @property
+    def limits_version(self):
+        '''counter incremented whenever a limit or cut is changed, so that
+        results depending on them can be invalidated
+        '''
+        return self._limits_version
+
     def get_lower_limit(self, name):
         '''returns lower limits by axis name. Limit may be None if not set
         '''
@@ -174,6 +182,7 @@ class HardwareAdapter(object):
                        "clear" % name)
         else:
             self._lowerLimitDict[name] = value
+        self._limits_version += 1
 
     def set_upper_limit(self, name, value):
         """value may be None to remove limit"""
@@ -189,6 +198,7 @@ class HardwareAdapter(object):
                        "clear" % name)
         else:
             self._upperLimitDict[name] = value
+        self._limits_version += 1
 
     def is_position_within_limits(self, positionArray):
         """
@@ -253,6 +263,7 @@ class HardwareAdapter(object):
     def set_cut(self, name, value):
         if name in self._cut_angles:
             self._cut_angles[name] = value
+            self._limits_version += 1
         else:
             raise KeyError("Diffractometer has no angle %s. Try: %s." %
                             (name, self._diffractometerAngleNames))
@@ -260,6 +271,7 @@ class HardwareAdapter(object):
     def get_cuts(self):
         return self._cut_angles
 
+    @timed('hardware.cut_angles')
     def cut_angles(self, positionArray):
         '''Assumes each angle in positionArray is between -360 and 360
         '''
@@ -18,11 +18,87 @@
 
 from math import pi
 
-from diffcalc.util import DiffcalcException, differ
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from diffcalc.rotations import rows_times, rows_transpose_times
+from diffcalc.util import DiffcalcException, differ, timed
 
 TORAD = pi / 180
 TODEG = 180 / pi
 
+# Policies for checking that calculated positions map back to the requested
+# hkl (and virtual angles):
+VERIFY_ALWAYS = 'always'  # full anglesToHkl round trip on every calculation
+VERIFY_SAMPLED = 'sampled'  # full round trip on every Nth calculation only
+VERIFY_CHEAP = 'cheap'  # hkl only, skipping virtual angle readback
+VERIFY_OFF = 'off'
+VERIFICATION_POLICIES = (VERIFY_ALWAYS, VERIFY_SAMPLED, VERIFY_CHEAP,
+                         VERIFY_OFF)
+
+
+def check_verification_policy(policy):
+    if policy not in VERIFICATION_POLICIES:
+        raise DiffcalcException(
+            "Unknown verification policy '%s'. Try one of: %s" %
+            (policy, ', '.join(VERIFICATION_POLICIES)))
+
+
+def q_tolerance(UBinv, hkl_tolerance):
+    """Return the distance within which a position's scattering vector must
+    lie of UB * hkl for each of its miller indices to be within
+    hkl_tolerance of hkl. The Frobenius norm of UBinv bounds its 2-norm, so
+    this is at most sqrt(3) tighter than necessary."""
+    norm_squared = sum(e ** 2 for row in UBinv.tolist() for e in row)
+    return hkl_tolerance / norm_squared ** .5
+
+
+def hkl_jacobian_rows(UBinv, sample_rows, q, derivatives, wavevector):
+    """Return the rows of d(h, k, l)/d(angles) for hkl = UBinv * R.I * q *
+    wavevector, where R has the given rows and q is the scattering vector in
+    units of the wavevector.
+
+    derivatives has an (dR, dq) pair for each angle: the rows of the
+    derivative of R and the derivative of q, either of which may be None if
+    the angle does not affect it. The elements may be numpy arrays.
+    """
+    UBinv_rows = UBinv.tolist()
+    columns = []
+    for d_rows, dq in derivatives:
+        if d_rows is None:
+            dq_phi = rows_transpose_times(sample_rows, dq)
+        elif dq is None:
+            dq_phi = rows_transpose_times(d_rows, q)
+        else:
+            dq_phi = [a + b for a, b in zip(rows_transpose_times(d_rows, q),
+                                            rows_transpose_times(sample_rows,
+                                                                 dq))]
+        columns.append([wavevector * v for v in rows_times(UBinv_rows,
+                                                           dq_phi)])
+    return tuple(zip(*columns))
+
+
+def scale_derivatives(derivatives, numerator, denominator):
+    """Return derivatives * numerator / denominator, or nans if the
+    denominator is zero"""
+    if denominator == 0:
+        return (float('nan'),) * len(derivatives)
+    factor = numerator / denominator
+    return tuple(factor * d for d in derivatives)
+
+
+def combine_derivatives(*terms):
+    """Return the sum of coefficient * derivatives for each (coefficient,
+    derivatives) pair in terms"""
+    return tuple(sum(c * d[i] for c, d in terms)
+                 for i in range(len(terms[0][1])))
+
 
 class HklCalculatorBase(object):
 
@@ -35,27 +111,132 @@ class HklCalculatorBase(object):
         self._hardware = hardware  # Used for tracking parameters only
         self.raiseExceptionsIfAnglesDoNotMapBackToHkl = \
             raiseExceptionsIfAnglesDoNotMapBackToHkl
+        self.verification = VERIFY_ALWAYS
+        self.verification_interval = 10  # for VERIFY_SAMPLED
+        self._verification_count = 0
+
+    def set_verification(self, policy, interval=None):
+        """Set the verification policy (one of VERIFICATION_POLICIES) and,
+        for 'sampled', the number of calculations per full verification.
+        """
+        check_verification_policy(policy)
+        if interval is not None:
+            if int(interval) < 1:
+                raise DiffcalcException(
+                    'The verification interval must be at least 1')
+            self.verification_interval = int(interval)
+        self.verification = policy
+        self._verification_count = 0
+
+    def repr_verification(self):
+        if self.verification == VERIFY_SAMPLED:
+            return 'verification: %s (every %i)' % (
+                self.verification, self.verification_interval)
+        return 'verification: ' + self.verification
+
+    def _verification_due(self):
+        """Return the check to perform on the next calculated position:
+        VERIFY_ALWAYS, VERIFY_CHEAP or VERIFY_OFF."""
+        if self.verification != VERIFY_SAMPLED:
+            return self.verification
+        due = self._verification_count % self.verification_interval == 0
+        self._verification_count += 1
+        return VERIFY_ALWAYS if due else VERIFY_OFF
 
-    def anglesToHkl(self, pos, wavelength):
+    def anglesToHkl(self, pos, wavelength, virtual_angle_names=None):
         """
         Return hkl tuple and dictionary of all virtual angles in degrees from
         Position in degrees and wavelength in Angstroms.
+
+        If virtual_angle_names is given only those virtual angles are
+        calculated and returned (none if it is empty).
         """
 
         h, k, l = self._anglesToHkl(pos.inRadians(), wavelength)
-        paramDict = self.anglesToVirtualAngles(pos, wavelength)
+        if virtual_angle_names is not None and not virtual_angle_names:
+            return ((h, k, l), {})
+        paramDict = self.anglesToVirtualAngles(pos, wavelength,
+                                               virtual_angle_names)
         return ((h, k, l), paramDict)
 
-    def anglesToVirtualAngles(self, pos, wavelength):
+    def anglesToVirtualAngles(self, pos, wavelength, names=None):
         """
         Return dictionary of all virtual angles in degrees from Position object
-        in degrees and wavelength in Angstroms.
+        in degrees and wavelength in Angstroms, or only those in names if
+        given.
         """
-        anglesDict = self._anglesToVirtualAngles(pos.inRadians(), wavelength)
+        anglesDict = self._anglesToVirtualAngles(pos.inRadians(), wavelength,
+                                                 names)
         for name in anglesDict:
             anglesDict[name] = anglesDict[name] * TODEG
         return anglesDict
 
+    def anglesToHklJacobian(self, pos, wavelength):
+        """
+        Return d(h, k, l)/d(angles) as a 3*N matrix, with hkl per degree and
+        a column for each angle of Position pos in degrees (ordered as
+        pos.totuple()), and wavelength in Angstroms.
+        """
+        rows = self._anglesToHklJacobian(pos.inRadians().totuple(),
+                                         wavelength)
+        return matrix(rows) * TORAD
+
+    def anglesToVirtualAnglesJacobian(self, pos, wavelength, names=None):
+        """
+        Return a dictionary of d(virtual angle)/d(angles) tuples in degrees
+        per degree, with an element for each angle of Position pos in degrees
+        (ordered as pos.totuple()), and wavelength in Angstroms. If names is
+        given only those virtual angles are included. An element is nan
+        where the derivative is undefined.
+        """
+        return self._anglesToVirtualAnglesJacobian(
+            pos.inRadians().totuple(), wavelength, names)
+
+    def angles_to_hkl_jacobian_batch(self, positions, wavelength):
+        """
+        Return an N*3*M array of d(h, k, l)/d(angles), with hkl per degree,
+        from an N*M array of positions in degrees and wavelength in
+        Angstroms.
+
+        The array version of anglesToHklJacobian. Requires numpy.
+        """
+        angles = self._batch_positions_in_radians(positions)
+        rows = self._anglesToHklJacobian(tuple(angles), wavelength,
+                                         numpy.sin, numpy.cos)
+        elements = numpy.broadcast_arrays(
+            *([angles[0]] + [e for row in rows for e in row]))[1:]
+        jacobians = numpy.array(elements).reshape(3, len(angles), -1)
+        return jacobians.transpose(2, 0, 1) * TORAD
+
+    def angles_to_virtual_angles_jacobian_batch(self, positions, wavelength,
+                                                names=None):
+        """
+        Return a dictionary of N*M arrays of d(virtual angle)/d(angles) from
+        an N*M array of positions in degrees and wavelength in Angstroms.
+
+        The array version of anglesToVirtualAnglesJacobian. Requires numpy.
+        """
+        angles = self._batch_positions_in_radians(positions)
+        jacobians = {}
+        for row in angles.T:
+            jacobian = self._anglesToVirtualAnglesJacobian(
+                tuple(row), wavelength, names)
+            for name, derivatives in jacobian.items():
+                jacobians.setdefault(name, []).append(derivatives)
+        return dict((name, numpy.array(rows, dtype=float))
+                    for name, rows in jacobians.items())
+
+    def _batch_positions_in_radians(self, positions):
+        """Return the columns of an N*M array of positions in degrees, in
+        radians"""
+        if numpy is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        positions = numpy.array(positions, dtype=float)
+        if positions.ndim != 2:
+            raise ValueError('positions must be an N*M array')
+        return positions.T * TORAD
+
     def hklToAngles(self, h, k, l, wavelength):
         """
         Return verified Position and all virtual angles in degrees from
@@ -88,14 +269,20 @@ class HklCalculatorBase(object):
             if val is not None:
                 virtualAngles[key] = val * TODEG
 
-        self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
+        verification = self._verification_due()
+        self._verify_pos_map_to_hkl(h, k, l, wavelength, pos, verification)
 
-        virtualAnglesReadback = self._verify_virtual_angles(h, k, l, wavelength, pos, virtualAngles)
+        virtualAnglesReadback = self._verify_virtual_angles(
+            h, k, l, wavelength, pos, virtualAngles, verification)
 
         return pos, virtualAnglesReadback
 
-    def _verify_pos_map_to_hkl(self, h, k, l, wavelength, pos):
-        hkl, _ = self.anglesToHkl(pos, wavelength)
+    @timed('verify.hkl')
+    def _verify_pos_map_to_hkl(self, h, k, l, wavelength, pos,
+                               verification=VERIFY_ALWAYS):
+        if verification == VERIFY_OFF:
+            return
+        hkl, _ = self.anglesToHkl(pos, wavelength, ())
         e = 0.001
         if ((abs(hkl[0] - h) > e) or (abs(hkl[1] - k) > e) or 
             (abs(hkl[2] - l) > e)):
@@ -107,10 +294,14 @@ class HklCalculatorBase(object):
             else:
                 print s
 
-    def _verify_virtual_angles(self, h, k, l, wavelength, pos, virtualAngles):
+    @timed('verify.virtual_angles')
+    def _verify_virtual_angles(self, h, k, l, wavelength, pos, virtualAngles,
+                               verification=VERIFY_ALWAYS):
         # Check that the virtual angles calculated/fixed during the hklToAngles
     # those read back from pos using anglesToVirtualAngles
         virtualAnglesReadback = self.anglesToVirtualAngles(pos, wavelength)
+        if verification in (VERIFY_OFF, VERIFY_CHEAP):
+            return virtualAnglesReadback
         for key, val in virtualAngles.items():
             if val != None: # Some values calculated in some mode_selector
                 r = virtualAnglesReadback[key]
@@ -136,6 +327,9 @@ class HklCalculatorBase(object):
     def _getUBMatrix(self):
         return self._ubcalc.UB
 
+    def _getUBMatrixInverse(self):
+        return self._ubcalc.UB_inv
+
     def _getMode(self):
         return self.mode_selector.getMode()
 
@@ -25,13 +25,17 @@ except ImportError:
     from numjy import matrix
     from numjy.linalg import norm
 
-from diffcalc.hkl.calcbase import HklCalculatorBase
+from diffcalc.hkl.calcbase import HklCalculatorBase, hkl_jacobian_rows, \
+    scale_derivatives, combine_derivatives
 from diffcalc.hkl.vlieg.transform import TransformCInRadians
 from diffcalc.util import dot3, cross3, bound, differ
 from diffcalc.hkl.vlieg.geometry import createVliegMatrices, \
     createVliegsPsiTransformationMatrix, \
     createVliegsSurfaceTransformationMatrices, calcPHI
 from diffcalc.hkl.vlieg.geometry import VliegPosition
+from diffcalc.rotations import vlieg_sample_rotation, \
+    vlieg_sample_rotation_inverse, vlieg_q_alpha, column, vlieg_sample_rows, \
+    vlieg_sample_rows_derivatives, vlieg_q_alpha_derivatives, rows_times
 from diffcalc.hkl.vlieg.constraints import VliegParameterManager
 from diffcalc.hkl.vlieg.constraints import ModeSelector
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
@@ -74,22 +78,22 @@ def sign(x):
         return 1
 
 
-def vliegAnglesToHkl(pos, wavelength, UBMatrix):
+def vliegAnglesToHkl(pos, wavelength, UBMatrix, UBinv=None):
     """
-    Returns hkl indices from pos object in radians.
+    Returns hkl indices from pos object in radians. UBinv is the inverse of
+    UBMatrix if already known.
     """
     wavevector = 2 * pi / wavelength
 
-    # Create transformation matrices
-    [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegMatrices(
-        pos.alpha, pos.delta, pos.gamma, pos.omega, pos.chi, pos.phi)
-
     # Create the plane normal vector in the alpha axis coordinate frame
-    qa = ((DELTA * GAMMA) - ALPHA.I) * matrix([[0], [wavevector], [0]])
+    qa = column(vlieg_q_alpha(pos.alpha, pos.delta, pos.gamma)) * wavevector
 
     # Transform the plane normal vector from the alpha frame to reciprical
     # lattice frame.
-    hkl = UBMatrix.I * PHI.I * CHI.I * OMEGA.I * qa
+    if UBinv is None:
+        UBinv = UBMatrix.I
+    hkl = (UBinv *
+           vlieg_sample_rotation_inverse(pos.omega, pos.chi, pos.phi) * qa)
 
     return hkl[0, 0], hkl[1, 0], hkl[2, 0]
 
@@ -98,11 +102,8 @@ class VliegUbCalcStrategy(PaperSpecificUbCalcStrategy):
 
     def calculate_q_phi(self, pos):
 
-        [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegMatrices(
-           pos.alpha, pos.delta, pos.gamma, pos.omega, pos.chi, pos.phi)
-
-        u1a = (DELTA * GAMMA - ALPHA.I) * y
-        u1p = PHI.I * CHI.I * OMEGA.I * u1a
+        u1a = column(vlieg_q_alpha(pos.alpha, pos.delta, pos.gamma))
+        u1p = vlieg_sample_rotation_inverse(pos.omega, pos.chi, pos.phi) * u1a
         return u1p
 
 
@@ -137,18 +138,21 @@ class VliegHklCalculator(HklCalculatorBase):
         Return hkl tuple from VliegPosition in radians and wavelength in
         Angstroms.
         """
-        return vliegAnglesToHkl(pos, wavelength, self._getUBMatrix())
+        return vliegAnglesToHkl(pos, wavelength, self._getUBMatrix(),
+                                self._getUBMatrixInverse())
 
-    def _anglesToVirtualAngles(self, pos, wavelength):
+    def _anglesToVirtualAngles(self, pos, wavelength, names=None):
         """
         Return dictionary of all virtual angles in radians from VliegPosition
         object win radians and wavelength in Angstroms. The virtual angles are:
-        Bin, Bout, azimuth and 2theta.
+        Bin, Bout, azimuth and 2theta. If names is given only those are
+        returned, and the azimuth is only calculated if included.
         """
 
         # Create transformation matrices
-        [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegMatrices(
-            pos.alpha, pos.delta, pos.gamma, pos.omega, pos.chi, pos.phi)
+        [ALPHA, DELTA, GAMMA, _, _, _] = createVliegMatrices(
+            pos.alpha, pos.delta, pos.gamma, None, None, None)
+        R = vlieg_sample_rotation(pos.omega, pos.chi, pos.phi)
         [SIGMA, TAU] = createVliegsSurfaceTransformationMatrices(
             self._getSigma() * TORAD, self._getTau() * TORAD)
 
@@ -156,8 +160,8 @@ class VliegHklCalculator(HklCalculatorBase):
         y_vector = matrix([[0], [1], [0]])
 
         # Calculate Bin from equation 15:
-        surfacenormal_alpha = OMEGA * CHI * PHI * S * matrix([[0], [0], [1]])
-        incoming_alpha = ALPHA.I * y_vector
+        surfacenormal_alpha = R * S * matrix([[0], [0], [1]])
+        incoming_alpha = ALPHA.T * y_vector
         minusSinBetaIn = dot3(surfacenormal_alpha, incoming_alpha)
         Bin = asin(bound(-minusSinBetaIn))
 
@@ -171,9 +175,83 @@ class VliegHklCalculator(HklCalculatorBase):
 
         cosTwoTheta = dot3(ALPHA * DELTA * GAMMA * y_vector, y_vector)
         twotheta = acos(bound(cosTwoTheta))
-        psi = self._anglesToPsi(pos, wavelength)
 
-        return {'Bin': Bin, 'Bout': Bout, 'azimuth': psi, '2theta': twotheta}
+        angles = {'Bin': Bin, 'Bout': Bout, '2theta': twotheta}
+        if names is None or 'azimuth' in names:
+            angles['azimuth'] = self._anglesToPsi(pos, wavelength)
+        if names is None:
+            return angles
+        return dict((name, angles[name]) for name in angles if name in names)
+
+    def _anglesToHklJacobian(self, angles, wavelength, sin=sin, cos=cos):
+        """
+        Return the rows of d(h, k, l)/d(alpha, delta, gamma, omega, chi, phi)
+        per radian from the angles in radians.
+        """
+        alpha, delta, gamma, omega, chi, phi = angles
+        d_alpha, d_delta, d_gamma = vlieg_q_alpha_derivatives(
+            alpha, delta, gamma, sin, cos)
+        d_omega, d_chi, d_phi = vlieg_sample_rows_derivatives(
+            omega, chi, phi, sin, cos)
+        return hkl_jacobian_rows(
+            self._getUBMatrixInverse(),
+            vlieg_sample_rows(omega, chi, phi, sin, cos),
+            vlieg_q_alpha(alpha, delta, gamma, sin, cos),
+            ((None, d_alpha), (None, d_delta), (None, d_gamma),
+             (d_omega, None), (d_chi, None), (d_phi, None)),
+            2 * pi / wavelength)
+
+    def _anglesToVirtualAnglesJacobian(self, angles, wavelength, names=None):
+        """
+        Return a dictionary of d(virtual angle)/d(alpha, delta, gamma, omega,
+        chi, phi) from the angles in radians, for Bin, Bout and 2theta or
+        those of them in names. The azimuth is not included as it is
+        measured from a reference solution which itself depends on the
+        angles.
+        """
+        alpha, delta, gamma, omega, chi, phi = angles
+        sa, ca = sin(alpha), cos(alpha)
+        sd, cd = sin(delta), cos(delta)
+        sg, cg = sin(gamma), cos(gamma)
+        virtual_angles = self._anglesToVirtualAngles(
+            VliegPosition(*angles), wavelength, ('Bin', 'Bout', '2theta'))
+
+        # surface normal in the alpha frame and its derivatives
+        S = createVliegsSurfaceTransformationMatrices(
+            self._getSigma() * TORAD, self._getTau() * TORAD)
+        S = S[1] * S[0]
+        n_phi = [S[i, 2] for i in range(3)]
+        n = rows_times(vlieg_sample_rows(omega, chi, phi), n_phi)
+        d_omega, d_chi, d_phi = [
+            rows_times(d, n_phi)
+            for d in vlieg_sample_rows_derivatives(omega, chi, phi)]
+        dn = [(0., 0., 0., d_omega[i], d_chi[i], d_phi[i]) for i in range(3)]
+
+        # Equation 15: sin(Bin) = -n . (ALPHA.T * y)
+        d_sin_Bin = combine_derivatives((-ca, dn[1]), (sa, dn[2]),
+                                        (n[1] * sa + n[2] * ca,
+                                         (1., 0., 0., 0., 0., 0.)))
+        # Equation 16: sin(Bout) = n . (DELTA * GAMMA * y)
+        out = cg * sd, cg * cd, sg
+        d_sin_Bout = combine_derivatives(
+            (out[0], dn[0]), (out[1], dn[1]), (out[2], dn[2]),
+            (n[0] * cg * cd - n[1] * cg * sd, (0., 1., 0., 0., 0., 0.)),
+            (-n[0] * sg * sd - n[1] * sg * cd + n[2] * cg,
+             (0., 0., 1., 0., 0., 0.)))
+        # Equation 25: cos(2theta) = ca * cg * cd - sa * sg
+        d_cos_twotheta = (-sa * cg * cd - ca * sg, -ca * cg * sd,
+                          -ca * sg * cd - sa * cg, 0., 0., 0.)
+
+        jacobian = {
+            'Bin': scale_derivatives(d_sin_Bin, 1., cos(virtual_angles['Bin'])),
+            'Bout': scale_derivatives(d_sin_Bout, 1.,
+                                      cos(virtual_angles['Bout'])),
+            '2theta': scale_derivatives(d_cos_twotheta, -1.,
+                                        sin(virtual_angles['2theta']))}
+        if names is None:
+            return jacobian
+        return dict((name, jacobian[name]) for name in jacobian
+                    if name in names)
 
     def _hklToAngles(self, h, k, l, wavelength):
         """
@@ -532,9 +610,7 @@ class VliegHklCalculator(HklCalculatorBase):
             return omega, chi, phi
 
         def checkSolution(omega, chi, phi):
-            _, _, _, OMEGA, CHI, PHI = createVliegMatrices(
-                None, None, None, omega, chi, phi)
-            R = OMEGA * CHI * PHI
+            R = vlieg_sample_rotation(omega, chi, phi)
             RtimesH_phi = R * H_phi
             print ("R*H_phi=%s, Q_alpha=%s" %
                    (R * H_phi.tolist(), Q_alpha.tolist()))
@@ -543,8 +619,8 @@ class VliegHklCalculator(HklCalculatorBase):
         # Using Vlieg section 7.2
 
         # Needed througout:
-        [ALPHA, DELTA, GAMMA, _, _, _] = createVliegMatrices(
-            alpha, delta, gamma, None, None, None)
+        [ALPHA, _, _, _, _, _] = createVliegMatrices(
+            alpha, None, None, None, None, None)
 
         ## Find Ro, one possible solution to equation 46: R*H_phi=Q_alpha
 
@@ -555,7 +631,7 @@ class VliegHklCalculator(HklCalculatorBase):
         H_phi = hklPhiNorm * (1 / normh)
 
         # Create Q_alpha from equation 47, (it comes normalised)
-        Q_alpha = ((DELTA * GAMMA) - ALPHA.I) * matrix([[0], [1], [0]])
+        Q_alpha = column(vlieg_q_alpha(alpha, delta, gamma))
         Q_alpha = Q_alpha * (1 / norm(Q_alpha))
 
         if self._getMode().name == '4cPhi':
@@ -623,17 +699,13 @@ class VliegHklCalculator(HklCalculatorBase):
         """
         # Using Vlieg section 7.2
 
-        # Needed througout:
-        [ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI] = createVliegMatrices(
-                pos.alpha, pos.delta, pos.gamma, pos.omega, pos.chi, pos.phi)
-
         # Solve equation 49 for psi, the rotation of the a reference solution
         # about Qalpha or H_phi##
 
         # Find Ro, the reference solution to equation 46: R*H_phi=Q_alpha
 
         # Create Q_alpha from equation 47, (it comes normalised)
-        Q_alpha = ((DELTA * GAMMA) - ALPHA.I) * matrix([[0], [1], [0]])
+        Q_alpha = column(vlieg_q_alpha(pos.alpha, pos.delta, pos.gamma))
         Q_alpha = Q_alpha * (1 / norm(Q_alpha))
 
         # Finh H_phi
@@ -648,7 +720,7 @@ class VliegHklCalculator(HklCalculatorBase):
         Ro = self._findMatrixToTransformAIntoB(H_phi, Q_alpha)
 
         # equation 48:
-        R = OMEGA * CHI * PHI
+        R = vlieg_sample_rotation(pos.omega, pos.chi, pos.phi)
 
         ## equation 50: Find a solution D to D*Q=norm(Q)*[[1],[0],[0]])
         D = self._findMatrixToTransformAIntoB(Q_alpha, matrix([[1], [0], [0]]))
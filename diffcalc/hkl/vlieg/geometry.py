@@ -93,6 +93,9 @@ def createVliegsPsiTransformationMatrix(psi):
 
 class VliegPosition(AbstractPosition):
     """The position of all six diffractometer axis"""
+
+    __slots__ = ('alpha', 'delta', 'gamma', 'omega', 'chi', 'phi')
+
     def __init__(self, alpha=None, delta=None, gamma=None, omega=None,
                  chi=None, phi=None):
         self.alpha = alpha
@@ -122,16 +125,6 @@ class VliegPosition(AbstractPosition):
         self.chi *= TODEG
         self.phi *= TODEG
 
-    def inRadians(self):
-        pos = self.clone()
-        pos.changeToRadians()
-        return pos
-
-    def inDegrees(self):
-        pos = self.clone()
-        pos.changeToDegrees()
-        return pos
-
     def nearlyEquals(self, pos2, maxnorm):
         for a, b in zip(self.totuple(), pos2.totuple()):
             if abs(a - b) > maxnorm:
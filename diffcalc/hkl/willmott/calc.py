@@ -28,8 +28,12 @@ from diffcalc.util import bound, AbstractPosition, DiffcalcException,\
     x_rotation, z_rotation
 from diffcalc.hkl.vlieg.geometry import VliegGeometry
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
-from diffcalc.hkl.calcbase import HklCalculatorBase
+from diffcalc.hkl.calcbase import HklCalculatorBase, hkl_jacobian_rows, \
+    scale_derivatives, combine_derivatives
 from diffcalc.hkl.common import DummyParameterManager
+from diffcalc.rotations import willmott_sample_rotation_inverse, \
+    willmott_h_lab, column, willmott_sample_rows, \
+    willmott_sample_rows_derivatives, willmott_h_lab_derivatives
 
 logger = logging.getLogger("diffcalc.hkl.willmot.calcwill")
 
@@ -67,22 +71,40 @@ def calc_PHI(phi):
 def angles_to_hkl_phi(delta, gamma, omegah, phi):
     """Calculate hkl matrix in phi frame in units of 2*pi/lambda
     """
-    DELTA, GAMMA, OMEGAH, PHI = create_matrices(delta, gamma, omegah, phi)
-    H_lab = (GAMMA * DELTA - I) * matrix([[0], [1], [0]])                # (43)
-    H_phi = PHI.I * OMEGAH.I * H_lab                                     # (44)
+    H_lab = column(willmott_h_lab(delta, gamma))                         # (43)
+    H_phi = willmott_sample_rotation_inverse(omegah, phi) * H_lab        # (44)
     return H_phi
 
 
-def angles_to_hkl(delta, gamma, omegah, phi, wavelength, UB):
-    """Calculate hkl matrix in reprical lattice space in units of 1/Angstrom
+def angles_to_hkl(delta, gamma, omegah, phi, wavelength, UB, UBinv=None):
+    """Calculate hkl matrix in reprical lattice space in units of 1/Angstrom.
+    UBinv is the inverse of UB if already known.
     """
     H_phi = angles_to_hkl_phi(delta, gamma, omegah, phi) * 2 * pi / wavelength
-    hkl = UB.I * H_phi                                                    # (5)
+    if UBinv is None:
+        UBinv = UB.I
+    hkl = UBinv * H_phi                                                   # (5)
     return hkl
 
 
+def angles_to_hkl_jacobian_rows(angles, UBinv, wavevector, sin=sin, cos=cos):
+    """Return the rows of d(UBinv * H_phi * wavevector)/d(delta, gamma,
+    omegah, phi) from the angles in radians.
+    """
+    delta, gamma, omegah, phi = angles
+    d_delta, d_gamma = willmott_h_lab_derivatives(delta, gamma, sin, cos)
+    d_omegah, d_phi = willmott_sample_rows_derivatives(omegah, phi, sin, cos)
+    return hkl_jacobian_rows(
+        UBinv, willmott_sample_rows(omegah, phi, sin, cos),
+        willmott_h_lab(delta, gamma, sin, cos),
+        ((None, d_delta), (None, d_gamma), (d_omegah, None), (d_phi, None)),
+        wavevector)
+
+
 class WillmottHorizontalPosition(AbstractPosition):
 
+    __slots__ = ('delta', 'gamma', 'omegah', 'phi')
+
     def __init__(self, delta=None, gamma=None, omegah=None, phi=None):
         self.delta = delta
         self.gamma = gamma
@@ -196,20 +218,21 @@ class WillmottHorizontalCalculator(HklCalculatorBase):
         Calculate miller indices from position in radians.
         """
         hkl_matrix = angles_to_hkl(pos.delta, pos.gamma, pos.omegah, pos.phi,
-                             wavelength, self._UB)
+                             wavelength, self._UB, self._getUBMatrixInverse())
         return hkl_matrix[0, 0], hkl_matrix[1, 0], hkl_matrix[2, 0],
 
-    def _anglesToVirtualAngles(self, pos, wavelength):
+    def _anglesToVirtualAngles(self, pos, wavelength, names=None):
         """
         Calculate virtual-angles in radians from position in radians.
 
-        Return theta, alpha, and beta in a dictionary.
+        Return theta, alpha, and beta in a dictionary, or only those in names
+        if given.
         """
 
         betain = pos.omegah                                              # (52)
 
         hkl = angles_to_hkl(pos.delta, pos.gamma, pos.omegah, pos.phi,
-                              wavelength, self._UB)
+                              wavelength, self._UB, self._getUBMatrixInverse())
         H_phi = self._UB * hkl
         H_phi = H_phi / (2 * pi / wavelength)
         l_phi = H_phi[2, 0]
@@ -219,7 +242,44 @@ class WillmottHorizontalCalculator(HklCalculatorBase):
         cos_2theta = cos(pos.delta) * cos(pos.gamma)
         theta = acos(bound(cos_2theta)) / 2.
 
-        return {'theta': theta, 'betain': betain, 'betaout': betaout}
+        angles = {'theta': theta, 'betain': betain, 'betaout': betaout}
+        if names is None:
+            return angles
+        return dict((name, angles[name]) for name in angles if name in names)
+
+    def _anglesToHklJacobian(self, angles, wavelength, sin=sin, cos=cos):
+        """
+        Return the rows of d(h, k, l)/d(delta, gamma, omegah, phi) per radian
+        from the angles in radians.
+        """
+        return angles_to_hkl_jacobian_rows(
+            angles, self._getUBMatrixInverse(), 2 * pi / wavelength, sin, cos)
+
+    def _anglesToVirtualAnglesJacobian(self, angles, wavelength, names=None):
+        """
+        Return a dictionary of d(virtual angle)/d(delta, gamma, omegah, phi)
+        from the angles in radians, for theta, betain and betaout or those of
+        them in names.
+        """
+        delta, gamma, omegah, phi = angles
+        virtual_angles = self._anglesToVirtualAngles(
+            WillmottHorizontalPosition(*angles), wavelength)
+        d_cos_2theta = (-sin(delta) * cos(gamma), -cos(delta) * sin(gamma),
+                        0., 0.)
+        d_betain = (0., 0., 1., 0.)                                      # (52)
+        # l_phi in units of 2*pi/lambda, from H_phi (44)
+        d_l_phi = angles_to_hkl_jacobian_rows(angles, I, 1.)[2]
+        jacobian = {
+            'theta': scale_derivatives(
+                d_cos_2theta, -.5, sin(2 * virtual_angles['theta'])),
+            'betain': d_betain,
+            'betaout': scale_derivatives(                                # (54)
+                combine_derivatives((1., d_l_phi), (-cos(omegah), d_betain)),
+                1., cos(virtual_angles['betaout']))}
+        if names is None:
+            return jacobian
+        return dict((name, jacobian[name]) for name in jacobian
+                    if name in names)
 
     def _hklToAngles(self, h, k, l, wavelength):
         """
@@ -0,0 +1,944 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Vectorised versions of the You hkl calculations.
+
+These operate on numpy arrays with one row per reflection and require numpy
+(they are not available under Jython with Jama). The calculations follow
+those in diffcalc.hkl.you.calc step for step. Any row that cannot be solved
+cleanly here (including every row that would raise an exception) is handed
+back to the scalar calculator so that results, and failures, match it
+exactly.
+"""
+
+import numpy as np
+
+from diffcalc.util import DiffcalcException, SMALL as BOUND_SMALL
+from diffcalc.hkl.you.constraints import NUNAME, ModePlan, ref_constraints
+from diffcalc.hkl.calcbase import VERIFY_ALWAYS, VERIFY_SAMPLED, \
+    VERIFY_CHEAP, VERIFY_OFF, check_verification_policy, q_tolerance
+from diffcalc.rotations import you_sample_rows, you_q_lab
+
+SMALL = 1e-8  # as in diffcalc.hkl.you.calc
+CUT_SMALL = 1e-8  # as in diffcalc.hardware
+TORAD = np.pi / 180
+TODEG = 180 / np.pi
+
+VIRTUAL_ANGLE_NAMES = ('theta', 'qaz', 'alpha', 'naz', 'tau', 'psi', 'beta')
+
+# Per row status codes
+STATUS_OK = 0
+STATUS_UNREACHABLE = 1  # scalar calculation raised a DiffcalcException
+STATUS_ERROR = 2  # scalar calculation raised any other exception
+
+
+def is_small(x):
+    return np.abs(x) < SMALL
+
+
+def _bound(x):
+    """Return x moved between -1 and 1 and a mask of values that
+    diffcalc.util.bound would have refused to bound"""
+    return np.clip(x, -1, 1), np.abs(x) > (1 + BOUND_SMALL)
+
+
+def cut_at_minus_pi(value):
+    return np.where(value < (-np.pi - SMALL), value + 2 * np.pi,
+                    np.where(value >= np.pi + SMALL, value - 2 * np.pi, value))
+
+
+### Stacked rotation matrices ###
+
+def _stack(rows, shape):
+    return np.stack([np.stack([np.broadcast_to(v, shape) for v in row],
+                              axis=-1) for row in rows], axis=-2)
+
+
+def x_rotations(th):
+    """Return an array of x_rotation matrices, shaped th.shape + (3, 3)"""
+    th = np.asarray(th, dtype=float)
+    c, s = np.cos(th), np.sin(th)
+    return _stack(((1, 0, 0), (0, c, -s), (0, s, c)), th.shape)
+
+
+def y_rotations(th):
+    """Return an array of y_rotation matrices, shaped th.shape + (3, 3)"""
+    th = np.asarray(th, dtype=float)
+    c, s = np.cos(th), np.sin(th)
+    return _stack(((c, 0, s), (0, 1, 0), (-s, 0, c)), th.shape)
+
+
+def z_rotations(th):
+    """Return an array of z_rotation matrices, shaped th.shape + (3, 3)"""
+    th = np.asarray(th, dtype=float)
+    c, s = np.cos(th), np.sin(th)
+    return _stack(((c, -s, 0), (s, c, 0), (0, 0, 1)), th.shape)
+
+
+def transposed(M):
+    """Transpose each matrix in a stack of matrices"""
+    return np.swapaxes(M, -1, -2)
+
+
+def sample_rotations(mu, eta, chi, phi):
+    """Return the stacked matrices Z = MU * ETA * CHI * PHI which take phi
+    frame vectors into the lab frame. Being rotations, the transpose of each
+    takes lab frame vectors back to the phi frame."""
+    shape = np.broadcast(mu, eta, chi, phi).shape
+    return _stack(you_sample_rows(mu, eta, chi, phi, np.sin, np.cos), shape)
+
+
+def _apply(M, v):
+    """Multiply each matrix in a stack by a vector (or stack of vectors)"""
+    return np.matmul(M, np.asarray(v)[..., np.newaxis])[..., 0]
+
+
+def _q_lab(delta, nu, wavelength):
+    """Equation 12: (NU * DELTA - I) * [0, 2 * pi / wavelength, 0]"""
+    delta, nu = np.broadcast_arrays(delta, nu)
+    return np.stack(you_q_lab(delta, nu, np.sin, np.cos),
+                    axis=-1) * (2 * np.pi / wavelength)
+
+
+def _angles_to_hkl(mu, delta, nu, eta, chi, phi, wavelength, UBinv):
+    """Return an array of hkl values, with hkl along the last axis, from
+    arrays of angles in radians"""
+    Z = sample_rotations(mu, eta, chi, phi)
+    q_phi = _apply(transposed(Z), _q_lab(delta, nu, wavelength))
+    return _apply(UBinv, q_phi)
+
+
+def _angles_to_virtual_angles(mu, delta, nu, eta, chi, phi, n_phi):
+    """Return a dictionary of virtual angle arrays in radians and a mask of
+    those elements for which the scalar calculation would fail to bound a
+    sine or cosine"""
+
+    cos_2theta, unbounded = _bound(np.cos(delta) * np.cos(nu))
+    theta = np.arccos(cos_2theta) / 2.                                 # (19)
+    qaz = np.arctan2(np.tan(delta), np.sin(nu))
+    qaz = np.where(delta > np.pi / 2, -qaz, qaz)
+
+    n_lab = _apply(sample_rotations(mu, eta, chi, phi), n_phi)
+    sin_alpha, bad = _bound(-n_lab[..., 1])
+    unbounded = unbounded | bad
+    alpha = np.arcsin(sin_alpha)
+    naz = np.arctan2(n_lab[..., 0], n_lab[..., 2])                     # (20)
+
+    cos_tau, bad = _bound(np.cos(alpha) * np.cos(theta) * np.cos(naz - qaz) +
+                          np.sin(alpha) * np.sin(theta))
+    unbounded = unbounded | bad
+    tau = np.arccos(cos_tau)                                           # (23)
+
+    sin_beta, bad = _bound(2 * np.sin(theta) * np.cos(tau) - np.sin(alpha))
+    unbounded = unbounded | bad
+    beta = np.arcsin(sin_beta)                                         # (24)
+
+    sin_tau = np.sin(tau)
+    cos_theta = np.cos(theta)
+    cos_psi, bad = _bound((np.cos(tau) * np.sin(theta) - np.sin(alpha)) /
+                          (sin_tau * cos_theta))
+    undefined = (sin_tau == 0) | (cos_theta == 0)
+    unbounded = unbounded | (bad & ~undefined)
+    psi = np.where(undefined, np.nan, np.arccos(cos_psi))              # (28)
+
+    return ({'theta': theta, 'qaz': qaz, 'alpha': alpha, 'naz': naz,
+             'tau': tau, 'psi': psi, 'beta': beta}, unbounded)
+
+
+### angles to hkl ###
+
+def _positions_in_radians(positions):
+    positions = np.array(positions, dtype=float)
+    if positions.ndim != 2 or positions.shape[1] != 6:
+        raise ValueError('positions must be an N*6 array')
+    return positions.T * TORAD
+
+
+def angles_to_hkl_batch(positions, wavelength, UBmatrix):
+    """Return an N*3 array of hkl values from an N*6 array of positions in
+    degrees (ordered mu, delta, nu, eta, chi, phi) and wavelength in
+    Angstroms."""
+    UBinv = np.linalg.inv(np.array(UBmatrix, dtype=float))
+    return _angles_to_hkl(
+        *(list(_positions_in_radians(positions)) + [wavelength, UBinv]))
+
+
+def angles_to_virtual_angles_batch(positions, n_phi):
+    """Return an N*7 array of virtual angles in degrees, ordered as
+    VIRTUAL_ANGLE_NAMES, from an N*6 array of positions in degrees (ordered
+    mu, delta, nu, eta, chi, phi) and the reference vector n_phi.
+
+    Where psi is undefined it is returned as nan (without the warning
+    printed by the scalar code)."""
+    n_phi = np.array(n_phi, dtype=float).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        virtual, _ = _angles_to_virtual_angles(
+            *(list(_positions_in_radians(positions)) + [n_phi]))
+    return np.column_stack(
+        [virtual[name] for name in VIRTUAL_ANGLE_NAMES]) * TODEG
+
+
+### Limits ###
+
+def _cut_angle_at(cut_angle, value):
+    """Vectorised diffcalc.hardware.cut_angle_at"""
+    zero = (np.abs(value + 360) < CUT_SMALL) | (np.abs(value) < CUT_SMALL)
+    if cut_angle == 0:
+        zero |= np.abs(value - 360) < CUT_SMALL
+    value = np.where(zero, 0., value)
+    return np.where(value < (cut_angle - CUT_SMALL), value + 360.,
+                    np.where(value >= cut_angle + 360. + CUT_SMALL,
+                             value - 360., value))
+
+
+def _within_limits(limits, name, value):
+    """Return a mask of those radian values that are within the limits for
+    the named axis once cut, or None if the hardware has no such axis.
+    limits is YouHklCalculator._get_axis_limits()"""
+    if name not in limits:
+        return None
+    cut, lower, upper = limits[name]
+    value = value * TODEG
+    if cut is not None:
+        value = _cut_angle_at(cut, value)
+    okay = np.ones(value.shape, dtype=bool)
+    if upper is not None:
+        okay &= ~(value > upper)
+    if lower is not None:
+        okay &= ~(value < lower)
+    return okay
+
+
+def _position_within_limits(limits, mu, delta, nu, eta, chi, phi):
+    """Vectorised YouHklCalculator._is_position_within_limits. Return a mask
+    of the rows with every radian angle within limits"""
+    okay = np.ones(np.shape(mu), dtype=bool)
+    for name, value in zip(('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'),
+                           (mu, delta, nu, eta, chi, phi)):
+        in_limits = _within_limits(limits, name, value)
+        if in_limits is not None:
+            okay &= in_limits
+    return okay
+
+
+def _transformed_values(value):
+    """Vectorised _generate_transformed_values. Return an N*4 array of values
+    and a mask of those that are generated"""
+    n = len(value)
+    values = np.column_stack(
+        (value, -value, np.pi + value, np.pi - value))
+    generated = np.ones((n, 4), dtype=bool)
+
+    at_zero = is_small(value)
+    values[at_zero, 0] = 0.
+    values[at_zero, 1] = np.pi
+    at_90 = ~at_zero & (is_small(value - np.pi / 2) |
+                        is_small(value + np.pi / 2))
+    values[at_90, 0] = np.pi / 2
+    values[at_90, 1] = -np.pi / 2
+    generated[at_zero | at_90, 2:] = False
+    return values, generated
+
+
+def _possible_solutions(limits, values, names, constrained_names):
+    """Vectorised _generate_possible_solutions. Return a list with an N*M
+    array for each name and an N*M mask of the generated combinations within
+    limits, which are in the same order as the scalar code would produce
+    them. Return None if the hardware cannot check the limits."""
+    columns = []
+    for value, name in zip(values, names):
+        if name in constrained_names:
+            # constrained values are checked against the limits too
+            in_limits = _within_limits(limits, name, value)
+            if in_limits is None:
+                in_limits = np.ones(len(value), dtype=bool)
+            columns.append((cut_at_minus_pi(value)[:, np.newaxis],
+                            in_limits[:, np.newaxis]))
+        else:
+            transformed, generated = _transformed_values(value)
+            in_limits = _within_limits(limits, name, transformed)
+            if in_limits is None:
+                return None
+            columns.append((cut_at_minus_pi(transformed),
+                            generated & in_limits))
+
+    n = len(values[0])
+    widths = [column.shape[1] for column, _ in columns]
+    grids = []
+    mask = np.ones([n] + widths, dtype=bool)
+    for i, (column, generated) in enumerate(columns):
+        shape = [n] + [1] * len(widths)
+        shape[i + 1] = widths[i]
+        grids.append(np.broadcast_to(column.reshape(shape), mask.shape))
+        mask = mask & generated.reshape(shape)
+    return [grid.reshape(n, -1) for grid in grids], mask.reshape(n, -1)
+
+
+### hkl to angles ###
+
+def hkl_to_angles_batch(hklcalc, hkl_array, wavelength, verification=None):
+    """Return N*6 positions, N*7 virtual angles and N status codes for an N*3
+    array of hkl values and wavelength in Angstroms.
+
+    Positions are in the You order mu, delta, nu, eta, chi, phi and virtual
+    angles in the order given by VIRTUAL_ANGLE_NAMES, all in degrees, exactly
+    as YouHklCalculator.hklToAngles would return them. Rows that could not be
+    calculated are filled with nan and marked with STATUS_UNREACHABLE or
+    STATUS_ERROR.
+
+    verification overrides hklcalc.verification for this call, without
+    changing the calculator. Vectorised rows are checked by mapping them back
+    to hkl, or with 'cheap' by comparing their scattering vectors with
+    UB * hkl, except that with 'sampled' only every Nth row is checked and
+    with 'off' none are.
+    """
+    hkl = np.array(hkl_array, dtype=float)
+    if hkl.ndim != 2 or hkl.shape[1] != 3:
+        raise ValueError('hkl_array must be an N*3 array')
+    if verification is not None:
+        check_verification_policy(verification)
+    return _hkl_to_angles_batch(hklcalc, hkl, wavelength, verification)
+
+
+def _rows_to_verify(hklcalc, n, verification=None):
+    """Return a mask of the N rows to verify under the verification policy,
+    by default hklcalc's"""
+    if verification is None:
+        verification = hklcalc.verification
+    if verification == VERIFY_OFF:
+        return np.zeros(n, dtype=bool)
+    if verification == VERIFY_SAMPLED:
+        return np.arange(n) % hklcalc.verification_interval == 0
+    return np.ones(n, dtype=bool)
+
+
+def _hkl_to_angles_batch(hklcalc, hkl, wavelength, verification=None):
+    n = len(hkl)
+    constraints = _fully_constrained_plan(hklcalc)
+    positions, virtual_angles, status = _empty_results(n)
+    verify = _rows_to_verify(hklcalc, n, verification)
+    cheap = (verification or hklcalc.verification) == VERIFY_CHEAP
+
+    solved = np.zeros(n, dtype=bool)
+    if n and len(constraints.sample) == 1:
+        with np.errstate(all='ignore'):
+            result = _hkl_to_angles_one_sample_constraint(
+                hklcalc, hkl, wavelength, verify=verify, cheap=cheap)
+        solved = _store_solved(hklcalc, result, positions, virtual_angles)
+
+    # Whatever remains is solved exactly as the scalar code would
+    checked = VERIFY_CHEAP if cheap else VERIFY_ALWAYS
+
+    def solve(i):
+        h, k, l = hkl[i]
+        if verification is None:
+            return hklcalc.hklToAngles(h, k, l, wavelength)
+        return hklcalc.hklToAngles(h, k, l, wavelength,
+                                   checked if verify[i] else VERIFY_OFF)
+    _solve_scalar_rows(solve, ~solved, positions, virtual_angles, status)
+    return positions, virtual_angles, status
+
+
+def _fully_constrained_plan(hklcalc):
+    plan = hklcalc.constraints.mode_plan
+    if not plan.fully_constrained:
+        raise DiffcalcException(
+            "Diffcalc is not fully constrained.\n"
+            "Type 'help con' for instructions")
+    return plan
+
+
+def _empty_results(n):
+    """Return N*6 positions and N*7 virtual angles filled with nan, and N
+    STATUS_OK status codes"""
+    positions = np.empty((n, 6))
+    positions.fill(np.nan)
+    virtual_angles = np.empty((n, len(VIRTUAL_ANGLE_NAMES)))
+    virtual_angles.fill(np.nan)
+    return positions, virtual_angles, np.zeros(n, dtype=int)
+
+
+def _store_solved(hklcalc, result, positions, virtual_angles):
+    """Copy the solved rows of a vectorised result (or None) into positions,
+    in the sector chosen by hklcalc's transform selector, and virtual_angles
+    and return the mask of solved rows"""
+    if result is None:
+        return np.zeros(len(positions), dtype=bool)
+    solved, pos, virtual = result
+    selector = hklcalc.transform_selector
+    if selector.active and solved.any():
+        pos = pos.copy()
+        pos[solved], _ = selector.select(pos[solved],
+                                         hklcalc._get_axis_limits(),
+                                         hklcalc.constrained_angle_names())
+    positions[solved] = pos[solved]
+    virtual_angles[solved] = virtual[solved]
+    return solved
+
+
+def _solve_scalar_rows(solve, rows, positions, virtual_angles, status):
+    """Fill in the rows selected by mask rows with the position and virtual
+    angles returned by solve(i), or set their status if it raises."""
+    for i in np.flatnonzero(rows):
+        try:
+            pos, virtual = solve(i)
+        except DiffcalcException:
+            status[i] = STATUS_UNREACHABLE
+        except Exception:
+            status[i] = STATUS_ERROR
+        else:
+            positions[i] = pos.totuple()
+            virtual_angles[i] = [virtual[name] for name in VIRTUAL_ANGLE_NAMES]
+
+
+def _fixed_hkl(hkl):
+    hkl = np.array(hkl, dtype=float)
+    if hkl.shape != (3,):
+        raise ValueError('hkl must be a sequence of three values')
+    return hkl
+
+
+def _repeated(values, n):
+    """Repeat each single row array in values n times"""
+    return [np.repeat(v, n, axis=0) for v in values]
+
+
+### psi sweep ###
+
+def psi_sweep(hklcalc, hkl, psi_array, wavelength):
+    """Return N*6 positions, N*7 virtual angles, N status codes and an N*6
+    mask of angles within the hardware limits for a fixed hkl and each of N
+    azimuths in degrees, with wavelength in Angstroms.
+
+    The current reference constraint is replaced by psi; the detector and
+    sample constraints are kept. theta and tau are calculated once and the
+    whole sweep then solved in one vectorised pass. Points that cannot be
+    vectorised are solved by hklToAngles with psi constrained to their value,
+    on a scratch calculator so that hklcalc's constraints, cache, statistics
+    and tracking state are left untouched. Columns and status codes are as
+    for hkl_to_angles_batch. Rows that could not be calculated have no angles
+    within limits.
+    """
+    hkl = _fixed_hkl(hkl)
+    psi = np.array(psi_array, dtype=float)
+    if psi.ndim != 1:
+        raise ValueError('psi_array must be one dimensional')
+
+    plan = _fully_constrained_plan(hklcalc)
+    if not plan.reference:
+        raise DiffcalcException(
+            'A psi sweep requires a reference constraint to replace with '
+            'psi.\nType \'help con\' for instructions')
+    constrained = dict((name, value) for name, value in plan.all.items()
+                       if name not in ref_constraints)
+
+    n = len(psi)
+    positions, virtual_angles, status = _empty_results(n)
+
+    solved = np.zeros(n, dtype=bool)
+    if n and len(plan.sample) == 1:
+        constrained['psi'] = psi[0] * TORAD
+        with np.errstate(all='ignore'):
+            first = _theta_and_tau(hklcalc, hkl[np.newaxis], wavelength)
+            result = _hkl_to_angles_one_sample_constraint(
+                hklcalc, np.tile(hkl, (n, 1)), wavelength,
+                ModePlan(constrained), psi * TORAD, _repeated(first, n))
+        solved = _store_solved(hklcalc, result, positions, virtual_angles)
+
+    scratch = hklcalc._scratch_calculator(constrained)
+
+    def solve(i):
+        constrained['psi'] = psi[i] * TORAD
+        scratch.constraints._constrained = dict(constrained)
+        return scratch.hklToAngles(hkl[0], hkl[1], hkl[2], wavelength)
+    _solve_scalar_rows(solve, ~solved, positions, virtual_angles, status)
+
+    within_limits = np.isfinite(positions)
+    limits = hklcalc._get_axis_limits()
+    for j, name in enumerate(('mu', 'delta', NUNAME, 'eta', 'chi', 'phi')):
+        with np.errstate(invalid='ignore'):
+            in_limits = _within_limits(limits, name, positions[:, j] * TORAD)
+        if in_limits is not None:
+            within_limits[:, j] &= in_limits
+    return positions, virtual_angles, status, within_limits
+
+
+def reachable_psi_intervals(hklcalc, hkl, wavelength, step=1.,
+                            tolerance=1e-3):
+    """Return a list of (start, end) pairs of psi in degrees between which a
+    fixed hkl at wavelength in Angstroms can be reached within the hardware
+    limits, with psi replacing the reference constraint as for psi_sweep.
+
+    psi is sampled from 0 to 180 degrees every step degrees and the end of
+    each interval then refined by bisection, all ends together, to within
+    tolerance degrees. The ends returned are reachable. Intervals narrower
+    than step may be missed.
+    """
+    psi = np.linspace(0, 180, int(np.ceil(180. / step)) + 1)
+    reachable = _reachable_psi(hklcalc, hkl, psi, wavelength)
+
+    changes = np.flatnonzero(reachable[1:] != reachable[:-1])
+    low = psi[changes]
+    high = psi[changes + 1]
+    low_reachable = reachable[changes]
+    while len(changes) and (high - low).max() > tolerance:
+        middle = (low + high) / 2
+        same = (_reachable_psi(hklcalc, hkl, middle, wavelength) ==
+                low_reachable)
+        low = np.where(same, middle, low)
+        high = np.where(same, high, middle)
+
+    intervals = []
+    start = psi[0] if reachable[0] else None
+    for low_, high_, leaving in zip(low, high, low_reachable):
+        if leaving:
+            intervals.append((start, low_))
+        else:
+            start = high_
+    if reachable[-1]:
+        intervals.append((start, psi[-1]))
+    return [(float(start), float(end)) for start, end in intervals]
+
+
+def _reachable_psi(hklcalc, hkl, psi, wavelength):
+    """Return a mask of the psi values at which hkl can be reached within
+    the hardware limits"""
+    _, _, status, within_limits = psi_sweep(hklcalc, hkl, psi, wavelength)
+    return (status == STATUS_OK) & within_limits.all(axis=1)
+
+
+### Energy series ###
+
+def hkl_to_angles_vs_wavelength(hklcalc, hkl, wavelengths):
+    """Return N*6 positions, N*7 virtual angles and N status codes for a
+    fixed hkl at each of N wavelengths in Angstroms.
+
+    h_phi and tau do not depend on the wavelength, so are calculated once;
+    theta and everything that follows from it are then calculated for all
+    wavelengths in one vectorised pass. Points that cannot be vectorised are
+    solved by hklToAngles. Columns and status codes are as for
+    hkl_to_angles_batch.
+    """
+    hkl = _fixed_hkl(hkl)
+    wavelengths = np.array(wavelengths, dtype=float)
+    if wavelengths.ndim != 1:
+        raise ValueError('wavelengths must be one dimensional')
+
+    plan = _fully_constrained_plan(hklcalc)
+    n = len(wavelengths)
+    positions, virtual_angles, status = _empty_results(n)
+
+    solved = np.zeros(n, dtype=bool)
+    if n and len(plan.sample) == 1:
+        with np.errstate(all='ignore'):
+            h_phi_and_tau = _repeated(
+                _h_phi_and_tau(hklcalc, hkl[np.newaxis]), n)
+            result = _hkl_to_angles_one_sample_constraint(
+                hklcalc, np.tile(hkl, (n, 1)), wavelengths,
+                theta_and_tau=_theta_and_tau(hklcalc, None, wavelengths,
+                                             h_phi_and_tau))
+        solved = _store_solved(hklcalc, result, positions, virtual_angles)
+
+    def solve(i):
+        return hklcalc.hklToAngles(hkl[0], hkl[1], hkl[2], wavelengths[i])
+    _solve_scalar_rows(solve, ~solved, positions, virtual_angles, status)
+    return positions, virtual_angles, status
+
+
+def _h_phi_and_tau(hklcalc, hkl):
+    """Return h_phi, its length, tau and a mask of the rows for which the
+    scalar code could calculate them"""
+    UB = np.array(hklcalc._get_ubmatrix(), dtype=float)
+    n_phi = np.array(hklcalc._get_n_phi(), dtype=float).ravel()
+    okay = np.ones(len(hkl), dtype=bool)
+
+    h_phi = hkl.dot(UB.T)
+    q_length = np.sqrt((h_phi ** 2).sum(axis=1))
+    okay &= q_length != 0
+
+    h_phi_unit = h_phi * (1 / q_length)[:, np.newaxis]
+    n_phi_unit = n_phi * (1 / np.sqrt((n_phi ** 2).sum()))
+    cos_tau, bad = _bound(h_phi_unit.dot(n_phi_unit))
+    okay &= ~bad
+    tau = np.arccos(cos_tau)
+    return h_phi, q_length, tau, okay
+
+
+def _theta_and_tau(hklcalc, hkl, wavelength, h_phi_and_tau=None):
+    """Return h_phi, theta, tau and a mask of the rows for which the scalar
+    code could calculate them. wavelength may be an array with a value for
+    each row, and h_phi_and_tau as already calculated by _h_phi_and_tau."""
+    if h_phi_and_tau is None:
+        h_phi_and_tau = _h_phi_and_tau(hklcalc, hkl)
+    h_phi, q_length, tau, okay = h_phi_and_tau
+    sin_theta = q_length / (2 * (2 * np.pi / wavelength))
+    okay = okay & (sin_theta <= 1)
+    theta = np.arcsin(sin_theta)
+    return h_phi, theta, tau, okay
+
+
+def _hkl_to_angles_one_sample_constraint(hklcalc, hkl, wavelength, plan=None,
+                                         ref_value=None, theta_and_tau=None,
+                                         verify=None, cheap=None):
+    """Return a mask of solved rows, and positions and virtual angles in
+    degrees, for the modes with one sample constraint. Return None if no
+    rows can be vectorised.
+
+    wavelength may be an array with a value for each row. plan defaults to
+    the current mode plan. ref_value, an array with a value in radians for
+    each row, overrides the value of its reference constraint. theta_and_tau
+    may be given as already calculated by _theta_and_tau. verify, a mask of
+    the rows to map back to hkl, defaults to those due under hklcalc's
+    verification policy. If cheap (by default if that policy is 'cheap') the
+    scattering vectors of these rows are compared with h_phi instead.
+    """
+
+    constraints = plan or hklcalc.constraints.mode_plan
+    limits = hklcalc._get_axis_limits()
+    n_phi = np.array(hklcalc._get_n_phi(), dtype=float).ravel()
+
+    ### theta and tau ###
+
+    if theta_and_tau is None:
+        theta_and_tau = _theta_and_tau(hklcalc, hkl, wavelength)
+    h_phi, theta, tau, okay = theta_and_tau
+    okay = okay.copy()
+    wavelengths = np.broadcast_to(np.asarray(wavelength, dtype=float),
+                                  (len(hkl),))
+
+    ### Reference constraint column ###
+
+    ref_name, value = constraints.reference.items()[0]
+    if ref_value is None:
+        ref_value = value
+    okay &= (np.sin(tau) != 0) & (np.cos(theta) != 0)
+    if ref_name == 'psi':
+        sin_alpha, bad = _bound(np.cos(tau) * np.sin(theta) -
+                                np.cos(theta) * np.sin(tau) * np.cos(ref_value))
+        okay &= ~bad
+        alpha = np.arcsin(sin_alpha)
+        _, bad = _bound(np.cos(tau) * np.sin(theta) +
+                        np.cos(theta) * np.sin(tau) * np.cos(ref_value))
+        okay &= ~bad
+    elif ref_name == 'a_eq_b':
+        sin_alpha, bad = _bound(np.cos(tau) * np.sin(theta))
+        okay &= ~bad
+        alpha = np.arcsin(sin_alpha)
+    elif ref_name == 'alpha':
+        alpha = np.empty(len(hkl))
+        alpha[:] = ref_value
+        sin_beta = 2 * np.sin(theta) * np.cos(tau) - np.sin(alpha)
+        okay &= np.abs(sin_beta) <= 1
+    elif ref_name == 'beta':
+        sin_alpha = 2 * np.sin(theta) * np.cos(tau) - np.sin(ref_value)
+        okay &= np.abs(sin_alpha) <= 1
+        alpha = np.arcsin(sin_alpha)
+    else:
+        return None
+    if ref_name != 'psi':
+        _, bad = _bound((np.cos(tau) * np.sin(theta) - np.sin(alpha)) /
+                        (np.sin(tau) * np.cos(theta)))
+        okay &= ~bad
+
+    ### Detector constraint column ###
+
+    detector = constraints.detector
+    naz_constraint = constraints.naz
+    sin_2theta = np.sin(2 * theta)
+    cos_2theta = np.cos(2 * theta)
+
+    # _calc_angle_between_naz_and_qaz
+    bottom = np.cos(alpha) * np.cos(theta)
+    okay &= ~(is_small(bottom) & (is_small(np.cos(alpha)) |
+                                  is_small(np.cos(theta))))
+    okay &= bottom != 0
+    cos_naz_qaz, bad = _bound(
+        (np.cos(tau) - np.sin(alpha) * np.sin(theta)) / bottom)
+    okay &= ~bad
+    naz_qaz_angle = np.arccos(cos_naz_qaz)
+
+    if detector:
+        det_name, det_value = detector.items()[0]
+        if det_name == 'delta':
+            delta = np.empty(len(hkl))
+            delta.fill(det_value)
+            okay &= ~is_small(sin_2theta)
+            sin_qaz, bad = _bound(np.sin(delta) / sin_2theta)
+            okay &= ~bad
+            qaz = np.arcsin(sin_qaz)
+        elif det_name == NUNAME:
+            nu = np.empty(len(hkl))
+            nu.fill(det_value)
+            okay &= ~is_small(sin_2theta)
+            cos_qaz, bad = _bound(np.tan(nu) / np.tan(2 * theta))
+            okay &= ~bad
+            qaz = np.arccos(cos_qaz)
+        elif det_name == 'qaz':
+            qaz = np.empty(len(hkl))
+            qaz.fill(det_value)
+        else:
+            return None
+        if det_name != NUNAME:
+            nu = np.arctan2(sin_2theta * np.cos(qaz), cos_2theta)
+        if det_name != 'delta':
+            cos_qaz = np.cos(qaz)
+            cos_delta, bad = _bound(cos_2theta / np.cos(nu))
+            okay &= ~(is_small(cos_qaz) & (bad | (np.cos(nu) == 0)))
+            delta = np.where(
+                is_small(cos_qaz), np.sign(qaz) * np.arccos(cos_delta),
+                np.arctan2(np.sin(qaz) * np.sin(nu), cos_qaz))
+        naz = qaz - naz_qaz_angle
+        naz = np.where(naz < 0, qaz + naz_qaz_angle, naz)
+    else:
+        det_name, naz_value = naz_constraint.items()[0]
+        naz = np.empty(len(hkl))
+        naz.fill(naz_value)
+        qaz = naz - naz_qaz_angle
+        nu = np.arctan2(sin_2theta * np.cos(qaz), cos_2theta)
+        delta = np.arctan2(np.sin(qaz) * np.sin(nu), np.cos(qaz))
+
+    # _generate_detector_solutions
+    if NUNAME in detector:
+        shortcut = np.zeros(len(hkl), dtype=bool)
+    else:
+        shortcut = is_small(delta - np.pi / 2)
+    possible = _possible_solutions(
+        limits, [delta, nu], ['delta', NUNAME], (det_name,))
+    if possible is None:
+        okay &= shortcut
+        nu = np.where(shortcut, 0., nu)
+    else:
+        (deltas, nus), generated = possible
+        cos_2theta_, _ = _bound(np.cos(deltas) * np.cos(nus))
+        theta_ = np.arccos(cos_2theta_) / 2.
+        qaz_ = np.arctan2(np.tan(deltas), np.sin(nus))
+        qaz_ = np.where(deltas > np.pi / 2, -qaz_, qaz_)
+        matching = (generated & is_small(theta_ - theta[:, np.newaxis]) &
+                    is_small(qaz_ - qaz[:, np.newaxis]))
+        # Rows with more than one detector solution are left to the scalar
+        # code to pick between (or to complain about)
+        single = matching.sum(axis=1) == 1
+        okay &= shortcut | single
+        index = matching.argmax(axis=1)
+        rows = np.arange(len(hkl))
+        delta = np.where(shortcut, delta, deltas[rows, index])
+        nu = np.where(shortcut, 0., nus[rows, index])
+
+    ### Sample constraint column ###
+
+    samp_name, samp_value = constraints.sample.items()[0]
+    if samp_name not in ('mu', 'eta', 'chi', 'phi'):
+        return None
+
+    q_lab = np.column_stack((np.cos(theta) * np.sin(qaz), -np.sin(theta),
+                             np.cos(theta) * np.cos(qaz)))              # (18)
+    n_lab = np.column_stack((np.cos(alpha) * np.sin(naz), -np.sin(alpha),
+                             np.cos(alpha) * np.cos(naz)))              # (20)
+    N_lab, bad = _calc_N(q_lab, n_lab)
+    okay &= ~bad
+    N_phi, bad = _calc_N(h_phi, np.tile(n_phi, (len(hkl), 1)))
+    okay &= ~bad
+
+    mu, eta, chi, phi, bad = _calc_remaining_sample_angles(
+        samp_name, samp_value, N_lab, N_phi)
+    okay &= ~bad
+
+    possible = _possible_solutions(
+        limits, [mu, eta, chi, phi], ['mu', 'eta', 'chi', 'phi'],
+        (samp_name,))
+    if possible is None:
+        return None
+    (mus, etas, chis, phis), generated = possible
+
+    # _filter_valid_sample_solutions
+    UBinv = np.array(hklcalc._getUBMatrixInverse(), dtype=float)
+    deltas = delta[:, np.newaxis]
+    nus = nu[:, np.newaxis]
+    hkl_ = _angles_to_hkl(mus, deltas, nus, etas, chis, phis,
+                          wavelengths[:, np.newaxis, np.newaxis],
+                          UBinv)
+    valid = generated.copy()
+    for i in range(3):
+        valid &= is_small(hkl[:, i][:, np.newaxis] - hkl_[..., i])
+    virtual, unbounded = _angles_to_virtual_angles(
+        mus, deltas, nus, etas, chis, phis, n_phi)
+    # (the scalar code warns about any undefined psi it comes across)
+    okay &= ~(valid & (unbounded | np.isnan(virtual['psi']))).any(axis=1)
+    if ref_name == 'a_eq_b':
+        valid &= is_small(virtual['alpha'] - virtual['beta'])
+    else:
+        valid &= is_small(np.reshape(ref_value, (-1, 1)) -
+                          virtual[ref_name])
+
+    # _choose_sample_solution
+    distance = (np.abs(mus) + np.abs(etas)) + np.abs(chis) + np.abs(phis)
+    distance[~valid] = np.inf
+    index = distance.argmin(axis=1)
+    okay &= valid.any(axis=1)
+    rows = np.arange(len(hkl))
+    mu = mus[rows, index]
+    eta = etas[rows, index]
+    chi = chis[rows, index]
+    phi = phis[rows, index]
+
+    ### Position and pseudo angles ###
+
+    tidy_mu, tidy_eta, tidy_phi = _tidy_degenerate_solutions(
+        constraints, mu, delta, nu, eta, chi, phi)
+    tidy_phi = np.where(tidy_phi <= -np.pi + SMALL, tidy_phi + 2 * np.pi,
+                        tidy_phi)
+    # The chosen solution was within limits; keep it so if tidying it would
+    # move it out
+    tidy = _position_within_limits(limits, tidy_mu, delta, nu, tidy_eta, chi,
+                                   tidy_phi)
+    mu = np.where(tidy, tidy_mu, mu)
+    eta = np.where(tidy, tidy_eta, eta)
+    phi = np.where(tidy, tidy_phi, phi)
+
+    virtual, unbounded = _angles_to_virtual_angles(
+        mu, delta, nu, eta, chi, phi, n_phi)
+    okay &= ~unbounded & ~np.isnan(virtual['psi'])
+
+    pos = np.column_stack((mu, delta, nu, eta, chi, phi)) * TODEG
+    virtual = np.column_stack(
+        [virtual[name] for name in VIRTUAL_ANGLE_NAMES]) * TODEG
+
+    # _verify_pos_map_to_hkl or _verify_q_residual (from the position in
+    # degrees)
+    if verify is None:
+        verify = _rows_to_verify(hklcalc, len(hkl))
+    if cheap is None:
+        cheap = hklcalc.verification == VERIFY_CHEAP
+    pos_rad = pos[verify] * TORAD
+    mapped = np.ones(len(hkl), dtype=bool)
+    if cheap:
+        mu_, delta_, nu_, eta_, chi_, phi_ = pos_rad.T
+        residual = (_apply(sample_rotations(mu_, eta_, chi_, phi_),
+                           h_phi[verify]) -
+                    _q_lab(delta_, nu_, wavelengths[verify][:, np.newaxis]))
+        mapped[verify] = ~(np.sqrt((residual ** 2).sum(axis=1)) >
+                           q_tolerance(UBinv, .001))
+    else:
+        hkl_ = _angles_to_hkl(*(list(pos_rad.T) +
+                                [wavelengths[verify][:, np.newaxis], UBinv]))
+        for i in range(3):
+            mapped[verify] &= ~(np.abs(hkl_[:, i] - hkl[verify, i]) > .001)
+    okay &= mapped
+
+    okay &= np.isfinite(pos).all(axis=1)
+    return okay, pos, virtual
+
+
+def _normalised(v):
+    return v * (1 / np.sqrt((v ** 2).sum(axis=1)))[:, np.newaxis]
+
+
+def _calc_N(Q, n):
+    """Vectorised _calc_N. Return N*3*3 matrices and a mask of rows for which
+    Q and n are parallel"""
+    Q = _normalised(Q)
+    n = _normalised(n)
+    cos_angle, parallel = _bound((Q * n).sum(axis=1))
+    parallel |= is_small(np.arccos(cos_angle))
+    Qxn = np.cross(Q, n)
+    QxnxQ = _normalised(np.cross(Qxn, Q))
+    Qxn = _normalised(Qxn)
+    return np.stack((Q, QxnxQ, Qxn), axis=2), parallel
+
+
+def _calc_remaining_sample_angles(name, value, N_lab, N_phi):
+    """Vectorised YouHklCalculator._calc_remaining_sample_angles. Return mu,
+    eta, chi and phi arrays and a mask of rows that the scalar code would
+    raise an exception for"""
+    n = len(N_lab)
+    fixed = np.empty(n)
+    fixed.fill(value)
+    bad = np.zeros(n, dtype=bool)
+    N_phi_T = N_phi.transpose(0, 2, 1)
+
+    if name == 'mu':                                                   # (35)
+        mu = fixed
+        V = np.matmul(N_lab, N_phi_T)
+        V = np.matmul(transposed(x_rotations(mu)), V)  # MU.I * V
+        phi = np.arctan2(V[:, 2, 1], V[:, 2, 0])
+        eta = np.arctan2(-V[:, 1, 2], V[:, 0, 2])
+        chi = np.arctan2(np.sqrt(V[:, 2, 0] ** 2 + V[:, 2, 1] ** 2),
+                         V[:, 2, 2])
+        degenerate = is_small(np.sin(chi))
+        eta = np.where(degenerate, 0, eta)
+        phi = np.where(degenerate, np.arctan2(V[:, 0, 1], V[:, 0, 0]), phi)
+        return mu, eta, chi, phi, bad
+
+    if name == 'phi':                                                  # (37)
+        phi = fixed
+        V = np.matmul(N_lab, np.linalg.inv(N_phi))
+        V = np.matmul(V, z_rotations(phi))  # V * PHI.T
+        eta = np.arctan2(V[:, 0, 1], np.sqrt(V[:, 1, 1] ** 2 +
+                                             V[:, 2, 1] ** 2))
+        mu = np.arctan2(V[:, 2, 1], V[:, 1, 1])
+        chi = np.arctan2(V[:, 0, 2], V[:, 0, 0])
+        bad |= is_small(np.cos(eta))
+        return mu, eta, chi, phi, bad
+
+    V = np.matmul(N_lab, N_phi_T)
+    if name == 'eta':                                                  # (39)
+        eta = fixed
+        cos_eta = np.cos(eta)
+        bad |= is_small(cos_eta)
+        sin_chi = V[:, 0, 2] / cos_eta
+        bad |= ~(np.abs(sin_chi) <= 1)
+        chi = np.arcsin(sin_chi)
+    else:  # name == 'chi'                                             # (40)
+        chi = fixed
+        sin_chi = np.sin(chi)
+        bad |= is_small(sin_chi)
+        cos_eta = V[:, 0, 2] / sin_chi
+        bad |= ~(np.abs(cos_eta) <= 1)
+        eta = np.arccos(cos_eta)
+
+    top_for_mu = (V[:, 2, 2] * np.sin(eta) * np.sin(chi) +
+                  V[:, 1, 2] * np.cos(chi))
+    bot_for_mu = (-V[:, 2, 2] * np.cos(chi) +
+                  V[:, 1, 2] * np.sin(eta) * np.sin(chi))
+    mu = np.arctan2(-top_for_mu, -bot_for_mu)                          # (41)
+    top_for_phi = (V[:, 0, 1] * np.cos(eta) * np.cos(chi) -
+                   V[:, 0, 0] * np.sin(eta))
+    bot_for_phi = (V[:, 0, 1] * np.sin(eta) +
+                   V[:, 0, 0] * np.cos(eta) * np.cos(chi))
+    phi = np.arctan2(top_for_phi, bot_for_phi)                         # (42)
+    return mu, eta, chi, phi, bad
+
+
+def _tidy_degenerate_solutions(constraints, mu, delta, nu, eta, chi, phi):
+    """Vectorised _tidy_degenerate_solutions. Return mu, eta and phi"""
+    detector_like_constraint = bool(constraints.detector or constraints.naz)
+    sample = constraints.sample
+    nu_constrained_to_0 = is_small(nu) & detector_like_constraint
+    mu_constrained_to_0 = is_small(mu) & ('mu' in sample)
+    delta_constrained_to_0 = is_small(delta) & detector_like_constraint
+    eta_constrained_to_0 = is_small(eta) & ('eta' in sample)
+
+    # constrained to vertical 4-circle like mode with phi || eta
+    vertical = nu_constrained_to_0 & mu_constrained_to_0
+    eta_diff = np.where(vertical & is_small(chi), delta / 2. - eta, 0)
+    # constrained to horizontal 4-circle like mode with phi || mu
+    horizontal = (~vertical & delta_constrained_to_0 & eta_constrained_to_0 &
+                  is_small(chi - np.pi / 2))
+    mu_diff = np.where(horizontal, nu / 2. - mu, 0)
+
+    return mu + mu_diff, eta + eta_diff, phi - eta_diff + mu_diff
@@ -26,15 +26,32 @@ except ImportError:
     from numjy.linalg import norm
 
 from diffcalc.log import logging
-from diffcalc.hkl.calcbase import HklCalculatorBase
-from diffcalc.hkl.you.geometry import create_you_matrices, calcMU, calcPHI, \
-    calcCHI
+from diffcalc.hkl.calcbase import HklCalculatorBase, hkl_jacobian_rows, \
+    scale_derivatives, combine_derivatives, q_tolerance, VERIFY_CHEAP, \
+    VERIFY_OFF
+from diffcalc.hkl.you.geometry import calcMU, calcPHI, calcCHI
 from diffcalc.hkl.you.geometry import YouPosition
 from diffcalc.util import DiffcalcException, bound, angle_between_vectors
-from diffcalc.util import cross3, z_rotation, x_rotation
+from diffcalc.util import cross3, z_rotation, x_rotation, LRUCache, \
+    timed
+from diffcalc.rotations import you_sample_rotation, \
+    you_sample_rotation_inverse, you_q_lab, column, you_sample_rows, \
+    you_sample_rows_derivatives, you_q_lab_derivatives, rows_times
 from diffcalc.ub.calc import PaperSpecificUbCalcStrategy
 
-from diffcalc.hkl.you.constraints import NUNAME
+from diffcalc.hkl.you.constraints import NUNAME, ONE_SAMPLE, \
+    TWO_SAMPLE_AND_REFERENCE, THREE_SAMPLE, NUMERICAL, all_constraints, \
+    YouConstraintManager
+from diffcalc.hkl.you.numerical import YouEquations, \
+    LevenbergMarquardtSolver, ANGLE_INDICES
+from diffcalc.hardware import cut_angle_at
+from diffcalc.hkl.you.transform import YouTransformSelector
+
+try:
+    from diffcalc.hkl.you import batch
+except ImportError:
+    batch = None  # requires numpy
+
 logger = logging.getLogger("diffcalc.hkl.you.calc")
 I = matrix('1 0 0; 0 1 0; 0 0 1')
 y = matrix('0; 1; 0')
@@ -45,6 +62,16 @@ TODEG = 180 / pi
 
 PRINT_DEGENERATE = False
 
+# When tracking, a sample angle jumping further than this between consecutive
+# calculations is reported as a switch to another solution branch
+BRANCH_SWITCH_ANGLE = 90 * TORAD
+
+VIRTUAL_ANGLE_NAMES = ('theta', 'qaz', 'alpha', 'naz', 'tau', 'psi', 'beta')
+# Those depending on the detector angles only, and those requiring tau
+_DETECTOR_VIRTUAL_ANGLE_NAMES = frozenset(('theta', 'qaz'))
+_TAU_VIRTUAL_ANGLE_NAMES = frozenset(('tau', 'psi', 'beta'))
+_NO_PSI_NAMES = ('theta', 'qaz', 'alpha', 'naz', 'tau', 'beta')
+
 
 def is_small(x):
     return abs(x) < SMALL
@@ -97,6 +124,21 @@ def merge_nearly_equal_pairs(delta_nu_pairs):
     return merged
 
 
+def _merge_nearly_equal_solutions(solutions):
+    """Return solutions without those nearly equal, modulo 2pi, to one
+    earlier in the list"""
+    merged = []
+    for solution in solutions:
+        for other in merged:
+            if sequence_ne([cut_at_minus_pi(a - b)
+                            for a, b in zip(solution, other)],
+                           [0] * len(solution)):
+                break
+        else:
+            merged.append(solution)
+    return merged
+
+
 def _calc_N(Q, n):
     """Return N as described by Equation 31"""
     Q = normalised(Q)
@@ -125,15 +167,18 @@ def _calc_angle_between_naz_and_qaz(theta, alpha, tau):
     return acos(bound(top / bottom))
 
 
-def youAnglesToHkl(pos, wavelength, UBmatrix):
-    """Calculate miller indices from position in radians.
+def youAnglesToHkl(pos, wavelength, UBmatrix, UBinv=None):
+    """Calculate miller indices from position in radians. UBinv is the
+    inverse of UBmatrix if already known.
     """
 
-    [MU, DELTA, NU, ETA, CHI, PHI] = create_you_matrices(*pos.totuple())
+    mu, delta, nu, eta, chi, phi = pos.totuple()
 
-    q_lab = (NU * DELTA - I) * matrix([[0], [2 * pi / wavelength], [0]])   # 12
+    q_lab = column(you_q_lab(delta, nu)) * (2 * pi / wavelength)         # 12
 
-    hkl = UBmatrix.I * PHI.I * CHI.I * ETA.I * MU.I * q_lab
+    if UBinv is None:
+        UBinv = UBmatrix.I
+    hkl = UBinv * you_sample_rotation_inverse(mu, eta, chi, phi) * q_lab
 
     return hkl[0, 0], hkl[1, 0], hkl[2, 0]
 
@@ -187,6 +232,10 @@ def _theta_and_qaz_from_detector_angles(delta, nu):
     return theta, qaz
 
 
+def _filter_names(angles, names):
+    return dict((name, angles[name]) for name in angles if name in names)
+
+
 def _filter_detector_solutions_by_theta_and_qaz(possible_delta_nu_pairs,
                                                 required_theta, required_qaz):
     delta_nu_pairs = []
@@ -217,11 +266,11 @@ class YouUbCalcStrategy(PaperSpecificUbCalcStrategy):
 
     def calculate_q_phi(self, pos):
 
-        [MU, DELTA, NU, ETA, CHI, PHI] = create_you_matrices(*pos.totuple())
+        mu, delta, nu, eta, chi, phi = pos.totuple()
         # Equation 12: Compute the momentum transfer vector in the lab  frame
-        q_lab = (NU * DELTA - I) * y
+        q_lab = column(you_q_lab(delta, nu))
         # Transform this into the phi frame.
-        return PHI.I * CHI.I * ETA.I * MU.I * q_lab
+        return you_sample_rotation_inverse(mu, eta, chi, phi) * q_lab
 
 
 UNREACHABLE_MSG = (
@@ -229,6 +278,71 @@ UNREACHABLE_MSG = (
     'prohibits a solution for the specified reflection.')
 
 
+class SolverStatistics(object):
+    """Counts of the work done by YouHklCalculator, for the last call, in
+    total and for each mode (combination of constraint names).
+
+    calls: hkl to angles calculations started
+    detector_pairs: candidate delta, nu pairs generated
+    sample_tuples: candidate mu, eta, chi, phi tuples generated
+    sample_rejected: candidate sample tuples rejected as not reaching hkl or
+        not matching the reference constraint
+    verifications: positions mapped back to hkl to verify them
+    tidy_ups: positions changed to tidy a degenerate solution
+    exceptions: calculations failing with an exception
+    """
+
+    COUNTERS = ('calls', 'detector_pairs', 'sample_tuples', 'sample_rejected',
+                'verifications', 'tidy_ups', 'exceptions')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.last_call = dict.fromkeys(self.COUNTERS, 0)
+        self.total = dict.fromkeys(self.COUNTERS, 0)
+        self.modes = {}
+        self._mode_counts = None
+
+    def start_call(self, plan):
+        """Start counting a calculation made with ModePlan plan"""
+        mode = ' '.join(name for name in all_constraints if name in plan.all)
+        self.last_call = dict.fromkeys(self.COUNTERS, 0)
+        if mode not in self.modes:
+            self.modes[mode] = dict.fromkeys(self.COUNTERS, 0)
+        self._mode_counts = self.modes[mode]
+        self.add('calls')
+
+    def add(self, counter, n=1):
+        self.last_call[counter] += n
+        self.total[counter] += n
+        if self._mode_counts is not None:
+            self._mode_counts[counter] += n
+
+    def snapshot(self):
+        """Return a copy of the counts as a dictionary with 'last_call',
+        'total' and 'modes' entries"""
+        return {'last_call': self.last_call.copy(),
+                'total': self.total.copy(),
+                'modes': dict((mode, counts.copy())
+                              for mode, counts in self.modes.items())}
+
+    def __str__(self):
+        rows = [('',) + self.COUNTERS]
+        for name, counts in ([('last call', self.last_call),
+                              ('total', self.total)] +
+                             sorted(self.modes.items())):
+            rows.append((name,) + tuple(str(counts[counter])
+                                        for counter in self.COUNTERS))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+        return '\n'.join(
+            '  '.join([row[0].ljust(widths[0])] +
+                      [cell.rjust(width)
+                       for cell, width in zip(row[1:], widths[1:])])
+            for row in rows)
+
+
 class YouHklCalculator(HklCalculatorBase):
 
     def __init__(self, ubcalc, geometry, hardware, constraints,
@@ -238,9 +352,38 @@ class YouHklCalculator(HklCalculatorBase):
         self._hardware = hardware  # for checking limits only
         self.constraints = constraints
         self.parameter_manager = constraints  # TODO: remove need for this attr
+        self.cache = LRUCache(0)  # hklToAngles results, disabled by default
+        self._cache_context = None
+        self._limits = None  # (hardware limits_version, axis limits table)
+        self.tracking = False
+        self.branch_switches = 0
+        self._reference = None  # mu, eta, chi, phi (rad) to stay close to
+        # for constraint combinations with no analytic solution
+        self.numerical_solver = LevenbergMarquardtSolver()
+        self._last_numerical_solution = None
+        # chooses between equivalent positions (sectors)
+        self.transform_selector = YouTransformSelector()
+        self.statistics = SolverStatistics()
 
     def __str__(self):
-        return self.constraints.__str__()
+        return self.constraints.__str__() + '\n' + self.repr_verification()
+
+    def _scratch_calculator(self, constrained):
+        """Return a calculator constrained by the dictionary constrained
+        (values in radians) that shares this one's UB calculation, geometry,
+        hardware and verification and sector settings, but has its own
+        constraints, cache, statistics and tracking state. Calculating in
+        other modes with it leaves this calculator untouched, even while
+        another thread is using it."""
+        constraints = YouConstraintManager(self._hardware)
+        constraints._constrained = dict(constrained)
+        calc = YouHklCalculator(self._ubcalc, self._geometry, self._hardware,
+                                constraints,
+                                self.raiseExceptionsIfAnglesDoNotMapBackToHkl)
+        calc.verification = self.verification
+        calc.verification_interval = self.verification_interval
+        calc.transform_selector.sector = self.transform_selector.sector
+        return calc
 
     def _get_n_phi(self):
         return self._ubcalc.n_phi
@@ -254,30 +397,41 @@ class YouHklCalculator(HklCalculatorBase):
     def _anglesToHkl(self, pos, wavelength):
         """Calculate miller indices from position in radians.
         """
-        return youAnglesToHkl(pos, wavelength, self._get_ubmatrix())
+        return youAnglesToHkl(pos, wavelength, self._get_ubmatrix(),
+                              self._getUBMatrixInverse())
 
-    def _anglesToVirtualAngles(self, pos, _wavelength):
+    def _anglesToVirtualAngles(self, pos, _wavelength, names=None):
         """Calculate pseudo-angles in radians from position in radians.
 
-        Return theta, qaz, alpha, naz, tau, psi and beta in a dictionary.
-
+        Return theta, qaz, alpha, naz, tau, psi and beta in a dictionary, or
+        only those in names if given. Angles not needed for those requested
+        are not calculated.
         """
+        if names is None:
+            names = VIRTUAL_ANGLE_NAMES
+        names = set(names)
 
         # depends on surface normal n_lab.
         mu, delta, nu, eta, chi, phi = pos.totuple()
 
         theta, qaz = _theta_and_qaz_from_detector_angles(delta, nu)      # (19)
+        angles = {'theta': theta, 'qaz': qaz}
+        if not names - _DETECTOR_VIRTUAL_ANGLE_NAMES:
+            return _filter_names(angles, names)
 
-        [MU, _, _, ETA, CHI, PHI] = create_you_matrices(mu,
-                                           delta, nu, eta, chi, phi)
-        Z = MU * ETA * CHI * PHI
+        Z = you_sample_rotation(mu, eta, chi, phi)
         n_lab = Z * self._get_n_phi()
         alpha = asin(bound((-n_lab[1, 0])))
         naz = atan2(n_lab[0, 0], n_lab[2, 0])                            # (20)
+        angles['alpha'] = alpha
+        angles['naz'] = naz
+        if not names & _TAU_VIRTUAL_ANGLE_NAMES:
+            return _filter_names(angles, names)
 
         cos_tau = cos(alpha) * cos(theta) * cos(naz - qaz) + \
                   sin(alpha) * sin(theta)
         tau = acos(bound(cos_tau))                                       # (23)
+        angles['tau'] = tau
 
         # Compute Tau using the dot product directly (THIS ALSO WORKS)
 #        q_lab = ( (NU * DELTA - I ) * matrix([[0],[1],[0]])
@@ -285,9 +439,109 @@ class YouHklCalculator(HklCalculatorBase):
 #        q_lab = matrix([[1],[0],[0]]) if norm == 0 else q_lab * (1/norm)
 #        tau_from_dot_product = acos(bound(dot3(q_lab, n_lab)))
 
-        sin_beta = 2 * sin(theta) * cos(tau) - sin(alpha)
-        beta = asin(bound(sin_beta))                                     # (24)
-
+        if 'beta' in names:
+            sin_beta = 2 * sin(theta) * cos(tau) - sin(alpha)
+            angles['beta'] = asin(bound(sin_beta))                       # (24)
+        if 'psi' in names:
+            angles['psi'] = self._calc_psi(alpha, theta, tau)
+        return _filter_names(angles, names)
+
+    def _anglesToHklJacobian(self, angles, wavelength, sin=sin, cos=cos):
+        """Return the rows of d(h, k, l)/d(mu, delta, nu, eta, chi, phi) per
+        radian from the angles in radians.
+        """
+        mu, delta, nu, eta, chi, phi = angles
+        d_mu, d_eta, d_chi, d_phi = you_sample_rows_derivatives(
+            mu, eta, chi, phi, sin, cos)
+        d_delta, d_nu = you_q_lab_derivatives(delta, nu, sin, cos)
+        return hkl_jacobian_rows(
+            self._getUBMatrixInverse(),
+            you_sample_rows(mu, eta, chi, phi, sin, cos),
+            you_q_lab(delta, nu, sin, cos),
+            ((d_mu, None), (None, d_delta), (None, d_nu), (d_eta, None),
+             (d_chi, None), (d_phi, None)),
+            2 * pi / wavelength)
+
+    def _anglesToVirtualAnglesJacobian(self, angles, wavelength, names=None):
+        """Return d(virtual angle)/d(mu, delta, nu, eta, chi, phi) from the
+        angles in radians.
+
+        Return tuples for theta, qaz, alpha, naz, tau, psi and beta in a
+        dictionary, or for only those in names if given. These are the
+        derivatives of the expressions used in _anglesToVirtualAngles.
+        """
+        return self._anglesToVirtualAnglesAndJacobian(angles, wavelength,
+                                                      names)[1]
+
+    def _anglesToVirtualAnglesAndJacobian(self, angles, wavelength,
+                                          names=None):
+        """Return dictionaries of the virtual angles in radians and of their
+        derivatives, as _anglesToVirtualAngles and
+        _anglesToVirtualAnglesJacobian but sharing the work."""
+        if names is None:
+            names = VIRTUAL_ANGLE_NAMES
+        v = self._anglesToVirtualAngles(
+            YouPosition(*angles), wavelength,
+            VIRTUAL_ANGLE_NAMES if 'psi' in names else _NO_PSI_NAMES)
+        mu, delta, nu, eta, chi, phi = angles
+        sd, cd, sn, cn = sin(delta), cos(delta), sin(nu), cos(nu)
+
+        # Equation 19, including the flip of qaz for delta > 90
+        d_theta = scale_derivatives((0., -sd * cn, -cd * sn, 0., 0., 0.),
+                                    -.5, sin(2 * v['theta']))
+        d_qaz = scale_derivatives((0., sn, -sd * cd * cn, 0., 0., 0.),
+                                  -1. if delta > pi / 2 else 1.,
+                                  sd * sd + cd * cd * sn * sn)
+
+        # Equation 20, from n_lab = Z * n_phi
+        n_phi = [self._get_n_phi()[i, 0] for i in range(3)]
+        n_lab = rows_times(you_sample_rows(mu, eta, chi, phi), n_phi)
+        d_mu, d_eta, d_chi, d_phi = [
+            rows_times(d, n_phi) for d in
+            you_sample_rows_derivatives(mu, eta, chi, phi)]
+        dn = [(d_mu[i], 0., 0., d_eta[i], d_chi[i], d_phi[i])
+              for i in range(3)]
+        d_alpha = scale_derivatives(dn[1], -1., cos(v['alpha']))
+        d_naz = scale_derivatives(
+            combine_derivatives((n_lab[2], dn[0]), (-n_lab[0], dn[2])),
+            1., n_lab[0] ** 2 + n_lab[2] ** 2)
+
+        # Equation 23
+        sin_theta, cos_theta = sin(v['theta']), cos(v['theta'])
+        sin_alpha, cos_alpha = sin(v['alpha']), cos(v['alpha'])
+        sin_tau, cos_tau = sin(v['tau']), cos(v['tau'])
+        angle = v['naz'] - v['qaz']
+        d_cos_tau = combine_derivatives(
+            (cos_alpha * sin_theta - sin_alpha * cos_theta * cos(angle),
+             d_alpha),
+            (sin_alpha * cos_theta - cos_alpha * sin_theta * cos(angle),
+             d_theta),
+            (-cos_alpha * cos_theta * sin(angle), d_naz),
+            (cos_alpha * cos_theta * sin(angle), d_qaz))
+        d_tau = scale_derivatives(d_cos_tau, -1., sin_tau)
+        jacobian = {'theta': d_theta, 'qaz': d_qaz, 'alpha': d_alpha,
+                    'naz': d_naz, 'tau': d_tau}
+
+        # Equation 24
+        if 'beta' in names:
+            jacobian['beta'] = scale_derivatives(combine_derivatives(
+                (2 * cos_theta * cos_tau, d_theta),
+                (-2 * sin_theta * sin_tau, d_tau),
+                (-cos_alpha, d_alpha)), 1., cos(v['beta']))
+
+        # Equation 28
+        if 'psi' in names:
+            cos_psi = cos(v['psi'])
+            d_cos_psi = scale_derivatives(combine_derivatives(
+                (-sin_tau * sin_theta - cos_psi * cos_tau * cos_theta, d_tau),
+                (cos_tau * cos_theta + cos_psi * sin_tau * sin_theta,
+                 d_theta),
+                (-cos_alpha, d_alpha)), 1., sin_tau * cos_theta)
+            jacobian['psi'] = scale_derivatives(d_cos_psi, -1.,
+                                                sin(v['psi']))
+        return _filter_names(v, names), _filter_names(jacobian, names)
+
+    def _calc_psi(self, alpha, theta, tau):
         sin_tau = sin(tau)
         cos_theta = cos(theta)
         if sin_tau == 0:
@@ -304,18 +558,18 @@ class YouHklCalculator(HklCalculatorBase):
             cos_psi = ((cos(tau) * sin(theta) - sin(alpha)) /
                        (sin_tau * cos_theta))
             psi = acos(bound(cos_psi))                                   # (28)
+        return psi
 
-        return {'theta': theta, 'qaz': qaz, 'alpha': alpha,
-                'naz': naz, 'tau': tau, 'psi': psi, 'beta': beta}
 
-
-    def hklToAngles(self, h, k, l, wavelength):
+    def hklToAngles(self, h, k, l, wavelength, verification=None):
         """
         Return verified Position and all virtual angles in degrees from
         h, k & l and wavelength in Angstroms.
 
         The calculated Position is verified by checking that it maps back using
-        anglesToHkl() to the requested hkl value.
+        anglesToHkl() to the requested hkl value. With the 'cheap' policy its
+        scattering vector is instead compared with UB * hkl, which skips
+        inverting the sample rotation and converting back to hkl.
 
         Those virtual angles fixed or generated while calculating the position
         are verified by by checking that they map back using
@@ -323,10 +577,104 @@ class YouHklCalculator(HklCalculatorBase):
 
         Throws a DiffcalcException if either check fails and
         raiseExceptionsIfAnglesDoNotMapBackToHkl is True, otherwise displays a
-        warning.
+        warning. verification, VERIFY_ALWAYS, VERIFY_CHEAP or VERIFY_OFF,
+        overrides the verification policy for this calculation only.
+
+        If self.cache has a non-zero maxsize, results are remembered and
+        returned again for repeated requests made in the same context (see
+        _check_cache_context).
+
+        When tracking (see set_tracking) or given a reference position (see
+        set_reference_position), the sample solution closest to the reference
+        is returned instead of that closest to all zeros, and the cache is
+        not used. The selected sector (see transform_selector) is then not
+        applied, except to the first point tracked without a reference: the
+        reference already picks between the equivalent branches.
         """
+        if self.tracking or self._reference is not None:
+            return self._tracked_hkl_to_angles(h, k, l, wavelength,
+                                               verification)
+        if self.cache.maxsize:
+            self._check_cache_context()
+            key = (h, k, l, wavelength)
+            cached = self.cache.get(key)
+            if cached is not None:
+                pos, virtual_angles = cached
+                return pos.clone(), virtual_angles.copy()
+            pos, virtual_angles = self._uncached_hkl_to_angles(
+                h, k, l, wavelength, verification)
+            self.cache.put(key, (pos.clone(), virtual_angles.copy()))
+            return pos, virtual_angles
+        return self._uncached_hkl_to_angles(h, k, l, wavelength, verification)
+
+    def set_tracking(self, tracking):
+        """Enable or disable tracking. When tracking, each calculation starts
+        from the branch of the last position calculated, so that consecutive
+        positions in a scan do not flip between equivalent solutions."""
+        self.tracking = bool(tracking)
+        self.branch_switches = 0
+        self._reference = None
+
+    def set_reference_position(self, pos):
+        """Solve the next hklToAngles calculation close to YouPosition pos in
+        degrees, e.g. the current diffractometer position. When tracking,
+        following calculations continue from the solution found."""
+        self._reference = tuple(v * TORAD for v in
+                                (pos.mu, pos.eta, pos.chi, pos.phi))
+
+    def _tracked_hkl_to_angles(self, h, k, l, wavelength, verification=None):
+        reference = self._reference
+        try:
+            pos, virtual_angles = self._uncached_hkl_to_angles(
+                h, k, l, wavelength, verification)
+        finally:
+            if not self.tracking:
+                self._reference = None  # a seed is used only once
+        if (self.tracking and reference is not None and
+                self._is_branch_switch(pos)):
+            self.branch_switches += 1
+            print ('WARNING: hkl=(%f,%f,%f) could not be reached on the branch '
+                   'continuing from the previous position; switched to %s' %
+                   (h, k, l, pos))
+        if self.tracking:
+            self.set_reference_position(pos)
+        return pos, virtual_angles
+
+    def _distance_from_reference(self, mu_eta_chi_phi):
+        return sum(abs(cut_at_minus_pi(a - b))
+                   for a, b in zip(mu_eta_chi_phi, self._reference))
+
+    def _is_branch_switch(self, pos):
+        """Return True if any sample angle of YouPosition pos (in degrees)
+        has jumped by more than BRANCH_SWITCH_ANGLE from the reference."""
+        for a, b in zip((pos.mu, pos.eta, pos.chi, pos.phi), self._reference):
+            if abs(cut_at_minus_pi(a * TORAD - b)) > BRANCH_SWITCH_ANGLE:
+                return True
+        return False
 
-        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength)  # in rad
+    def set_cache_size(self, maxsize):
+        """Set the number of hklToAngles results remembered; 0 disables"""
+        self.cache.maxsize = maxsize
+        if not maxsize:
+            self.cache.clear()
+            self._cache_context = None
+
+    def _check_cache_context(self):
+        """Clear the cache if the constraints, UB calculation, hardware
+        limits and cuts, or sector selection have changed since it was last
+        used.
+        """
+        context = (tuple(sorted(self.constraints.all.items())),
+                   self._ubcalc.version, self._hardware.limits_version,
+                   self.transform_selector.state())
+        if context != self._cache_context:
+            self.cache.clear()
+            self._cache_context = context
+
+    def _uncached_hkl_to_angles(self, h, k, l, wavelength, verification=None):
+        h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
+        pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength,
+                                                     h_phi=h_phi)  # in rad
         assert len(pos_virtual_angles_pairs) == 1
         pos, virtual_angles = pos_virtual_angles_pairs[0]
             
@@ -335,17 +683,170 @@ class YouHklCalculator(HklCalculatorBase):
         for key, val in virtual_angles.items():
             if val is not None:
                 virtual_angles[key] = val * TODEG
-
-        self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
+        # A reference (when tracking or seeded) has already chosen the branch
+        # closest to it; flipping that into the selected sector would send
+        # each tracked point to the other branch from the last
+        if self._reference is None:
+            pos = self.transform_selector.transform_position(
+                pos, self._get_axis_limits(), self.constrained_angle_names())
+
+        if verification is None:
+            verification = self._verification_due()
+        self._counted_verify_pos_map_to_hkl(h, k, l, wavelength, pos,
+                                            verification, h_phi)
 
         return pos, virtual_angles
 
+    def _counted_verify_pos_map_to_hkl(self, h, k, l, wavelength, pos,
+                                       verification, h_phi):
+        if verification != VERIFY_OFF:
+            self.statistics.add('verifications')
+        try:
+            if verification == VERIFY_CHEAP:
+                self._verify_q_residual(h, k, l, wavelength, pos, h_phi)
+            else:
+                self._verify_pos_map_to_hkl(h, k, l, wavelength, pos,
+                                            verification)
+        except DiffcalcException:
+            self.statistics.add('exceptions')
+            raise
+
+    @timed('verify.hkl')
+    def _verify_q_residual(self, h, k, l, wavelength, pos, h_phi):
+        """Check that Position pos in degrees scatters along Z * h_phi, with
+        h_phi = UB * hkl as used by the solver. Unlike mapping pos back to
+        hkl this needs no matrices: the rows of Z and q_lab are calculated
+        directly from the angles."""
+        mu, delta, nu, eta, chi, phi = pos.inRadians().totuple()
+        q_phi = (h_phi[0, 0], h_phi[1, 0], h_phi[2, 0])
+        q_sample = rows_times(you_sample_rows(mu, eta, chi, phi), q_phi)
+        wavevector = 2 * pi / wavelength
+        residual = sqrt(sum((a - b * wavevector) ** 2 for a, b in
+                            zip(q_sample, you_q_lab(delta, nu))))
+        if residual > q_tolerance(self._getUBMatrixInverse(), .001):
+            s = ("ERROR: The angles calculated for hkl=(%f,%f,%f) were %s.\n"
+                 % (h, k, l, str(pos)))
+            s += ("Their scattering vector is %f 1/Angstrom from that of this "
+                  "hkl" % residual)
+            if self.raiseExceptionsIfAnglesDoNotMapBackToHkl:
+                raise DiffcalcException(s)
+            else:
+                print s
+
+    def constrained_angle_names(self):
+        """Return the names of the angles fixed by the current constraints,
+        which equivalent positions must leave unchanged"""
+        names = list(self.constraints.all)
+        if 'mu_is_' + NUNAME in names:
+            names += ['mu', NUNAME]
+        return tuple(names)
+
+    def angles_to_hkl_batch(self, positions, wavelength):
+        """
+        Return an N*3 array of hkl values and an N*7 array of virtual angles
+        in degrees from an N*6 array of positions in degrees (ordered mu,
+        delta, nu, eta, chi, phi) and wavelength in Angstroms.
+
+        The array version of anglesToHkl. Virtual angles are ordered as
+        batch.VIRTUAL_ANGLE_NAMES. Requires numpy.
+        """
+        if batch is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        hkl = batch.angles_to_hkl_batch(positions, wavelength,
+                                        self._get_ubmatrix())
+        virtual_angles = batch.angles_to_virtual_angles_batch(
+            positions, self._get_n_phi())
+        return hkl, virtual_angles
+
+    def hkl_to_angles_batch(self, hkl_array, wavelength, verification=None):
+        """
+        Return positions, virtual angles and status codes for an N*3 array of
+        hkl values and wavelength in Angstroms.
+
+        Positions are returned as an N*6 array ordered mu, delta, nu, eta, chi,
+        phi and virtual angles as an N*7 array ordered as
+        batch.VIRTUAL_ANGLE_NAMES, all in degrees. Each row matches what
+        hklToAngles would return. Rows that could not be calculated are filled
+        with nan and given a non-zero status (batch.STATUS_UNREACHABLE or
+        batch.STATUS_ERROR) rather than raising an exception.
+
+        verification overrides the calculator's verification policy for this
+        call only.
+
+        Requires numpy.
+        """
+        if batch is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        return batch.hkl_to_angles_batch(self, hkl_array, wavelength,
+                                         verification)
+
+    def psi_sweep(self, hkl, psi_array, wavelength):
+        """
+        Return positions, virtual angles, status codes and limit flags for a
+        fixed hkl (a sequence h, k, l) at each of N azimuths psi in degrees,
+        and wavelength in Angstroms.
+
+        The current reference constraint is replaced by psi for the sweep,
+        keeping the detector and sample constraints. Positions, virtual angles
+        and status codes are arrays as returned by hkl_to_angles_batch; the
+        limit flags are an N*6 boolean array marking the angles of each
+        position that are within the hardware limits.
+
+        Requires numpy.
+        """
+        if batch is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        return batch.psi_sweep(self, hkl, psi_array, wavelength)
+
+    def reachable_psi_intervals(self, hkl, wavelength, step=1.,
+                                tolerance=1e-3):
+        """
+        Return a list of (start, end) pairs of psi in degrees between which a
+        fixed hkl (a sequence h, k, l) at wavelength in Angstroms can be
+        reached within the hardware limits.
+
+        psi replaces the current reference constraint as for psi_sweep and is
+        measured about the current reference vector. Intervals are found by
+        sampling every step degrees and refining their ends to within
+        tolerance degrees.
+
+        Requires numpy.
+        """
+        if batch is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        return batch.reachable_psi_intervals(self, hkl, wavelength, step,
+                                             tolerance)
+
+    def hkl_to_angles_vs_wavelength(self, hkl, wavelengths):
+        """
+        Return positions, virtual angles and status codes for a fixed hkl (a
+        sequence h, k, l) at each of N wavelengths in Angstroms, e.g. for an
+        energy scan at constant hkl.
+
+        The work that does not depend on the wavelength is done once and the
+        rest for all wavelengths together. Arrays are as returned by
+        hkl_to_angles_batch.
+
+        Requires numpy.
+        """
+        if batch is None:
+            raise DiffcalcException(
+                'Batch calculations require numpy, which is not available')
+        return batch.hkl_to_angles_vs_wavelength(self, hkl, wavelengths)
+
     def hkl_to_all_angles(self, h, k, l, wavelength):
+        h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
         pos_virtual_angles_pairs = self._hklToAngles(h, k, l, wavelength,
-                                                     return_all_solutions=True)  # in rad
+                                                     return_all_solutions=True,
+                                                     h_phi=h_phi)  # in rad
         assert pos_virtual_angles_pairs
         
         pos_virtual_angles_pairs_in_degrees = []
+        verification = self._verification_due()
         
         for pos, virtual_angles in pos_virtual_angles_pairs:
             pos.changeToDegrees()
@@ -353,99 +854,201 @@ class YouHklCalculator(HklCalculatorBase):
                 if val is not None:
                     virtual_angles[key] = val * TODEG
     
-            self._verify_pos_map_to_hkl(h, k, l, wavelength, pos)
+            self._counted_verify_pos_map_to_hkl(h, k, l, wavelength, pos,
+                                                verification, h_phi)
             pos_virtual_angles_pairs_in_degrees.append((pos, virtual_angles))
         return pos_virtual_angles_pairs_in_degrees
         
 
-    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False):
+    def _hklToAngles(self, h, k, l, wavelength, return_all_solutions=False,
+                     h_phi=None):
         """(pos, virtualAngles) = hklToAngles(h, k, l, wavelength) --- with
         Position object pos and the virtual angles returned in degrees. Some
-        modes may not calculate all virtual angles.
+        modes may not calculate all virtual angles. h_phi, UB * hkl, is
+        calculated if not given.
         """
-
-        if not self.constraints.is_fully_constrained():
+        plan = self.constraints.mode_plan
+        self.statistics.start_call(plan)
+        if not plan.fully_constrained:
+            self.statistics.add('exceptions')
             raise DiffcalcException(
                 "Diffcalc is not fully constrained.\n"
                 "Type 'help con' for instructions")
 
-        if not self.constraints.is_current_mode_implemented():
-            raise DiffcalcException(
-                "Sorry, the selected constraint combination is valid but "
-                "is not implemented. Type 'help con' for implemented combinations")
-              
-        # constraints are dictionaries  
-        ref_constraint = self.constraints.reference
-        if ref_constraint:
-            ref_constraint_name, ref_constraint_value = ref_constraint.items()[0]
-        det_constraint = self.constraints.detector
-        naz_constraint = self.constraints.naz
-        samp_constraints = self.constraints.sample
-            
-        assert not (det_constraint and naz_constraint), (
-               "Two 'detector' constraints given")
+        try:
+            if h_phi is None:
+                h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
+            theta = self._calc_theta(h_phi, wavelength)
 
+            solve = getattr(self, self._SOLVERS[plan.kind])
+            solution_tuples = solve(plan, h, k, l, wavelength,
+                                    return_all_solutions, h_phi, theta)
+        except Exception:
+            self.statistics.add('exceptions')
+            raise
 
-        h_phi = self._get_ubmatrix() * matrix([[h], [k], [l]])
-        theta = self._calc_theta(h_phi, wavelength)
+        position_pseudo_angles_pairs = []
+        for mu, delta, nu, eta, chi, phi in solution_tuples:
+            pair = self._create_position_pseudo_angles_pair(
+                wavelength, mu, delta, nu, eta, chi, phi,
+                not return_all_solutions, plan)
+            position_pseudo_angles_pairs.append(pair)
+
+        return position_pseudo_angles_pairs
+
+    # Method solving each kind of ModePlan
+    _SOLVERS = {
+        ONE_SAMPLE: '_calc_angles_given_one_sample_constraint',
+        TWO_SAMPLE_AND_REFERENCE: '_calc_angles_given_two_sample_and_reference',
+        THREE_SAMPLE: '_calc_angles_given_three_sample_constraints',
+        NUMERICAL: '_calc_angles_numerically'}
+
+    def _calc_angles_given_one_sample_constraint(
+            self, plan, h, k, l, wavelength, return_all_solutions, h_phi,
+            theta):
+        """Return the (mu, delta, nu, eta, chi, phi) solution given one
+        reference, one detector (or naz) and one sample constraint"""
         tau = angle_between_vectors(h_phi, self._get_n_phi())
+        ref_constraint_name, ref_constraint_value = plan.reference_constraint
 
         ### Reference constraint column ###
 
-        if ref_constraint:
-            # An angle for the reference vector (n) is given      (Section 5.2)         
-            psi, alpha, _ = self._calc_remaining_reference_angles(
-                ref_constraint_name, ref_constraint_value, theta, tau)
-            # IMPORTNANT: other psi solutions are possibly valid.
-            # TODO: ensure this is handled consistently in all paths below
-            #       currently only handled in 
-            #       self._calc_sample_given_two_sample_and_reference(...)
+        # An angle for the reference vector (n) is given      (Section 5.2)
+        psi, alpha, _ = self._calc_remaining_reference_angles(
+            ref_constraint_name, ref_constraint_value, theta, tau,
+            plan.trig.get(ref_constraint_name))
 
         ### Detector constraint column ###
 
-        if det_constraint or naz_constraint:
-            qaz, naz, delta, nu = self._calc_det_angles_given_det_or_naz_constraint(
-                                  det_constraint, naz_constraint, theta, tau, alpha)
-        
-        ### Sample constraint column ###
-
-        if len(samp_constraints) == 1:
-            # a detector and reference constraint will have been given
-            mu, eta, chi, phi = self._calc_sample_angles_from_one_sample_constraint(
-                h, k, l, wavelength, samp_constraints, h_phi, theta,
-                ref_constraint_name, ref_constraint_value, alpha, qaz, naz,
-                delta, nu)
-            solution_tuples = [(mu, delta, nu, eta, chi, phi)]
-
-        elif len(samp_constraints) == 2:
-            assert ref_constraint, ('No code yet to handle 2 sample '
-                                    'without a reference constraint!')
-            angles = self._calc_sample_given_two_sample_and_reference(
-                h, k, l, wavelength, samp_constraints, h_phi, theta,
-                ref_constraint_name, ref_constraint_value, psi)
-            solution_tuples = [angles]
-
-        elif len(samp_constraints) == 3:
-            solution_tuples = self._calc_angles_given_three_sample_constraints(
-                h, k, l, wavelength, return_all_solutions, samp_constraints,
-                 h_phi, theta)
-            
-        position_pseudo_angles_pairs = []
-        for mu, delta, nu, eta, chi, phi in solution_tuples:
-            pair = self._create_position_pseudo_angles_pair(
-                wavelength, mu, delta, nu, eta, chi, phi)
-            position_pseudo_angles_pairs.append(pair)
-
-        return position_pseudo_angles_pairs
+        qaz, naz, delta, nu = self._calc_det_angles_given_det_or_naz_constraint(
+                              plan.detector, plan.naz, theta, tau, alpha)
 
+        ### Sample constraint column ###
 
+        mu, eta, chi, phi = self._calc_sample_angles_from_one_sample_constraint(
+            h, k, l, wavelength, plan.sample, h_phi, theta,
+            ref_constraint_name, ref_constraint_value, alpha, qaz, naz,
+            delta, nu)
+        return [(mu, delta, nu, eta, chi, phi)]
 
-    def _create_position_pseudo_angles_pair(self, wavelength, mu, delta, nu, eta, chi, phi):
+    def _calc_angles_given_two_sample_and_reference(
+            self, plan, h, k, l, wavelength, return_all_solutions, h_phi,
+            theta):
+        """Return the (mu, delta, nu, eta, chi, phi) solutions given two
+        sample and one reference constraint"""
+        tau = angle_between_vectors(h_phi, self._get_n_phi())
+        ref_constraint_name, ref_constraint_value = plan.reference_constraint
+        psi, _, _ = self._calc_remaining_reference_angles(
+            ref_constraint_name, ref_constraint_value, theta, tau,
+            plan.trig.get(ref_constraint_name))
+        return self._calc_sample_given_two_sample_and_reference(
+            h, k, l, wavelength, plan.sample, h_phi, theta,
+            ref_constraint_name, ref_constraint_value, psi,
+            return_all_solutions)
+
+    @timed('solve.numerical')
+    def _calc_angles_numerically(self, plan, h, k, l, wavelength,
+                                 return_all_solutions, h_phi, theta):
+        """Return (mu, delta, nu, eta, chi, phi) solutions found numerically
+        for constraint combinations with no analytic solution.
+
+        The iteration starts first from the last solution found, so that
+        during scans it converges within a few steps. Only if that fails
+        (or its solution is rejected) are positions spread around the
+        circles tried in turn, which is slow for unreachable hkl as every
+        start must fail. Solutions not matching the constraints, or unless
+        all solutions are requested outside the limits, are rejected.
+        """
+        equations = YouEquations(self, (h, k, l), wavelength, plan.all)
+        solutions = []
+        for x0 in self._numerical_starting_positions(plan, theta):
+            x = self.numerical_solver.solve(equations, x0)
+            if x is None:
+                continue
+            x = tuple(atan2(sin(v), cos(v)) for v in x)
+            if not self._matches_constraints(plan, x, wavelength):
+                continue
+            if return_all_solutions:
+                if not [s for s in solutions
+                        if max(abs(cut_at_minus_pi(a - b))
+                               for a, b in zip(s, x)) < SMALL]:
+                    solutions.append(x)
+            elif self._is_position_within_limits(YouPosition(*x)):
+                self._last_numerical_solution = x
+                return [x]
+        if not return_all_solutions or not solutions:
+            raise DiffcalcException(
+                'No solution was found for hkl=(%f,%f,%f) with the constraint '
+                'combination %s, which is solved numerically.\nCheck the '
+                'hardware limits or choose different constraints.' %
+                (h, k, l, self.repr_mode()))
+        return solutions
+
+    def _numerical_starting_positions(self, plan, theta):
+        """Generate (mu, delta, nu, eta, chi, phi) positions to start the
+        numerical solver from, with constrained angles set"""
+        constraints = plan.all
+        starts = []
+        if self._last_numerical_solution is not None:
+            starts.append(self._last_numerical_solution)
+        if self._reference is not None:
+            mu, eta, chi, phi = self._reference
+            starts.append((mu, 2 * theta, 0., eta, chi, phi))
+        for delta, nu in ((2 * theta, 0.), (0., 2 * theta)):
+            for eta in (theta, theta - pi):
+                for chi in (0., pi / 2, -pi / 2):
+                    for phi in (0., pi / 2, pi, -pi / 2):
+                        starts.append((0., delta, nu, eta, chi, phi))
+        tried = set()
+        for start in starts:
+            x0 = list(start)
+            for name, value in constraints.items():
+                if name in ANGLE_INDICES:
+                    x0[ANGLE_INDICES[name]] = value
+            if 'mu_is_' + NUNAME in constraints:
+                x0[0] = x0[2]
+            x0 = tuple(x0)
+            if x0 not in tried:  # constraints make some starts identical
+                tried.add(x0)
+                yield x0
+
+    def _matches_constraints(self, plan, x, wavelength):
+        """Return True if the virtual angles of position x in radians match
+        the reference and detector constraints"""
+        names = set(plan.all) - set(ANGLE_INDICES) - set(['mu_is_' + NUNAME])
+        if 'a_eq_b' in names:
+            names.update(('alpha', 'beta'))
+        virtual_angles = self._anglesToVirtualAngles(YouPosition(*x),
+                                                     wavelength, names)
+        for name, value in plan.all.items():
+            if name == 'a_eq_b':
+                name, value = 'alpha', virtual_angles['beta']
+            elif name == 'psi':
+                value = abs(cut_at_minus_pi(value))  # psi is read back >= 0
+            elif name not in virtual_angles:
+                continue
+            if not abs(cut_at_minus_pi(virtual_angles[name] - value)) < 1e-6:
+                return False
+        return True
+
+    @timed('solve.position')
+    def _create_position_pseudo_angles_pair(self, wavelength, mu, delta, nu,
+                                            eta, chi, phi, within_limits=False,
+                                            plan=None):
         # Create position
         position = YouPosition(mu, delta, nu, eta, chi, phi)
-        position = _tidy_degenerate_solutions(position, self.constraints)
-        if position.phi <= -pi + SMALL:
-            position.phi += 2 * pi
+        if plan is None:
+            plan = self.constraints.mode_plan
+        tidied = _tidy_degenerate_solutions(position.clone(), plan)
+        degenerate = not tidied == position
+        if tidied.phi <= -pi + SMALL:
+            tidied.phi += 2 * pi
+        # The chosen solution was within limits; keep it so if tidying it
+        # would move it out
+        if not within_limits or self._is_position_within_limits(tidied):
+            position = tidied
+            if degenerate:
+                self.statistics.add('tidy_ups')
         # pseudo angles calculated along the way were for the initial solution
         # and may be invalid for the chosen solution TODO: anglesToHkl need no
         # longer check the pseudo_angles as they will be generated with the
@@ -454,6 +1057,7 @@ class YouHklCalculator(HklCalculatorBase):
         return position, pseudo_angles
 
 
+    @timed('solve.theta')
     def _calc_theta(self, h_phi, wavelength):
         """Calculate theta using Equation1
         """
@@ -468,9 +1072,14 @@ class YouHklCalculator(HklCalculatorBase):
                 'Reflection is unreachable as |Q| is too long')
         return theta
 
-    def _calc_remaining_reference_angles(self, name, value, theta, tau):
-        """Return psi, alpha and beta given one of a_eq_b, alpha, beta or psi
+    @timed('solve.reference')
+    def _calc_remaining_reference_angles(self, name, value, theta, tau,
+                                         trig=None):
+        """Return psi, alpha and beta given one of a_eq_b, alpha, beta or psi.
+        trig is (sin(value), cos(value)) if already known.
         """
+        if trig is None and value is not None:
+            trig = sin(value), cos(value)
         if sin(tau) == 0:
             raise DiffcalcException(
                 'The scattering vector (Q) and the reference vector (n) are\n'
@@ -486,12 +1095,12 @@ class YouHklCalculator(HklCalculatorBase):
             psi = value
             # Equation 26 for alpha
             sin_alpha = (cos(tau) * sin(theta) -
-                         cos(theta) * sin(tau) * cos(psi))
+                         cos(theta) * sin(tau) * trig[1])
             if abs(sin_alpha) > 1 + SMALL:
                 raise DiffcalcException(UNREACHABLE_MSG % (name, value * TODEG))
             alpha = asin(bound(sin_alpha))
             # Equation 27 for beta
-            sin_beta = cos(tau) * sin(theta) + cos(theta) * sin(tau) * cos(psi)
+            sin_beta = cos(tau) * sin(theta) + cos(theta) * sin(tau) * trig[1]
             if abs(sin_beta) > 1 + SMALL:
                 raise DiffcalcException(UNREACHABLE_MSG % (name, value * TODEG))
 
@@ -502,14 +1111,14 @@ class YouHklCalculator(HklCalculatorBase):
 
         elif name == 'alpha':
             alpha = value                                                # (24)
-            sin_beta = 2 * sin(theta) * cos(tau) - sin(alpha)
+            sin_beta = 2 * sin(theta) * cos(tau) - trig[0]
             if abs(sin_beta) > 1 + SMALL:
                 raise DiffcalcException(UNREACHABLE_MSG % (name, value * TODEG))
             beta = asin(sin_beta)
 
         elif name == 'beta':
             beta = value
-            sin_alpha = 2 * sin(theta) * cos(tau) - sin(beta)            # (24)
+            sin_alpha = 2 * sin(theta) * cos(tau) - trig[0]              # (24)
             if abs(sin_alpha) > 1 + SMALL:
                 raise DiffcalcException(UNREACHABLE_MSG % (name, value * TODEG))
 
@@ -526,6 +1135,7 @@ class YouHklCalculator(HklCalculatorBase):
             psi = acos(bound(cos_psi))
         return psi, alpha, beta
 
+    @timed('solve.detector')
     def _calc_det_angles_given_det_or_naz_constraint(
             self, det_constraint, naz_constraint, theta, tau, alpha):
         
@@ -617,6 +1227,7 @@ class YouHklCalculator(HklCalculatorBase):
 
         return delta, nu, qaz
 
+    @timed('solve.sample')
     def _calc_sample_angles_from_one_sample_constraint(
             self, h, k, l, wavelength, samp_constraints, h_phi, theta,
             ref_constraint_name, ref_constraint_value, alpha, qaz, naz, delta, nu):
@@ -641,56 +1252,74 @@ class YouHklCalculator(HklCalculatorBase):
         mu, eta, chi, phi = self._choose_sample_solution(mu_eta_chi_phi_tuples)
         return mu, eta, chi, phi
 
+    @timed('solve.sample')
     def _calc_sample_given_two_sample_and_reference(
             self, h, k, l, wavelength, samp_constraints, h_phi, theta,
-            ref_constraint_name, ref_constraint_value, psi):
-        
-        angles = self._calc_sample_angles_given_two_sample_and_reference(
-                 samp_constraints, psi, theta, h_phi, self._get_n_phi())
-        xi_initial, psi, mu, eta, chi, phi = angles
-        values_in_deg = tuple(v * TODEG for v in angles)
-        logger.info('Initial angles: xi=%.3f, psi=%.3f, mu=%.3f, '
-            'eta=%.3f, chi=%.3f, phi=%.3f' % 
-            values_in_deg) # Try to find a solution for each possible transformed xi
-        solution_found = False
-
-        possible_psi = [cut_at_minus_pi(_psi) for _psi in _generate_transformed_values(psi)]# , ref_constraint_name == 'psi') 
-        possible_xi = [_xi for _xi in _generate_transformed_values(xi_initial, False)]
-                
-        psi_xi_pairs = []
-        for _psi in possible_psi:
-            for _xi in possible_xi:
-                psi_xi_pairs.append((_psi, _xi))
-        
-        for psi, xi in psi_xi_pairs:   
-            qaz = xi + pi / 2
-            if qaz > 2 * pi:
-                qaz -= 2 * pi
-            logger.info("")
-            msg = "---Trying psi=%.3f, qaz=%.3f (from xi=%.3f)" % (psi * TODEG, qaz * TODEG, xi * TODEG)
-            logger.info(msg)
-            
-            delta, nu, qaz = self._calc_remaining_detector_angles(
-                'qaz', qaz, theta)
-            delta_nu_pairs = self._generate_detector_solutions(
-                delta, nu, qaz, theta, 'qaz')
-            if not delta_nu_pairs:
-                continue
-            delta, nu = self._choose_detector_solution(delta_nu_pairs)
-            logger.info("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-            mu_eta_chi_phi_tuples = self._generate_sample_solutions(
-                mu, eta, chi, phi, samp_constraints.keys(), delta, 
-                nu, wavelength, (h, k, l), ref_constraint_name, 
-                ref_constraint_value)
-            if not mu_eta_chi_phi_tuples:
-                continue
-            mu, eta, chi, phi = self._choose_sample_solution(mu_eta_chi_phi_tuples)
-            solution_found = True
-            break
-        if not solution_found:
-            raise Exception('No solutions were found, please '
-                'unconstrain detector or sample limits')
-        return mu, delta, nu, eta, chi, phi
+            ref_constraint_name, ref_constraint_value, psi,
+            return_all_solutions=False):
+        """Return the (mu, delta, nu, eta, chi, phi) solutions given two
+        sample constraints and psi.
+
+        Unless psi is itself constrained only cos(psi) follows from the
+        reference constraint, so both psi and -psi are tried. For each, the
+        sample angles and xi (and so qaz) are calculated directly on both of
+        their branches, and each candidate is checked once to map back to hkl
+        and to match the reference constraint. Unless all solutions are
+        requested, candidates outside the limits are discarded and the one
+        closest to all zeros is returned, preferring psi to -psi, or when
+        given a reference position that closest to it.
+        """
+        if ref_constraint_name == 'psi' or is_small(sin(psi)):
+            possible_psi = [psi]
+        else:
+            possible_psi = [psi, -psi]
+        filter_out_of_limits = not return_all_solutions
+        first_psi_only = not return_all_solutions and self._reference is None
+
+        solutions = []
+        for psi in possible_psi:
+            if first_psi_only and solutions:
+                break
+            branches = self._calc_sample_angles_given_two_sample_and_reference(
+                samp_constraints, psi, theta, h_phi, self._get_n_phi())
+            for xi, mu, eta, chi, phi in branches:
+                mu_eta_chi_phi = tuple(cut_at_minus_pi(v)
+                                       for v in (mu, eta, chi, phi))
+                logger.info('Trying psi=%.3f, xi=%.3f: mu=%.3f, eta=%.3f, '
+                            'chi=%.3f, phi=%.3f', psi * TODEG, xi * TODEG,
+                            *[v * TODEG for v in mu_eta_chi_phi])
+                self.statistics.add('sample_tuples')
+                if filter_out_of_limits and not self._are_within_limits(
+                        ('mu', 'eta', 'chi', 'phi'), mu_eta_chi_phi):
+                    continue
+                delta, nu, qaz = self._calc_remaining_detector_angles(
+                    'qaz', cut_at_minus_pi(xi + pi / 2), theta)
+                delta_nu_pairs = self._generate_detector_solutions(
+                    delta, nu, qaz, theta, 'qaz', filter_out_of_limits)
+                if filter_out_of_limits and len(delta_nu_pairs) > 1:
+                    _raise_multiple_detector_solutions_found(delta_nu_pairs)
+                for delta, nu in delta_nu_pairs:
+                    if self._filter_valid_sample_solutions(
+                            delta, nu, [mu_eta_chi_phi], wavelength,
+                            (h, k, l), ref_constraint_name,
+                            ref_constraint_value):
+                        mu, eta, chi, phi = mu_eta_chi_phi
+                        solutions.append((mu, delta, nu, eta, chi, phi))
+
+        solutions = _merge_nearly_equal_solutions(solutions)
+        if not solutions:
+            raise DiffcalcException(
+                'No solution was found for hkl=(%f,%f,%f) with the constraint '
+                'combination %s:\nno position %s maps back to hkl.' %
+                (h, k, l, self.repr_mode(),
+                 'within the detector and sample limits'
+                 if filter_out_of_limits else 'at all'))
+        if not return_all_solutions and len(solutions) > 1:
+            mu_eta_chi_phi_tuples = [(mu, eta, chi, phi) for
+                                     mu, _, _, eta, chi, phi in solutions]
+            chosen = self._choose_sample_solution(mu_eta_chi_phi_tuples)
+            solutions = [solutions[mu_eta_chi_phi_tuples.index(chosen)]]
+        return solutions
 
     def _calc_remaining_sample_angles(self, constraint_name, constraint_value,
                                       q_lab, n_lab, q_phi, n_phi):
@@ -704,7 +1333,7 @@ class YouHklCalculator(HklCalculatorBase):
 
         if constraint_name == 'mu':                                      # (35)
             mu = constraint_value
-            V = calcMU(mu).I * N_lab * N_phi.T
+            V = calcMU(mu).T * N_lab * N_phi.T
             phi = atan2(V[2, 1], V[2, 0])
             eta = atan2(-V[1, 2], V[0, 2])
             chi = atan2(sqrt(V[2, 0] ** 2 + V[2, 1] ** 2), V[2, 2])
@@ -794,57 +1423,147 @@ class YouHklCalculator(HklCalculatorBase):
 
         raise ValueError('Given angle must be one of phi, chi, eta or mu')
 
+    @timed('solve.sample')
     def _calc_angles_given_three_sample_constraints(
-            self, h, k, l, wavelength, return_all_solutions, samp_constraints,
-            h_phi, theta):
-        
-        if not 'mu' in samp_constraints:
-            eta_ = self.constraints.sample['eta']
-            chi_ = self.constraints.sample['chi']
-            phi_ = self.constraints.sample['phi']
-            two_mu_qaz_pairs = _mu_and_qaz_from_eta_chi_phi(eta_, chi_, phi_, theta, h_phi)
+            self, plan, h, k, l, wavelength, return_all_solutions, h_phi,
+            theta):
+        """Return (mu, delta, nu, eta, chi, phi) solutions given eta, chi and
+        phi.
+
+        mu has two roots (68,69). Each root fixes Q in the lab frame, and so
+        qaz, leaving only two detector branches: (delta, nu) and
+        (pi - delta, nu + pi). Candidates are pruned by limits before being
+        checked to map back to hkl, rather than expanding every angle into
+        its transformed values and verifying each combination.
+        """
+        if not 'mu' in plan.sample:
+            eta = cut_at_minus_pi(plan.sample['eta'])
+            chi = cut_at_minus_pi(plan.sample['chi'])
+            phi = cut_at_minus_pi(plan.sample['phi'])
+            two_mu_qaz_pairs = _mu_and_qaz_from_eta_chi_phi(eta, chi, phi,
+                                                            theta, h_phi)
         else:
             raise DiffcalcException(
                 'No code yet to handle this combination of 3 sample constraints!')
-    # TODO: Code duplicated above
+
         all_solutions = []
         working_delta_nu_pairs = []
         filter_out_of_limits = not return_all_solutions
-        two_mu_qaz_pairs = merge_nearly_equal_pairs(two_mu_qaz_pairs)
-        for mu_, qaz in two_mu_qaz_pairs:
-            logger.debug("--- Trying mu_:%.f qaz_%.f", mu_ * TODEG, qaz * TODEG)
-            delta_, nu_, _ = self._calc_remaining_detector_angles('qaz', qaz, theta)
-            delta_nu_pairs = self._generate_detector_solutions(
-                delta_, nu_, qaz, theta, 'qaz', filter_out_of_limits)
+        for mu, qaz in merge_nearly_equal_pairs(two_mu_qaz_pairs):
+            logger.debug("--- Trying mu:%.f qaz:%.f", mu * TODEG, qaz * TODEG)
+            mu = cut_at_minus_pi(mu)
+            if filter_out_of_limits and not self._is_within_limits('mu', mu):
+                continue
+            q_lab = you_sample_rotation(mu, eta, chi, phi) * h_phi      # (11)
+            delta_nu_pairs = self._generate_detector_branches(
+                q_lab, theta, filter_out_of_limits)
             for delta, nu in delta_nu_pairs:
-                logger.info("delta=%.3f, %s=%.3f", delta * TODEG, NUNAME, nu * TODEG)
-    #                delta, nu = self._choose_detector_solution(delta_nu_pairs)
-                mu_eta_chi_phi_tuples = self._generate_sample_solutions(
-                    mu_, eta_, chi_, phi_, samp_constraints.keys(), delta, 
-                    nu, wavelength, (h, k, l), None, None, filter_out_of_limits)
-                if mu_eta_chi_phi_tuples:
+                pos = YouPosition(mu, delta, nu, eta, chi, phi)
+                if sequence_ne((h, k, l), self._anglesToHkl(pos, wavelength)):
+                    logger.info("mu=%.3f, delta=%.3f, %s=%.3f", mu * TODEG,
+                                delta * TODEG, NUNAME, nu * TODEG)
                     working_delta_nu_pairs.append((delta, nu))
-                for mu, eta, chi, phi in mu_eta_chi_phi_tuples:
                     all_solutions.append((mu, delta, nu, eta, chi, phi))
-        
-        working_delta_nu_pairs = merge_nearly_equal_pairs(
-            working_delta_nu_pairs)
+
         if return_all_solutions:
             return all_solutions
-        
-        elif not working_delta_nu_pairs:
+
+        working_delta_nu_pairs = merge_nearly_equal_pairs(
+            working_delta_nu_pairs)
+        if not working_delta_nu_pairs:
             raise Exception('No solutions were found, please '
                 'unconstrain detector or sample limits')
         elif len(working_delta_nu_pairs) > 1:
             _raise_multiple_detector_solutions_found(working_delta_nu_pairs)
-        else:
-            delta, nu = working_delta_nu_pairs[0]
-            mu, eta, chi, phi = self._choose_sample_solution(mu_eta_chi_phi_tuples)
+        delta, nu = working_delta_nu_pairs[0]
+        mu, eta, chi, phi = self._choose_sample_solution(
+            [(mu_, eta_, chi_, phi_)
+             for mu_, _, _, eta_, chi_, phi_ in all_solutions])
         return [(mu, delta, nu, eta, chi, phi)]
 
+    def _get_axis_limits(self):
+        """Return a dictionary of (cut, lower, upper) tuples in degrees for
+        each hardware axis, rebuilt only when a limit or cut changes."""
+        version = self._hardware.limits_version
+        if self._limits is None or self._limits[0] != version:
+            cuts = self._hardware.get_cuts()
+            table = {}
+            for name in self._hardware.get_axes_names():
+                table[name] = (cuts.get(name),
+                               self._hardware.get_lower_limit(name),
+                               self._hardware.get_upper_limit(name))
+            self._limits = version, table
+        return self._limits[1]
+
+    def _is_position_within_limits(self, pos):
+        """Return True if all angles of pos, in radians, are within limits"""
+        for name, value in zip(('mu', 'delta', NUNAME, 'eta', 'chi', 'phi'),
+                               pos.totuple()):
+            if not self._is_within_limits(name, value):
+                return False
+        return True
+
+    def _are_within_limits(self, names, values):
+        """Return True if all values, in radians, are within the limits of
+        the axes names"""
+        for name, value in zip(names, values):
+            if not self._is_within_limits(name, value):
+                return False
+        return True
+
+    def _is_within_limits(self, name, value):
+        """Return True if value in radians, once cut, is within the hardware
+        limits of axis name (or if the hardware has no such axis)."""
+        try:
+            cut, lower, upper = self._get_axis_limits()[name]
+        except KeyError:
+            return True
+        value = value * TODEG
+        if cut is not None:
+            value = cut_angle_at(cut, value)
+        return ((lower is None or value >= lower) and
+                (upper is None or value <= upper))
+
+    def _generate_detector_branches(self, q_lab, theta,
+                                    filter_out_of_limits=True):
+        """Return the delta, nu pairs that scatter along q_lab with Bragg
+        angle theta.
+
+        From Equation 12, sin(delta), cos(delta)cos(nu) and cos(delta)sin(nu)
+        follow directly from Q in the lab frame, leaving only the branches
+        (delta, nu) and (pi - delta, nu + pi).
+        """
+        q1, q2, q3 = [v * 2 * sin(theta) for v in normalised(q_lab).flat]
+        delta = asin(bound(q1))
+        if ne(delta, pi / 2):
+            if PRINT_DEGENERATE:
+                print (('DEGENERATE: with delta=90, %s is degenerate: choosing '
+                       '%s = 0 (allowed because %s is unconstrained)') %
+                       (NUNAME, NUNAME, NUNAME))
+            self.statistics.add('detector_pairs')
+            return [(delta, 0)]
+        nu = atan2(q3, 1 + q2)
+
+        delta_nu_pairs = []
+        for delta_, nu_ in ((delta, nu), (pi - delta, nu + pi)):
+            delta_, nu_ = cut_at_minus_pi(delta_), cut_at_minus_pi(nu_)
+            if (not filter_out_of_limits or
+                (self._is_within_limits('delta', delta_) and
+                 self._is_within_limits(NUNAME, nu_))):
+                delta_nu_pairs.append((delta_, nu_))
+        self.statistics.add('detector_pairs', len(delta_nu_pairs))
+
+        # As in _generate_detector_solutions, keep only one of two solutions
+        # found just either side of delta = 90
+        if (len(delta_nu_pairs) == 2 and
+            all(abs(delta_ - pi / 2) < .01 for delta_, _ in delta_nu_pairs)):
+            delta_nu_pairs = delta_nu_pairs[:1]
+        return merge_nearly_equal_pairs(delta_nu_pairs)
+
     def _calc_sample_angles_given_two_sample_and_reference(
             self, samp_constraints, psi, theta, q_phi, n_phi):
-        """Available combinations:
+        """Return a list of the (xi, mu, eta, chi, phi) branches consistent
+        with psi. Available combinations:
         chi, phi, reference
         mu, eta, reference,
         chi=90, mu=0, reference
@@ -866,6 +1585,9 @@ class YouHklCalculator(HklCalculatorBase):
             xi = atan2(-V[2, 0], V[2, 2])
             eta = atan2(-V[0, 1], V[1, 1])
             mu = atan2(-V[2, 1], sqrt(V[2, 2] ** 2 + V[2, 0] ** 2))
+            # and with cos(mu) < 0
+            return [(xi, mu, eta, chi, phi),
+                    (xi + pi, pi - mu, eta + pi, chi, phi)]
 
         elif 'mu' in samp_constraints and 'eta' in samp_constraints:
 
@@ -875,34 +1597,23 @@ class YouHklCalculator(HklCalculatorBase):
             V = N_phi * PSI.T * THETA.T                                  # (49)
 
             bot = sqrt(sin(eta) ** 2 * cos(mu) ** 2 + sin(mu) ** 2)
-            chi_orig = (asin(-V[2, 1] / bot) -
-                   atan2(sin(mu), (sin(eta) * cos(mu))))                 # (52)
-
-            # Choose final chi solution here to obtain compatable xi and mu
-            # TODO: This temporary solution works only for one case used on i07
-            #       Return a list of possible solutions?
-            if is_small(eta) and is_small(mu + pi / 2):
-                for chi in _generate_transformed_values(chi_orig):
-                    if  pi / 2 <= chi < pi:
-                        break
-            else:
-                chi = chi_orig
-
-            a = sin(chi) * cos(eta)
-            b = sin(chi) * sin(eta) * sin(mu) - cos(chi) * cos(mu)
-            xi = atan2(V[2, 2] * a + V[2, 0] * b,
-                       V[2, 0] * a - V[2, 2] * b)                        # (54)
-
-            a = sin(chi) * sin(mu) - cos(mu) * cos(chi) * sin(eta)
-            b = cos(mu) * cos(eta)
-            phi = atan2(V[1, 1] * a - V[0, 1] * b,
-                        V[0, 1] * a + V[1, 1] * b)                       # (55)
-#            if is_small(mu+pi/2) and is_small(eta) and False:
-#                phi_general = phi
-#                # solved in extensions_to_yous_paper.wxm
-#                phi = atan2(V[1, 1], V[0, 1])
-#                logger.info("phi = %.3f or %.3f (std)",
-#                            phi*TODEG, phi_general*TODEG )
+            if is_small(bot) or abs(V[2, 1] / bot) > 1 + SMALL:
+                return []
+            asin_chi = asin(bound(-V[2, 1] / bot))
+            offset = atan2(sin(mu), (sin(eta) * cos(mu)))
+            branches = []
+            for chi in (asin_chi - offset, pi - asin_chi - offset):     # (52)
+                a = sin(chi) * cos(eta)
+                b = sin(chi) * sin(eta) * sin(mu) - cos(chi) * cos(mu)
+                xi = atan2(V[2, 2] * a + V[2, 0] * b,
+                           V[2, 0] * a - V[2, 2] * b)                    # (54)
+
+                a = sin(chi) * sin(mu) - cos(mu) * cos(chi) * sin(eta)
+                b = cos(mu) * cos(eta)
+                phi = atan2(V[1, 1] * a - V[0, 1] * b,
+                            V[0, 1] * a + V[1, 1] * b)                   # (55)
+                branches.append((xi, mu, eta, chi, phi))
+            return branches
 
         elif 'chi' in samp_constraints and 'mu' in samp_constraints:
             # derived in extensions_to_yous_paper.wxm
@@ -910,28 +1621,32 @@ class YouHklCalculator(HklCalculatorBase):
             mu = samp_constraints['mu']
 
             if not is_small(mu) and not is_small(chi - pi / 2):
-                raise Exception('The fixed chi, mu, psi/alpha/beta modes only '
-                                ' currently work with chi=90 and mu=0')
+                raise DiffcalcException(
+                    'The fixed chi, mu, psi/alpha/beta modes only currently '
+                    'work with chi=90 and mu=0')
             V = N_phi * PSI.T * THETA.T
-            eta = asin(-V[2, 1])
+            eta = asin(bound(-V[2, 1]))
             xi = atan2(V[2, 2], V[2, 0])
             phi = -atan2(V[0, 1], V[1, 1])
+            # and with cos(eta) < 0
+            return [(xi, mu, eta, chi, phi),
+                    (xi + pi, mu, pi - eta, chi, phi + pi)]
 
         else:
             raise DiffcalcException(
                 'No code yet to handle this combination of 2 sample '
                 'constraints and one reference!:' + str(samp_constraints))
-        return xi, psi, mu, eta, chi, phi
 
     def _generate_detector_solutions(self, initial_delta, initial_nu, qaz,
                                         theta, det_constraint_name,
                                         filter_out_of_limits=True):
         if (ne(initial_delta, pi / 2) and
-            (NUNAME not in self.constraints.detector)):
+            (NUNAME not in self.constraints.mode_plan.detector)):
             if PRINT_DEGENERATE:
                 print (('DEGENERATE: with delta=90, %s is degenerate: choosing '
                        '%s = 0 (allowed because %s is unconstrained)') %
                        (NUNAME, NUNAME, NUNAME))
+            self.statistics.add('detector_pairs')
             return ((initial_delta, 0), )  # delta, nu
 
         logger.info('initial detector solution - delta=% 7.3f, %s=% 7.3f',
@@ -939,6 +1654,7 @@ class YouHklCalculator(HklCalculatorBase):
         possible_delta_nu_pairs = self._generate_possible_solutions(
             [initial_delta, initial_nu], ['delta', NUNAME],
             (det_constraint_name,), filter_out_of_limits)
+        self.statistics.add('detector_pairs', len(possible_delta_nu_pairs))
         delta_nu_pairs = _filter_detector_solutions_by_theta_and_qaz(
             possible_delta_nu_pairs, theta, qaz)
 
@@ -977,6 +1693,15 @@ class YouHklCalculator(HklCalculatorBase):
         possible_tuples = self._generate_possible_solutions(
             [mu_, eta_, chi_, phi_], ['mu', 'eta', 'chi', 'phi'],
             sample_constraint_names, filter_out_of_limits)
+        self.statistics.add('sample_tuples', len(possible_tuples))
+        if self._reference is not None and possible_tuples:
+            # Try only the neighbouring branch first
+            nearest = min(possible_tuples, key=self._distance_from_reference)
+            mu_eta_chi_phi_tuples = self._filter_valid_sample_solutions(
+                delta, nu, [nearest], wavelength, hkl, ref_constraint_name,
+                ref_constraint_value)
+            if mu_eta_chi_phi_tuples:
+                return mu_eta_chi_phi_tuples
         mu_eta_chi_phi_tuples = self._filter_valid_sample_solutions(
             delta, nu, possible_tuples, wavelength, hkl, ref_constraint_name,
             ref_constraint_value)
@@ -996,7 +1721,14 @@ class YouHklCalculator(HklCalculatorBase):
             hkl_okay = sequence_ne(hkl, hkl_actual)
 
             if hkl_okay:
-                virtual_angles = self._anglesToVirtualAngles(pos, wavelength)
+                if logger.isEnabledFor(logging.DEBUG):
+                    names = None  # all are logged
+                elif ref_constraint_name == 'a_eq_b':
+                    names = ('alpha', 'beta')
+                else:
+                    names = (ref_constraint_name,)
+                virtual_angles = self._anglesToVirtualAngles(pos, wavelength,
+                                                             names)
                 if not ref_constraint_name:
                     virtual_okay = True;
                 elif ref_constraint_name == 'a_eq_b':
@@ -1026,6 +1758,9 @@ class YouHklCalculator(HklCalculatorBase):
                 msg += '\n'
         if logger.isEnabledFor(logging.DEBUG):
             logger.debug(msg)
+        self.statistics.add('sample_rejected',
+                            len(possible_mu_eta_chi_phi_tuples) -
+                            len(mu_eta_chi_phi_tuples))
         return mu_eta_chi_phi_tuples
 
     def _choose_detector_solution(self, delta_nu_pairs):
@@ -1046,7 +1781,11 @@ class YouHklCalculator(HklCalculatorBase):
         # there are multiple solutions
         absolute_distances = []
         for solution in mu_eta_chi_phi_tuples:
-            absolute_distances.append(sum([abs(v) for v in solution]))
+            if self._reference is None:
+                absolute_distances.append(sum([abs(v) for v in solution]))
+            else:
+                absolute_distances.append(
+                    self._distance_from_reference(solution))
 
         shortest_solution_index = absolute_distances.index(
             min(absolute_distances))
@@ -1054,7 +1793,8 @@ class YouHklCalculator(HklCalculatorBase):
 
         if logger.isEnabledFor(logging.INFO):
             msg = ('Multiple sample solutions found (choosing solution with '
-                   'shortest distance to all-zeros position):\n')
+                   'shortest distance to %s position):\n' %
+                   ('all-zeros' if self._reference is None else 'reference'))
             i = 0
             for solution, distance in zip(mu_eta_chi_phi_tuples,
                                           absolute_distances):
@@ -1073,18 +1813,20 @@ class YouHklCalculator(HklCalculatorBase):
     def _generate_possible_solutions(self, values, names, constrained_names,
                                      filter_out_of_limits=True):
 
-        # Expand each value into a list of values
+        # Expand each value into a list of values, discarding those outside
+        # the hardware limits axis by axis before any combinations are made
         transformed_values = []
         for value, name in zip(values, names):
-            transformed_values.append([])
             if name in constrained_names:
-                transformed_values[-1].append(cut_at_minus_pi(value))
-            else:             
-                for transformed_value in _generate_transformed_values(value, False):
-                    in_limits = self._hardware.is_axis_value_within_limits(name,
-                        self._hardware.cut_angle(name, transformed_value * TODEG))
-                    if in_limits or not filter_out_of_limits:
-                        transformed_values[-1].append(cut_at_minus_pi(transformed_value))
+                candidates = [value]
+            else:
+                candidates = _generate_transformed_values(value, False)
+            transformed_values.append(
+                [cut_at_minus_pi(v) for v in candidates
+                 if not filter_out_of_limits or self._is_within_limits(name, v)])
+            if not transformed_values[-1]:
+                logger.debug('No %s solutions within limits', name)
+                return []
 
         # Generate all combinations of the transformed values
         def expand(tuples_so_far, b):
@@ -1132,12 +1874,10 @@ def _mu_and_qaz_from_eta_chi_phi(eta, chi, phi, theta, h_phi):
 #             raise AssertionError("mu_simplified != mu , %f!=%f" % (mu_simplified, mu))
         
     
-    [MU, _, _, ETA, CHI, PHI] = create_you_matrices(mu1, None, None, eta, chi, phi)
-    h_lab = MU * ETA * CHI * PHI * h_phi                                 # (11)
+    h_lab = you_sample_rotation(mu1, eta, chi, phi) * h_phi              # (11)
     qaz1 = atan2(h_lab[0, 0] , h_lab[2, 0])
 
-    [MU, _, _, ETA, CHI, PHI] = create_you_matrices(mu2, None, None, eta, chi, phi)
-    h_lab = MU * ETA * CHI * PHI * h_phi                                 # (11)
+    h_lab = you_sample_rotation(mu2, eta, chi, phi) * h_phi              # (11)
     qaz2 = atan2(h_lab[0, 0] , h_lab[2, 0])
 
     return (mu1, qaz1) , (mu2, qaz2)
@@ -16,7 +16,7 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
-from math import pi
+from math import pi, sin, cos
 
 try:
     from numpy import matrix
@@ -47,12 +47,70 @@ all_constraints = det_constraints + ref_constraints + samp_constraints
 number_single_sample = (len(det_constraints) * len(ref_constraints) *
                         len(samp_constraints))
 
+# Kinds of ModePlan, each solved by its own YouHklCalculator method
+ONE_SAMPLE = 'one_sample'
+TWO_SAMPLE_AND_REFERENCE = 'two_sample_and_reference'
+THREE_SAMPLE = 'three_sample'
+NUMERICAL = 'numerical'  # no analytic solution implemented
+
+
+class ModePlan(object):
+    """A set of constraints compiled once for repeated hkl calculations.
+
+    Holds the constraints split into columns as dictionaries, the constant
+    values (in radians) and their sines and cosines, and the kind of solution
+    the combination requires (None unless fully constrained). Plans are
+    immutable; YouConstraintManager builds a new one whenever the
+    constraints change.
+    """
+
+    def __init__(self, constrained):
+        set_ = object.__setattr__
+        set_(self, 'all', dict(constrained))
+        set_(self, 'detector', filter_dict(constrained, det_constraints[:-1]))
+        set_(self, 'naz', filter_dict(constrained, ('naz',)))
+        set_(self, 'reference', filter_dict(constrained, ref_constraints))
+        set_(self, 'sample', filter_dict(constrained, samp_constraints))
+        set_(self, 'reference_constraint',
+             (self.reference.items() or [(None, None)])[0])
+        set_(self, 'fully_constrained', len(constrained) == 3)
+        # (sin, cos) of each constraint with a value
+        set_(self, 'trig', dict((name, (sin(value), cos(value)))
+                                for name, value in constrained.items()
+                                if value is not None))
+        set_(self, 'kind', self._kind())
+
+    def _kind(self):
+        if not self.fully_constrained:
+            return None
+        sample_names = set(self.sample.keys())
+        if len(self.sample) == 1:
+            return ONE_SAMPLE
+        if len(self.sample) == 3:
+            if sample_names == set(['chi', 'phi', 'eta']):
+                return THREE_SAMPLE
+        elif self.reference:
+            if (sample_names == set(['chi', 'phi']) or
+                    sample_names == set(['mu', 'eta']) or
+                    self.sample == {'mu': 0, 'chi': pi / 2}):
+                return TWO_SAMPLE_AND_REFERENCE
+        return NUMERICAL
+
+    @property
+    def implemented(self):
+        """True if the combination has an analytic solution"""
+        return self.kind not in (None, NUMERICAL)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ModePlan objects are immutable')
+
 
 class YouConstraintManager(object):
 
     def __init__(self, hardware, fixed_constraints = {}):
         self._hardware = hardware
         self._constrained = {}
+        self._mode_plan = None
 #        self._tracking = []
         self.n_phi = matrix([[0], [0], [1]])
         self._hide_detector_constraint = False # default
@@ -87,8 +145,8 @@ class YouConstraintManager(object):
         if (self.is_fully_constrained() and
             not self.is_current_mode_implemented()):
             lines.append(
-                "    Sorry, this constraint combination is not implemented")
-            lines.append("    Type 'help con' for available combinations")
+                "    This constraint combination will be solved numerically")
+            lines.append("    Type 'help con' for analytic combinations")
         else:
             lines.append("    Type 'help con' for instructions")  # okay
         return '\n'.join(lines)
@@ -106,6 +164,24 @@ class YouConstraintManager(object):
             all_copy.remove(valueless)
         return all_copy
 
+    def _get_constrained(self):
+        return self._values
+
+    def _set_constrained(self, constrained):
+        self._values = constrained
+        self._mode_plan = None
+
+    # Dictionary of constrained values; the mode plan is rebuilt whenever it
+    # is replaced or changed through the methods below
+    _constrained = property(_get_constrained, _set_constrained)
+
+    @property
+    def mode_plan(self):
+        """ModePlan compiled from the current constraints"""
+        if self._mode_plan is None:
+            self._mode_plan = ModePlan(self._constrained)
+        return self._mode_plan
+
     @property
     def all(self):  # @ReservedAssignment
         """dictionary of all constrained values"""
@@ -228,21 +304,7 @@ class YouConstraintManager(object):
     def is_current_mode_implemented(self):
         if not self.is_fully_constrained():
             raise ValueError("Three constraints required")
-        
-        if len(self.sample) == 3:
-            if set(self.sample.keys()) == set(['chi', 'phi', 'eta']):
-                return True
-            return False
-
-        if len(self.sample) == 1:
-            return True
-
-        if len(self.reference) == 1:
-            return (set(self.sample.keys()) == set(['chi', 'phi']) or
-                    set(self.sample.keys()) == set(['mu', 'eta']) or
-                    self.sample == {'mu': 0, 'chi': pi / 2})
-        
-        return False
+        return self.mode_plan.implemented
         
 
     def _label_constraint(self, name):
@@ -262,6 +324,7 @@ class YouConstraintManager(object):
     def constrain(self, name):
         if self.is_constraint_fixed(name):
             raise DiffcalcException('%s is not a valid constraint name' % name)
+        self._mode_plan = None
         if name in self.all:
             return "%s is already constrained." % name.capitalize()
         elif name in det_constraints:
@@ -327,6 +390,7 @@ class YouConstraintManager(object):
     def unconstrain(self, name):
         if self.is_constraint_fixed(name):
             raise DiffcalcException('%s is not a valid constraint name')
+        self._mode_plan = None
         if name in self._constrained:
             del self._constrained[name]
         else:
@@ -361,6 +425,7 @@ class YouConstraintManager(object):
         old_value = self.get_constraint(name)
         old = str(old_value) if old_value is not None else '---'
         self._constrained[name] = float(value) * TORAD
+        self._mode_plan = None
         new = str(value)
         return "%(name)s : %(old)s --> %(new)s" % locals()
 
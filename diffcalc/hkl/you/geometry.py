@@ -138,6 +138,8 @@ def calcPHI(phi):
 
 class YouPosition(AbstractPosition):
 
+    __slots__ = ('mu', 'delta', 'nu', 'eta', 'chi', 'phi')
+
     def __init__(self, mu=None, delta=None, nu=None, eta=None, chi=None,
                  phi=None):
         self.mu = mu
@@ -19,8 +19,9 @@
 from __future__ import absolute_import
 
 from diffcalc.hkl.common import getNameFromScannableOrString
-from diffcalc.util import command
+from diffcalc.util import command, stage_timers
 from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you import planner
 from diffcalc import settings
 
 
@@ -28,7 +29,9 @@ from diffcalc import settings
 import diffcalc.ub.ub
 from diffcalc.hkl.you.constraints import YouConstraintManager
 
-__all__ = ['allhkl', 'con', 'uncon', 'hklcalc', 'constraint_manager']
+__all__ = ['allhkl', 'con', 'uncon', 'hklcache', 'calcstats', 'hkltiming',
+           'hklverify', 'hkltrack', 'psirange', 'conplan', 'sector',
+           'hklcalc', 'constraint_manager']
 
 
 _fixed_constraints = settings.geometry.fixed_constraints  # @UndefinedVariable
@@ -53,7 +56,7 @@ def con(*args):
     from each of the sample and detector columns and up to three from
     the sample column.
 
-    Not all constraint combinations are currently available:
+    Not all constraint combinations are solved analytically:
 
         1 x samp:              all 80 of 80
         2 x samp and 1 x ref:  chi & phi
@@ -62,21 +65,25 @@ def con(*args):
         2 x samp and 1 x det:  0 of 6
         3 x samp:              eta, chi & phi (1 of 4)
 
+    Other combinations are solved numerically, starting from the previous
+    solution so that scans converge quickly.
+
     See also 'uncon'
     """
     args = list(args)
     msg = _handle_con(args)
     if (hklcalc.constraints.is_fully_constrained() and 
         not hklcalc.constraints.is_current_mode_implemented()):
-        msg += ("\n\nWARNING:. The selected constraint combination is valid but "
-            "is not implemented.\n\nType 'help con' to see implemented combinations")
+        msg += ("\n\nWARNING: The selected constraint combination has no "
+            "analytic solution and will be solved numerically.\n\nType "
+            "'help con' to see analytically solved combinations")
 
     if msg:
         print msg
 
 def _handle_con(args):
     if not args:
-        return hklcalc.constraints.__str__()
+        return hklcalc.__str__()
     
     if len(args) > 6:
         raise TypeError("Unexpected args: " + str(args))
@@ -114,6 +121,143 @@ def uncon(scn_or_string):
     hklcalc.constraints.unconstrain(name)
     print '\n'.join(hklcalc.constraints.report_constraints_lines())
 
+@command
+def hklcache(size=None):
+    """hklcache -- show statistics for the cache of hkl to angles results
+    hklcache <size> -- set the number of results cached (0 disables)
+
+    Cached results are discarded when the constraints, UB matrix, lattice,
+    or Diffcalc limits and cuts change.
+    """
+    if size is not None:
+        hklcalc.set_cache_size(size)
+    print 'hkl cache: ' + str(hklcalc.cache)
+
+@command
+def calcstats(reset=None):
+    """calcstats -- show counts of the work done calculating positions
+    calcstats reset -- reset the counts
+
+    Counts are shown for the last calculation, in total and for each mode.
+    """
+    if reset is not None:
+        if reset != 'reset':
+            raise TypeError()
+        hklcalc.statistics.reset()
+    print str(hklcalc.statistics)
+
+@command
+def hkltiming(action=None, filename=None):
+    """hkltiming -- show the times taken by each stage of hkl calculations
+    hkltiming on|off -- enable or disable timing
+    hkltiming reset -- discard the times recorded
+    hkltiming dump <filename> -- write the times and histograms to a JSON file
+
+    Stages time the solver (solve.*), the verification of calculated positions
+    (verify.*) and the cutting of hardware angles (hardware.cut_angles).
+    """
+    if action in ('on', 'off'):
+        stage_timers.enabled = action == 'on'
+    elif action == 'reset':
+        stage_timers.reset()
+    elif action == 'dump' and filename is not None:
+        stage_timers.dump_json(filename)
+        print 'hkl timing written to ' + filename
+        return
+    elif action is not None:
+        raise TypeError()
+    state = 'on' if stage_timers.enabled else 'off'
+    print 'hkl timing: %s\n%s' % (state, stage_timers)
+
+@command
+def hklverify(policy=None, interval=None):
+    """hklverify -- show how calculated positions are verified
+    hklverify always|sampled|cheap|off {interval} -- set verification policy
+
+    always: map every position back to hkl and virtual angles (default)
+    sampled: do this only for every <interval>th calculation (default 10)
+    cheap: check only that each position scatters along UB * hkl
+    off: do not verify positions
+    """
+    if policy is not None:
+        hklcalc.set_verification(policy, interval)
+    print hklcalc.repr_verification()
+
+@command
+def hkltrack(on_or_off=None):
+    """hkltrack -- show whether hkl moves track the previous position
+    hkltrack on|off -- choose solutions continuing from the previous position
+
+    When tracking, each hkl calculation chooses the sample solution closest to
+    the previous one rather than to all zeros, avoiding jumps between
+    equivalent solutions during scans. A warning is given when a switch
+    could not be avoided.
+    """
+    if on_or_off is not None:
+        if on_or_off not in ('on', 'off'):
+            raise TypeError()
+        hklcalc.set_tracking(on_or_off == 'on')
+    state = 'on' if hklcalc.tracking else 'off'
+    print 'hkl tracking: %s (%i forced branch switches)' % (
+        state, hklcalc.branch_switches)
+
+@command
+def sector(sector=None):
+    """sector {0|1} -- select or display the sector of equivalent positions
+
+    0: no transform
+    1: sample flip: eta + 180, -chi, phi + 180
+
+    Equivalent positions reach the same hkl with the same virtual angles.
+    A sector that would change a constrained angle, or take the position
+    outside limits, is not used. When tracking (see hkltrack) only the first
+    point is moved into the sector; the rest follow on from it.
+    """
+    selector = hklcalc.transform_selector
+    if sector is not None:
+        if type(sector) is not int:
+            raise TypeError()
+        selector.set_sector(sector)
+    print repr(selector)
+
+@command
+def conplan(hkl_list, wavelength=None, number=10):
+    """conplan [[h k l] [h k l] ...] -- rank constraint modes for an hkl path
+
+    Calculates the path in every analytically solved constraint mode, trying
+    a few typical values for each constraint, and lists the best modes by
+    the fraction of points reached within limits, then the number of branch
+    flips between consecutive points and then the total motor travel.
+    """
+    if wavelength is None:
+        wavelength = hklcalc._hardware.get_wavelength()
+    evaluations = planner.evaluate_modes(hklcalc, hkl_list, wavelength)
+    print '%6s %10s %5s   %s' % ('reach', 'travel', 'flips', 'mode')
+    for evaluation in evaluations[:number]:
+        print str(evaluation)
+    if evaluations and evaluations[0].coverage:
+        print '\nRecommended: ' + evaluations[0].con_command()
+    else:
+        print '\nNo mode reaches any of the path within limits'
+
+@command
+def psirange(hkl, wavelength=None):
+    """psirange [h k l] -- show the psi ranges in which hkl is within limits
+
+    psi takes the place of the reference constraint, keeping the detector and
+    sample constraints, and is measured about the current reference vector.
+    Ranges are found by sampling psi every degree and refining their ends.
+    """
+    if wavelength is None:
+        wavelength = hklcalc._hardware.get_wavelength()
+    intervals = hklcalc.reachable_psi_intervals(hkl, wavelength)
+    if not intervals:
+        print 'hkl=%s cannot be reached within limits at any psi' % (hkl,)
+        return
+    print 'hkl=%s can be reached within limits at:' % (hkl,)
+    for start, end in intervals:
+        print '    %9.4f <= psi <= %9.4f' % (start, end)
+
 @command 
 def allhkl(hkl, wavelength=None):
     """allhkl [h k l] -- print all hkl solutions ignoring limits
@@ -174,5 +318,14 @@ commands_for_help = ['Constraints',
                      con,
                      uncon,
                      'Hkl',
-                     allhkl
+                     allhkl,
+                     psirange,
+                     conplan,
+                     hklcache,
+                     calcstats,
+                     hkltiming,
+                     hklverify,
+                     hkltrack,
+                     'Sectors',
+                     sector
                      ]
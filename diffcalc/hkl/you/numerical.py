@@ -0,0 +1,190 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Numerical solution of You's equations for any set of three constraints.
+
+The six angles (mu, delta, nu, eta, chi, phi) are found by a damped
+Newton (Levenberg-Marquardt) iteration on six equations: three matching
+the hkl of the position to that requested and one for each constraint. The
+residuals and their Jacobian come from the calculator's own forward maps
+and their analytic derivatives (_anglesToHkl, _anglesToHklJacobian and
+_anglesToVirtualAnglesAndJacobian), so the equations solved are exactly
+those used to verify the result.
+
+The linear algebra is written in plain Python on lists, which for these
+small systems is faster than numpy and works under Jython.
+"""
+
+from math import sin, cos, atan2
+
+from diffcalc.hkl.you.constraints import NUNAME
+from diffcalc.hkl.you.geometry import YouPosition
+
+SMALL = 1e-8
+
+# The iteration is abandoned as stuck at a local minimum after SLOW_STEPS
+# successive steps each reducing the sum of squared residuals by less than
+# half. Near a root Newton steps converge quadratically, so this only costs
+# the multi-start search for unreachable positions.
+SLOW_STEPS = 4
+
+# Indices of the angles in a (mu, delta, nu, eta, chi, phi) tuple
+ANGLE_INDICES = {'mu': 0, 'delta': 1, NUNAME: 2, 'eta': 3, 'chi': 4,
+                 'phi': 5}
+
+
+def _solve_linear(a, b):
+    """Solve a * x = b by Gaussian elimination with partial pivoting. Return
+    None if a is singular."""
+    n = len(b)
+    m = [list(row) + [b_i] for row, b_i in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda i: abs(m[i][col]))
+        if abs(m[pivot][col]) < 1e-300:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        p = m[col]
+        for i in range(col + 1, n):
+            f = m[i][col] / p[col]
+            if f:
+                row = m[i]
+                for j in range(col, n + 1):
+                    row[j] -= f * p[j]
+    x = [0.] * n
+    for i in range(n - 1, -1, -1):
+        x[i] = (m[i][n] - sum(m[i][j] * x[j] for j in range(i + 1, n))) / m[i][i]
+    return x
+
+
+class YouEquations(object):
+    """The six residuals f(x) for x = (mu, delta, nu, eta, chi, phi) in
+    radians, and their Jacobian, for hkl and wavelength under the
+    constraints of a YouHklCalculator."""
+
+    def __init__(self, hklcalc, hkl, wavelength, constraints):
+        """constraints is a dictionary of constraint names and values as
+        found in YouConstraintManager.all"""
+        self._hklcalc = hklcalc
+        self.hkl = tuple(hkl)
+        self.wavelength = wavelength
+        self.constraints = sorted(constraints.items())
+        names = (set(constraints) - set(ANGLE_INDICES) -
+                 set(['mu_is_' + NUNAME, 'a_eq_b']))
+        if 'a_eq_b' in constraints:
+            names.update(('alpha', 'beta'))
+        self._virtual_angle_names = names
+
+    def __call__(self, x):
+        """Return the residuals and the Jacobian as a list of rows"""
+        hklcalc = self._hklcalc
+        hkl = hklcalc._anglesToHkl(YouPosition(*x), self.wavelength)
+        f = [a - b for a, b in zip(hkl, self.hkl)]
+        jacobian = list(hklcalc._anglesToHklJacobian(x, self.wavelength))
+        if self._virtual_angle_names:
+            virtual, derivatives = hklcalc._anglesToVirtualAnglesAndJacobian(
+                x, self.wavelength, self._virtual_angle_names)
+
+        for name, value in self.constraints:
+            if name in ANGLE_INDICES:
+                index = ANGLE_INDICES[name]
+                f.append(x[index] - value)
+                jacobian.append(tuple(float(i == index) for i in range(6)))
+            elif name == 'mu_is_' + NUNAME:
+                f.append(x[0] - x[2])
+                jacobian.append((1., 0., -1., 0., 0., 0.))
+            elif name == 'a_eq_b':
+                f.append(virtual['alpha'] - virtual['beta'])
+                jacobian.append(tuple(
+                    a - b for a, b in zip(derivatives['alpha'],
+                                          derivatives['beta'])))
+            elif name == 'psi':
+                # psi is read back as an arccosine, whose derivative is
+                # infinite at 0 and 180, so its cosine is matched instead
+                psi = virtual['psi']
+                f.append(cos(psi) - cos(value))
+                jacobian.append(tuple(-sin(psi) * d
+                                      for d in derivatives['psi']))
+            elif name in virtual:
+                difference = virtual[name] - value
+                f.append(atan2(sin(difference), cos(difference)))
+                jacobian.append(derivatives[name])
+            else:
+                raise ValueError('Unknown constraint: %s' % name)
+        return f, jacobian
+
+
+class LevenbergMarquardtSolver(object):
+    """Solve square systems of equations f(x) = 0 given a callable returning
+    f(x) and its Jacobian.
+
+    The number of iterations taken by the last call to solve is kept in
+    last_iterations.
+    """
+
+    def __init__(self, tolerance=1e-12, max_iterations=50):
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.last_iterations = 0
+
+    def solve(self, equations, x0):
+        """Return x with all |f(x)| < tolerance starting from x0, or None if
+        the iteration does not converge"""
+        x = list(x0)
+        n = len(x)
+        f, jacobian = equations(x)
+        cost = sum(f_i * f_i for f_i in f)
+        damping = 1e-3
+        slow = 0
+        for iteration in range(1, self.max_iterations + 1):
+            self.last_iterations = iteration
+            if max(abs(f_i) for f_i in f) < self.tolerance:
+                return x
+            # Normal equations (J'J + damping * diag(J'J)) dx = -J'f
+            columns = zip(*jacobian)
+            jtj = [[_dot_n(columns[i], columns[j]) for j in range(n)]
+                   for i in range(n)]
+            jtf = [-_dot_n(columns[i], f) for i in range(n)]
+            while True:
+                a = [row[:] for row in jtj]
+                for i in range(n):
+                    a[i][i] += damping * (jtj[i][i] + SMALL)
+                dx = _solve_linear(a, jtf)
+                if dx is None or max(abs(dx_i) for dx_i in dx) < 1e-14:
+                    return None  # stuck, probably at a local minimum
+                x_new = [x_i + dx_i for x_i, dx_i in zip(x, dx)]
+                f_new, jacobian_new = equations(x_new)
+                cost_new = sum(f_i * f_i for f_i in f_new)
+                if cost_new < cost:
+                    if cost - cost_new < 1e-6 * cost:
+                        return None  # stagnated at a local minimum
+                    slow = slow + 1 if cost_new > .5 * cost else 0
+                    if slow == SLOW_STEPS:
+                        return None  # converging too slowly to be a root
+                    x, f, jacobian, cost = x_new, f_new, jacobian_new, cost_new
+                    damping = max(damping / 10, 1e-12)
+                    break
+                damping *= 10
+                if damping > 1e12:
+                    return None
+        if max(abs(f_i) for f_i in f) < self.tolerance:
+            return x
+        return None
+
+
+def _dot_n(a, b):
+    return sum(a_i * b_i for a_i, b_i in zip(a, b))
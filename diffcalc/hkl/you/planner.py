@@ -0,0 +1,184 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Choose a constraint mode for a planned path of hkl values.
+
+Every analytically solved combination of constraints, with each constraint
+taking one of a few candidate values, is used to calculate the whole path
+with YouHklCalculator.hkl_to_angles_batch. The modes are then ranked by the
+fraction of the path they reach within limits, the number of branch flips
+between consecutive points and the total motor travel.
+"""
+
+from itertools import combinations
+from math import pi
+
+from diffcalc.hkl.you.calc import BRANCH_SWITCH_ANGLE, cut_at_minus_pi
+from diffcalc.hkl.you.constraints import ModePlan, NUNAME, det_constraints, \
+    ref_constraints, samp_constraints
+from diffcalc.hkl.you.geometry import YouPosition
+
+TORAD = pi / 180
+TODEG = 180 / pi
+
+# Values (in degrees) tried for each constraint
+CANDIDATE_VALUES = {
+    'delta': (0,), NUNAME: (0,), 'qaz': (0, 90), 'naz': (0, 90),
+    'a_eq_b': (None,), 'alpha': (0,), 'beta': (0,), 'psi': (0, 90),
+    'mu': (0,), 'eta': (0,), 'chi': (0, 90), 'phi': (0,),
+    'mu_is_' + NUNAME: (None,)}
+
+# Indices of the sample angles in a (mu, delta, nu, eta, chi, phi) position
+_SAMPLE_INDICES = (0, 3, 4, 5)
+
+
+class ModeEvaluation(object):
+    """How well one constraint mode follows a path of hkl values.
+
+    constraints maps each constraint name to its value in degrees (None for
+    those taking no value), coverage is the fraction of points reached within
+    limits, travel the total motor travel in degrees between consecutive
+    reached points and branch_flips the number of those steps in which a
+    sample angle jumps by more than BRANCH_SWITCH_ANGLE.
+    """
+
+    def __init__(self, constraints, coverage, travel, branch_flips):
+        self.constraints = constraints
+        self.coverage = coverage
+        self.travel = travel
+        self.branch_flips = branch_flips
+
+    def sort_key(self):
+        return (-self.coverage, self.branch_flips, self.travel,
+                self.con_command())
+
+    def con_command(self):
+        """Return the con command that selects this mode"""
+        args = []
+        for name in det_constraints + ref_constraints + samp_constraints:
+            if name in self.constraints:
+                args.append(name)
+                if self.constraints[name] is not None:
+                    args.append('%g' % self.constraints[name])
+        return 'con ' + ' '.join(args)
+
+    def __str__(self):
+        return '%5.1f%% %10.2f %5i   %s' % (
+            self.coverage * 100, self.travel, self.branch_flips,
+            self.con_command())
+
+
+def candidate_modes(constraint_manager, candidate_values=None):
+    """Return a list of dictionaries mapping constraint names to values in
+    degrees for every analytically solved mode, trying each value in
+    CANDIDATE_VALUES, or in candidate_values where given, for each
+    constraint.
+
+    Constraints fixed by the geometry are kept at their fixed values.
+    """
+    candidate_values = dict(CANDIDATE_VALUES, **(candidate_values or {}))
+    fixed = _in_degrees(dict(
+        (name, value) for name, value in constraint_manager.all.items()
+        if constraint_manager.is_constraint_fixed(name)))
+
+    def choices(column):
+        return [name for name in column
+                if name in fixed or
+                not constraint_manager.is_constraint_fixed(name)]
+    detector = choices(det_constraints)
+    reference = choices(ref_constraints)
+    sample = choices(samp_constraints)
+
+    modes = []
+    for det in detector + [None]:
+        for ref in reference + [None]:
+            n_sample = 3 - (det is not None) - (ref is not None)
+            for samp in combinations(sample, n_sample):
+                names = [name for name in (det, ref) if name] + list(samp)
+                if [name for name in fixed if name not in names]:
+                    continue
+                for constraints in _with_values(names, fixed,
+                                                candidate_values):
+                    plan = ModePlan(_in_radians(constraints))
+                    if plan.implemented:
+                        modes.append(constraints)
+    return modes
+
+
+def _with_values(names, fixed, candidate_values):
+    """Return each combination of candidate values for names"""
+    combos = [{}]
+    for name in names:
+        if name in fixed:
+            values = (fixed[name],)
+        else:
+            values = candidate_values[name]
+        combos = [dict(combo, **{name: value})
+                  for combo in combos for value in values]
+    return combos
+
+
+def _in_radians(constraints):
+    return dict((name, value * TORAD if value is not None else None)
+                for name, value in constraints.items())
+
+
+def _in_degrees(constraints):
+    return dict((name, value * TODEG if value is not None else None)
+                for name, value in constraints.items())
+
+
+def evaluate_modes(hklcalc, hkl_list, wavelength, candidate_values=None):
+    """Return a ModeEvaluation for each analytically solved mode following
+    the path hkl_list, a list of (h, k, l) values, at wavelength in
+    Angstroms, best first.
+
+    The modes are calculated on a scratch calculator, so the constraints,
+    cache, statistics and tracking state of hklcalc are left untouched.
+    Requires numpy.
+    """
+    scratch = hklcalc._scratch_calculator({})
+    evaluations = []
+    for constraints in candidate_modes(hklcalc.constraints, candidate_values):
+        scratch.constraints._constrained = _in_radians(constraints)
+        positions, _, status = scratch.hkl_to_angles_batch(hkl_list,
+                                                           wavelength)
+        evaluations.append(_evaluate_path(
+            scratch, constraints, positions.tolist(), status.tolist()))
+    evaluations.sort(key=ModeEvaluation.sort_key)
+    return evaluations
+
+
+def _evaluate_path(hklcalc, constraints, positions, status):
+    reached = []
+    for pos, point_status in zip(positions, status):
+        if point_status:
+            continue
+        pos = [v * TORAD for v in pos]
+        if hklcalc._is_position_within_limits(YouPosition(*pos)):
+            reached.append(pos)
+
+    travel = 0.
+    branch_flips = 0
+    for previous, pos in zip(reached[:-1], reached[1:]):
+        steps = [abs(cut_at_minus_pi(a - b)) for a, b in zip(pos, previous)]
+        travel += sum(steps) * TODEG
+        if [i for i in _SAMPLE_INDICES if steps[i] > BRANCH_SWITCH_ANGLE]:
+            branch_flips += 1
+    coverage = float(len(reached)) / len(positions) if positions else 0.
+    return ModeEvaluation(constraints, coverage, travel, branch_flips)
@@ -0,0 +1,159 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Equivalent positions (sectors) for the You geometry.
+
+Each sector maps a position (mu, delta, nu, eta, chi, phi) to one with the
+same sample rotation Z = MU * ETA * CHI * PHI, and therefore the same hkl
+and virtual angles. ETA * CHI * PHI is unchanged by (eta + 180, -chi,
+phi + 180) as Rz(180) * Ry(-chi) * Rz(180) = Ry(chi). (The detector
+position (180 - delta, nu + 180) scatters in the same direction too, but
+the virtual angles are calculated for the nu branch the solver chooses, so
+it is not included.)
+
+Sectors are tabulated as a sign and an offset (in degrees) for each angle,
+so that all the equivalents of an array of positions can be evaluated
+against the limits and cuts at once. Requires numpy unless only sector 0
+is used.
+
+There are no auto sectors: the solver already tries the sample flip among
+its candidate solutions, and keeps the one closest to all zeros of those
+within limits.
+"""
+
+try:
+    import numpy as np
+    from diffcalc.hkl.you.batch import _cut_angle_at
+except ImportError:
+    np = None
+
+from diffcalc.hkl.you.constraints import NUNAME
+from diffcalc.util import DiffcalcException
+
+ANGLE_NAMES = ('mu', 'delta', NUNAME, 'eta', 'chi', 'phi')
+
+# sector: (description, signs, offsets) for (mu, delta, nu, eta, chi, phi)
+SECTORS = {
+    0: ('no transform',
+        (1, 1, 1, 1, 1, 1), (0, 0, 0, 0, 0, 0)),
+    1: ('sample flip: eta + 180, -chi, phi + 180',
+        (1, 1, 1, 1, -1, 1), (0, 0, 0, 180, 0, 180)),
+}
+
+SMALL = 1e-8
+
+
+def _check_sector(sector):
+    if sector not in SECTORS:
+        raise ValueError('%r must be one of %s' % (sector, sorted(SECTORS)))
+
+
+def equivalent_positions(positions, sectors):
+    """Return an N*K*6 array of the equivalents under each of K sectors of
+    an N*6 array of positions in degrees"""
+    signs = np.array([SECTORS[sector][1] for sector in sectors], dtype=float)
+    offsets = np.array([SECTORS[sector][2] for sector in sectors],
+                       dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    return positions[:, np.newaxis, :] * signs + offsets
+
+
+def _cut_at_minus_180(value):
+    return (value + 180.) % 360. - 180.
+
+
+def _within_limits(equivalents, limits):
+    """Return a mask of the equivalents with every angle within limits, a
+    dictionary of (cut, lower, upper) tuples for each hardware axis"""
+    okay = np.isfinite(equivalents).all(axis=-1)
+    for i, name in enumerate(ANGLE_NAMES):
+        if name not in limits:
+            continue
+        cut, lower, upper = limits[name]
+        value = equivalents[..., i]
+        if cut is not None:
+            value = _cut_angle_at(cut, value)
+        if lower is not None:
+            okay &= ~(value < lower)
+        if upper is not None:
+            okay &= ~(value > upper)
+    return okay
+
+
+class YouTransformSelector(object):
+    """Moves each solution into the selected sector.
+
+    The position in the selected sector is used if it is within limits and
+    leaves the angles fixed by constraints unchanged; otherwise the solution
+    is left as calculated.
+    """
+
+    def __init__(self):
+        self.sector = 0
+
+    def set_sector(self, sector):
+        _check_sector(sector)
+        if sector and np is None:
+            raise DiffcalcException('Sectors require numpy')
+        self.sector = sector
+
+    @property
+    def active(self):
+        return bool(self.sector)
+
+    def state(self):
+        """Return a hashable summary of the selection settings"""
+        return self.sector
+
+    def select(self, positions, limits, constrained_names=()):
+        """Return an N*6 array of chosen positions and N chosen sectors
+        for an N*6 array of positions in degrees, given the hardware limits
+        as a dictionary of (cut, lower, upper) tuples for each axis and the
+        names of the angles fixed by constraints."""
+        positions = np.asarray(positions, dtype=float)
+        equivalents = equivalent_positions(positions, [self.sector])
+
+        candidates = _within_limits(equivalents, limits)
+        for i, name in enumerate(ANGLE_NAMES):
+            if name in constrained_names:
+                change = _cut_at_minus_180(equivalents[..., i] -
+                                           positions[:, np.newaxis, i])
+                candidates &= np.abs(change) < SMALL
+        transformed = candidates[:, 0]
+
+        chosen = np.where(transformed[:, np.newaxis], equivalents[:, 0],
+                          positions)
+        chosen_sectors = np.where(transformed, self.sector, 0)
+        return chosen, chosen_sectors
+
+    def transform_position(self, pos, limits, constrained_names=()):
+        """Return the chosen equivalent of YouPosition pos in degrees"""
+        if not self.active:
+            return pos
+        chosen, _ = self.select([pos.totuple()], limits, constrained_names)
+        pos = pos.clone()
+        (pos.mu, pos.delta, pos.nu, pos.eta, pos.chi,
+         pos.phi) = [float(v) for v in chosen[0]]
+        return pos
+
+    def __repr__(self):
+        lines = ['Sectors (equivalent positions):']
+        for sector in sorted(SECTORS):
+            flag = '*' if sector == self.sector else ' '
+            lines.append('  %s %i %s' % (flag, sector, SECTORS[sector][0]))
+        return '\n'.join(lines)
@@ -0,0 +1,238 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+"""Closed form rotation products used by the diffractometer engines.
+
+Each sample rotation stack (e.g. Z = MU * ETA * CHI * PHI in You's paper) is
+written out directly from the sines and cosines of its angles rather than by
+multiplying the individual rotation matrices together. As these are
+rotations, the inverse of each is its transpose.
+
+The *_rows functions return the matrix elements as nested tuples, and the
+*_derivatives functions those of their derivatives with respect to each
+angle. They take the sin and cos functions to use, so that the same
+expressions can be evaluated elementwise over numpy arrays.
+"""
+
+from math import sin, cos
+
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+
+
+def _transpose(rows):
+    return tuple(zip(*rows))
+
+
+### You ###
+
+def you_sample_rows(mu, eta, chi, phi, sin=sin, cos=cos):
+    """Return the rows of Z = MU * ETA * CHI * PHI"""
+    sm, cm = sin(mu), cos(mu)
+    se, ce = sin(eta), cos(eta)
+    sc, cc = sin(chi), cos(chi)
+    sp, cp = sin(phi), cos(phi)
+    # ETA * CHI * PHI
+    a0 = ce * cc * cp - se * sp, ce * cc * sp + se * cp, ce * sc
+    a1 = -se * cc * cp - ce * sp, -se * cc * sp + ce * cp, -se * sc
+    a2 = -sc * cp, -sc * sp, cc
+    return (a0,
+            (cm * a1[0] - sm * a2[0], cm * a1[1] - sm * a2[1],
+             cm * a1[2] - sm * a2[2]),
+            (sm * a1[0] + cm * a2[0], sm * a1[1] + cm * a2[1],
+             sm * a1[2] + cm * a2[2]))
+
+
+def you_sample_rows_derivatives(mu, eta, chi, phi, sin=sin, cos=cos):
+    """Return the rows of dZ/dmu, dZ/deta, dZ/dchi and dZ/dphi"""
+    sm, cm = sin(mu), cos(mu)
+    a, d_eta, d_chi, d_phi = _z_y_z_rows_and_derivatives(eta, chi, phi, sin,
+                                                         cos)
+
+    def times_MU(b):
+        return (b[0],
+                tuple(cm * b[1][j] - sm * b[2][j] for j in range(3)),
+                tuple(sm * b[1][j] + cm * b[2][j] for j in range(3)))
+    d_mu = ((0., 0., 0.),
+            tuple(-sm * a[1][j] - cm * a[2][j] for j in range(3)),
+            tuple(cm * a[1][j] - sm * a[2][j] for j in range(3)))
+    return d_mu, times_MU(d_eta), times_MU(d_chi), times_MU(d_phi)
+
+
+def you_sample_rotation(mu, eta, chi, phi):
+    """Return Z = MU * ETA * CHI * PHI, taking phi frame vectors to the lab
+    frame"""
+    return matrix(you_sample_rows(mu, eta, chi, phi))
+
+
+def you_sample_rotation_inverse(mu, eta, chi, phi):
+    """Return Z.I = PHI.I * CHI.I * ETA.I * MU.I, taking lab frame vectors to
+    the phi frame"""
+    return matrix(_transpose(you_sample_rows(mu, eta, chi, phi)))
+
+
+def you_q_lab(delta, nu, sin=sin, cos=cos):
+    """Return the components of (NU * DELTA - I) * [0, 1, 0], the scattering
+    vector in the lab frame in units of the wavevector (Equation 12)"""
+    return sin(delta), cos(delta) * cos(nu) - 1, cos(delta) * sin(nu)
+
+
+def you_q_lab_derivatives(delta, nu, sin=sin, cos=cos):
+    """Return the derivatives of you_q_lab with respect to delta and nu"""
+    sd, cd = sin(delta), cos(delta)
+    sn, cn = sin(nu), cos(nu)
+    return (cd, -sd * cn, -sd * sn), (0., -cd * sn, cd * cn)
+
+
+### Vlieg ###
+
+def vlieg_sample_rows(omega, chi, phi, sin=sin, cos=cos):
+    """Return the rows of OMEGA * CHI * PHI"""
+    so, co = sin(omega), cos(omega)
+    sc, cc = sin(chi), cos(chi)
+    sp, cp = sin(phi), cos(phi)
+    return ((co * cc * cp - so * sp, co * cc * sp + so * cp, co * sc),
+            (-so * cc * cp - co * sp, -so * cc * sp + co * cp, -so * sc),
+            (-sc * cp, -sc * sp, cc))
+
+
+def vlieg_sample_rows_derivatives(omega, chi, phi, sin=sin, cos=cos):
+    """Return the rows of the derivatives of OMEGA * CHI * PHI with respect
+    to omega, chi and phi"""
+    return _z_y_z_rows_and_derivatives(omega, chi, phi, sin, cos)[1:]
+
+
+def vlieg_sample_rotation(omega, chi, phi):
+    """Return OMEGA * CHI * PHI, taking phi frame vectors to the alpha
+    frame"""
+    return matrix(vlieg_sample_rows(omega, chi, phi))
+
+
+def vlieg_sample_rotation_inverse(omega, chi, phi):
+    """Return PHI.I * CHI.I * OMEGA.I, taking alpha frame vectors to the phi
+    frame"""
+    return matrix(_transpose(vlieg_sample_rows(omega, chi, phi)))
+
+
+def vlieg_q_alpha(alpha, delta, gamma, sin=sin, cos=cos):
+    """Return the components of (DELTA * GAMMA - ALPHA.I) * [0, 1, 0], the
+    scattering vector in the alpha frame in units of the wavevector"""
+    cg = cos(gamma)
+    return (cg * sin(delta), cg * cos(delta) - cos(alpha),
+            sin(gamma) + sin(alpha))
+
+
+def vlieg_q_alpha_derivatives(alpha, delta, gamma, sin=sin, cos=cos):
+    """Return the derivatives of vlieg_q_alpha with respect to alpha, delta
+    and gamma"""
+    sa, ca = sin(alpha), cos(alpha)
+    sd, cd = sin(delta), cos(delta)
+    sg, cg = sin(gamma), cos(gamma)
+    return ((0., sa, ca),
+            (cg * cd, -cg * sd, 0.),
+            (-sg * sd, -sg * cd, cg))
+
+
+### Willmott ###
+
+def willmott_sample_rows(omegah, phi, sin=sin, cos=cos):
+    """Return the rows of OMEGAH * PHI"""
+    so, co = sin(omegah), cos(omegah)
+    sp, cp = sin(phi), cos(phi)
+    return ((cp, -sp, 0.),
+            (co * sp, co * cp, -so),
+            (so * sp, so * cp, co))
+
+
+def willmott_sample_rows_derivatives(omegah, phi, sin=sin, cos=cos):
+    """Return the rows of the derivatives of OMEGAH * PHI with respect to
+    omegah and phi"""
+    so, co = sin(omegah), cos(omegah)
+    sp, cp = sin(phi), cos(phi)
+    return (((0., 0., 0.),
+             (-so * sp, -so * cp, -co),
+             (co * sp, co * cp, -so)),
+            ((-sp, -cp, 0.),
+             (co * cp, -co * sp, 0.),
+             (so * cp, -so * sp, 0.)))
+
+
+def willmott_sample_rotation(omegah, phi):
+    """Return OMEGAH * PHI, taking phi frame vectors to the lab frame"""
+    return matrix(willmott_sample_rows(omegah, phi))
+
+
+def willmott_sample_rotation_inverse(omegah, phi):
+    """Return PHI.I * OMEGAH.I, taking lab frame vectors to the phi frame"""
+    return matrix(_transpose(willmott_sample_rows(omegah, phi)))
+
+
+def willmott_h_lab(delta, gamma, sin=sin, cos=cos):
+    """Return the components of (GAMMA * DELTA - I) * [0, 1, 0], the
+    scattering vector in the lab frame in units of the wavevector
+    (Equation 43)"""
+    cd = cos(delta)
+    return -sin(gamma) * cd, cos(gamma) * cd - 1, sin(delta)
+
+
+def willmott_h_lab_derivatives(delta, gamma, sin=sin, cos=cos):
+    """Return the derivatives of willmott_h_lab with respect to delta and
+    gamma"""
+    sd, cd = sin(delta), cos(delta)
+    sg, cg = sin(gamma), cos(gamma)
+    return (sg * sd, -cg * sd, cd), (-cg * cd, -sg * cd, 0.)
+
+
+### Shared ###
+
+def _z_y_z_rows_and_derivatives(eta, chi, phi, sin, cos):
+    """Return the rows of ETA * CHI * PHI in You's paper (OMEGA * CHI * PHI
+    in Vlieg's) and of its derivatives with respect to each angle"""
+    se, ce = sin(eta), cos(eta)
+    sc, cc = sin(chi), cos(chi)
+    sp, cp = sin(phi), cos(phi)
+    a0 = ce * cc * cp - se * sp, ce * cc * sp + se * cp, ce * sc
+    a1 = -se * cc * cp - ce * sp, -se * cc * sp + ce * cp, -se * sc
+    a2 = -sc * cp, -sc * sp, cc
+    d_eta = a1, (-a0[0], -a0[1], -a0[2]), (0., 0., 0.)
+    d_chi = ((-ce * sc * cp, -ce * sc * sp, ce * cc),
+             (se * sc * cp, se * sc * sp, -se * cc),
+             (-cc * cp, -cc * sp, -sc))
+    d_phi = ((-ce * cc * sp - se * cp, ce * cc * cp - se * sp, 0.),
+             (se * cc * sp - ce * cp, -se * cc * cp - ce * sp, 0.),
+             (sc * sp, -sc * cp, 0.))
+    return (a0, a1, a2), d_eta, d_chi, d_phi
+
+
+def rows_times(rows, v):
+    """Return the components of M * v from the rows of M"""
+    return tuple(row[0] * v[0] + row[1] * v[1] + row[2] * v[2]
+                 for row in rows)
+
+
+def rows_transpose_times(rows, v):
+    """Return the components of M.T * v from the rows of M"""
+    return tuple(rows[0][j] * v[0] + rows[1][j] * v[1] + rows[2][j] * v[2]
+                 for j in range(3))
+
+
+def column(components):
+    """Return a 3*1 column matrix"""
+    return matrix([[components[0]], [components[1]], [components[2]]])
@@ -21,7 +21,7 @@ from diffcalc.ub.calcstate import UBCalcState
 from diffcalc.ub.crystal import CrystalUnderTest
 from diffcalc.ub.reflections import ReflectionList
 from diffcalc.ub.persistence import UBCalculationJSONPersister, UBCalculationPersister
-from diffcalc.util import DiffcalcException, cross3, dot3, bold
+from diffcalc.util import DiffcalcException, cross3, dot3, bold, bound
 from math import acos, cos, sin, pi
 from diffcalc.ub.reference import YouReference
 
@@ -89,6 +89,8 @@ class UBCalculation:
         self._strategy = strategy
         self.include_sigtau = include_sigtau
         self.include_reference = include_reference
+        self._version = 0
+        self._derived = {}
         self._clear()
         
     def _get_diffractometer_axes_names(self):
@@ -104,6 +106,26 @@ class UBCalculation:
         self._U = None
         self._UB = None
         self._state.configure_calc_type()
+        self._changed()
+
+    def _changed(self):
+        # Called whenever U, UB, the lattice or the reference vector changes
+        self._version += 1
+        self._derived = {}
+
+    @property
+    def version(self):
+        """A number that is incremented whenever U, UB, the lattice or the
+        reference vector changes. Anything derived from these may be reused
+        until it changes."""
+        return self._version
+
+    def _get_derived(self, name, calculate):
+        try:
+            return self._derived[name]
+        except KeyError:
+            value = self._derived[name] = calculate()
+            return value
 
 ### State ###
     def start_new(self, name):
@@ -126,6 +148,7 @@ class UBCalculation:
             self._state = state
         else:
             raise Exception('Unexpected persister type: ' + str(self._persister))
+        self._changed()
         if self._state.manual_U is not None:
             self.set_U_manually(self._state.manual_U)
         elif self._state.manual_UB is not None:
@@ -296,6 +319,7 @@ class UBCalculation:
                 "Cannot set lattice until a UBCalcaluation has been started "
                 "with newubcalc")
         self._state.crystal = CrystalUnderTest(name, a, b, c, alpha, beta, gamma)
+        self._changed()
         # Clear U and UB if these exist
         if self._U is not None:  # (UB will also exist)
             print "Warning: the old UB calculation has been cleared."
@@ -313,6 +337,7 @@ class UBCalculation:
 
     def _settau(self, tau):
         self._state.tau = tau
+        self._changed()
         self.save()
 
     tau = property(_gettau, _settau)
@@ -335,16 +360,18 @@ class UBCalculation:
 ### Reference vector ###
 
     def _get_n_phi(self):
-        return self._state.reference.n_phi
+        return self._get_derived('n_phi', lambda: self._state.reference.n_phi)
     
     n_phi = property(_get_n_phi)
     
     def set_n_phi_configured(self, n_phi):
         self._state.reference.n_phi_configured = n_phi
+        self._changed()
         self.save()
         
     def set_n_hkl_configured(self, n_hkl):
         self._state.reference.n_hkl_configured = n_hkl
+        self._changed()
         self.save()
         
     def print_reference(self):
@@ -452,6 +479,7 @@ class UBCalculation:
             raise DiffcalcException(
                 "A crystal must be specified before manually setting U")
         self._UB = self._U * self._state.crystal.B
+        self._changed()
         print ("NOTE: A new UB matrix will not be automatically calculated "
                "when the orientation reflections are modified.")
         self.save()
@@ -468,6 +496,7 @@ class UBCalculation:
 
         self._state.configure_calc_type(manual_UB=m)
         self._UB = m
+        self._changed()
         self.save()
 
     @property
@@ -481,6 +510,34 @@ class UBCalculation:
     def UB(self):
         return self._get_UB()
     
+    @property
+    def UB_inv(self):
+        """The inverse of UB, cached until UB changes"""
+        return self._get_derived('UB_inv', lambda: self._get_UB().I)
+
+    @property
+    def U_inv(self):
+        """The inverse of U, cached until U changes"""
+        return self._get_derived('U_inv', lambda: self.U.I)
+
+    @property
+    def B_inv(self):
+        """The inverse of B, cached until the lattice changes"""
+        return self._get_derived('B_inv', lambda: self._get_B().I)
+
+    @property
+    def metric_tensor(self):
+        """The reciprocal lattice metric tensor B.T * B, so that |Q|**2 =
+        hkl.T * G * hkl, cached until the lattice changes"""
+        return self._get_derived('metric_tensor',
+                                 lambda: self._get_B().T * self._get_B())
+
+    def _get_B(self):
+        if self._state.crystal is None:
+            raise DiffcalcException(
+                "No lattice has been set during this ub calculation")
+        return self._state.crystal.B
+
     def is_ub_calculated(self):
         return self._UB is not None
 
@@ -563,6 +620,7 @@ class UBCalculation:
         self._state.configure_calc_type(or0=1, or1=2)
         self._U = Tp * Tc.I
         self._UB = self._U * B
+        self._changed()
         self.save()
 
     def calculate_UB_from_primary_only(self):
@@ -594,9 +652,15 @@ class UBCalculation:
         q_measured_phi = q_measured_phi * (1 / norm(q_measured_phi))
 
         rotation_axis = cross3(h_crystal, q_measured_phi)
+        if norm(rotation_axis) < SMALL:
+            # h_crystal and q_measured_phi are (anti)parallel, so any axis
+            # perpendicular to them will do
+            rotation_axis = cross3(h_crystal, matrix([[0], [0], [1]]))
+            if norm(rotation_axis) < SMALL:
+                rotation_axis = cross3(h_crystal, matrix([[1], [0], [0]]))
         rotation_axis = rotation_axis * (1 / norm(rotation_axis))
 
-        cos_rotation_angle = dot3(h_crystal, q_measured_phi)
+        cos_rotation_angle = bound(dot3(h_crystal, q_measured_phi))
         rotation_angle = acos(cos_rotation_angle)
 
         uvw = rotation_axis.T.tolist()[0]  # TODO: cleanup
@@ -629,6 +693,7 @@ class UBCalculation:
         
         self._U = matrix(m)
         self._UB = self._U * B
+        self._changed()
 
         self.save()
 
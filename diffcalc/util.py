@@ -18,8 +18,16 @@
 
 from math import pi, acos, cos, sin
 from functools import wraps
+from collections import OrderedDict
+from bisect import bisect_left
+from timeit import default_timer
 import textwrap
 
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
 try:
     from gda.jython.commands.InputCommands import requestInput as raw_input
     GDA = True
@@ -97,16 +105,16 @@ class DiffcalcException(Exception):
 
 
 class AbstractPosition(object):
+    """A diffractometer position. Subclasses store their angles in
+    __slots__, and are constructed from the angles in totuple() order."""
+
+    __slots__ = ()
 
     def inRadians(self):
-        pos = self.clone()
-        pos.changeToRadians()
-        return pos
+        return self.__class__(*[v * TORAD for v in self.totuple()])
 
     def inDegrees(self):
-        pos = self.clone()
-        pos.changeToDegrees()
-        return pos
+        return self.__class__(*[v * TODEG for v in self.totuple()])
 
     def changeToRadians(self):
         raise NotImplementedError()
@@ -117,6 +125,13 @@ class AbstractPosition(object):
     def totuple(self):
         raise NotImplementedError()
 
+    # Objects with __slots__ and no __dict__ need these to be pickled
+    def __getstate__(self):
+        return self.totuple()
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
 
 ### Matrices
 
@@ -345,3 +360,210 @@ def call_command(f, args):
     except DiffcalcException, e:
         # TODO: log and create a new one to shorten stack trace for user
         raise DiffcalcException(e.message)
+
+
+### Caching
+
+class LRUCache(object):
+    """A bounded least-recently-used cache with hit and miss counts.
+
+    A maxsize of 0 disables the cache: nothing is stored and lookups are not
+    counted.
+    """
+
+    def __init__(self, maxsize=0):
+        self._entries = OrderedDict()
+        self._maxsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.maxsize = maxsize
+
+    def _get_maxsize(self):
+        return self._maxsize
+
+    def _set_maxsize(self, maxsize):
+        if int(maxsize) < 0:
+            raise ValueError('Cache size must be zero or more')
+        self._maxsize = int(maxsize)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    maxsize = property(_get_maxsize, _set_maxsize)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        if not self._maxsize:
+            return default
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value  # now most recently used
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self._maxsize:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all entries, counting this as an invalidation"""
+        if self._entries:
+            self.invalidations += 1
+        self._entries.clear()
+
+    def reset_statistics(self):
+        self.hits = self.misses = self.invalidations = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        if self._maxsize == 0:
+            return 'cache disabled'
+        hit_rate = (100. * self.hits / lookups) if lookups else 0.
+        return ('%i/%i entries, %i hits, %i misses (%.1f%% hit rate), '
+                '%i invalidations' % (len(self), self._maxsize, self.hits,
+                                      self.misses, hit_rate,
+                                      self.invalidations))
+
+
+### Timing
+
+# Upper edges (s) of the timing histogram bins, doubling from 1 microsecond;
+# a last bin holds longer times
+TIMING_BIN_EDGES = tuple(1e-6 * 2 ** i for i in range(24))
+
+
+class TimingHistogram(object):
+    """Count, total, extremes and a histogram of the times taken by a stage"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+        self.bins = [0] * (len(TIMING_BIN_EDGES) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        self.bins[bisect_left(TIMING_BIN_EDGES, seconds)] += 1
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def todict(self):
+        edges = list(TIMING_BIN_EDGES) + [None]
+        return {'count': self.count, 'total': self.total, 'mean': self.mean,
+                'min': self.min, 'max': self.max,
+                'histogram': [(edge, n) for edge, n in zip(edges, self.bins)
+                              if n]}
+
+
+class _StageTimer(object):
+
+    def __init__(self, timers, stage):
+        self._timers = timers
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = default_timer()
+
+    def __exit__(self, *exc_info):
+        self._timers.record(self._stage, default_timer() - self._start)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageTimers(object):
+    """Timing histograms for named stages of a calculation.
+
+    Disabled by default, when timing a stage costs only a check of enabled.
+    Stages are timed with a with statement using time(stage), or by
+    decorating a function with timed(stage).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+
+    def time(self, stage):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _StageTimer(self, stage)
+
+    def record(self, stage, seconds):
+        try:
+            histogram = self.stages[stage]
+        except KeyError:
+            histogram = self.stages[stage] = TimingHistogram()
+        histogram.add(seconds)
+
+    def reset(self):
+        self.stages = {}
+
+    def snapshot(self):
+        """Return a dictionary of the statistics for each stage, with times
+        in seconds. Histograms are lists of (upper bin edge, count) pairs
+        for the bins with counts; the last edge is None."""
+        return dict((stage, histogram.todict())
+                    for stage, histogram in self.stages.items())
+
+    def dump_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.snapshot(), f, indent=4, sort_keys=True)
+
+    def __str__(self):
+        if not self.stages:
+            return 'no stages timed'
+        width = max(len(stage) for stage in self.stages)
+        lines = ['%s %8s %10s %10s %10s %10s' % (
+            'stage'.ljust(width), 'count', 'total ms', 'mean ms', 'min ms',
+            'max ms')]
+        for stage in sorted(self.stages):
+            histogram = self.stages[stage]
+            lines.append('%s %8i %10.3f %10.4f %10.4f %10.4f' % (
+                stage.ljust(width), histogram.count, histogram.total * 1e3,
+                histogram.mean * 1e3, histogram.min * 1e3,
+                histogram.max * 1e3))
+        return '\n'.join(lines)
+
+
+stage_timers = StageTimers()
+
+
+def timed(stage):
+    """A decorator timing calls to a function as stage in stage_timers"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            if not stage_timers.enabled:
+                return f(*args, **kwds)
+            start = default_timer()
+            try:
+                return f(*args, **kwds)
+            finally:
+                stage_timers.record(stage, default_timer() - start)
+        return wrapper
+    return decorator
@@ -1,9 +1,13 @@
 
 from math import pi
 
+import pytest
+
 try:
+    import numpy
     from numpy import matrix
 except ImportError:
+    numpy = None
     from numjy import matrix
 from test.tools import mneq_, aneq_, dneq_
 
@@ -80,6 +84,31 @@ def test_hkl_to_angles():
     aneq_(angles_calc, angles)
     dneq_(param_calc, param)
     
+@pytest.mark.skipif(numpy is None, reason='requires numpy')
+def test_hkl_to_angles_vs_energy():
+    dc.con('a_eq_b')
+    dc.con('mu', 0)
+    dc.con(NUNAME, 0)
+
+    results = dc.hkl_to_angles_vs_energy([1, 0, 0], [en, en / 4])
+    angles_calc, param_calc = results[0]
+    aneq_(angles_calc, angles)
+    dneq_(param_calc, param)
+    assert results[1] is None  # beyond the Ewald sphere
+
+@pytest.mark.skipif(numpy is None, reason='requires numpy')
+def test_hkl_list_to_angles():
+    dc.con('a_eq_b')
+    dc.con('mu', 0)
+    dc.con(NUNAME, 0)
+
+    results = dc.hkl_list_to_angles([[1, 0, 0], [4, 0, 0], [0, 1, 0]])
+    angles_calc, param_calc = results[0]
+    aneq_(angles_calc, angles)
+    dneq_(param_calc, param)
+    assert results[1] is None  # beyond the Ewald sphere
+    aneq_(results[2][0], dc.hkl_to_angles(0, 1, 0)[0])
+
 def test_allhkl():
     diffcalc.util.DEBUG = True
     dc.con('eta', 0, 'chi', 0, 'phi', 0)
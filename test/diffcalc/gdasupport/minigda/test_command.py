@@ -16,11 +16,21 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+import threading
 import unittest
+
+import pytest
+
 import diffcalc.gdasupport.minigda.command
-from diffcalc.gdasupport.minigda.command import Pos, Scan, ScanDataPrinter
+from diffcalc.gdasupport.minigda.command import Pos, Scan, ScanDataPrinter, \
+    PipelinedScan, PrecomputedScan, ScanDataHandler
 from diffcalc.gdasupport.minigda.scannable import \
-    MultiInputExtraFieldsDummyScannable, SingleFieldDummyScannable
+    MultiInputExtraFieldsDummyScannable, SingleFieldDummyScannable, \
+    ScannableGroup
+from diffcalc.gdasupport.scannable.hkl import Hkl
+from diffcalc.gdasupport.scannable.wavelength import Wavelength
+from diffcalc.util import DiffcalcException
+from test.tools import assert_array_almost_equal
 
 
 class BadSingleFieldDummyScannable(SingleFieldDummyScannable):
@@ -136,3 +146,326 @@ class TestScan(object):
         scn6 = SingleFieldDummyScannable('scn6')
         scn6.setLevel(6)
         self.scan.__call__(scn5a, 1, 3, 1, scn6, 1, scn5b, scn4)
+
+
+class RecordingDataHandler(ScanDataHandler):
+
+    def __init__(self, scannable):
+        self.scannable = scannable
+        self.points = []
+        self.started = False
+        self.ended = False
+
+    def callAtScanStart(self, scannables):
+        self.started = True
+
+    def callWithScanPoint(self, position_dict):
+        self.points.append(position_dict[self.scannable])
+
+    def callAtScanEnd(self):
+        self.ended = True
+
+
+class FakeDiffcalc(object):
+    """Solves hkl to its value times the energy (initially 10), failing for
+    h > 1"""
+
+    def __init__(self):
+        self.calls = []
+        self.en = SingleFieldDummyScannable('en', 10.)
+        self.en.setLevel(3)
+
+    def hkl_to_angles(self, h, k, l, seed=None, energy=None):
+        self.calls.append(((h, k, l), seed, threading.currentThread(),
+                           energy))
+        if h > 1:
+            raise DiffcalcException('hkl unreachable')
+        if energy is None:
+            energy = self.en.getPosition()
+        return [h * energy, k * energy, l * energy], {}
+
+    def angles_to_hkl(self, pos, virtual_angle_names=None):
+        return [v / self.en.getPosition() for v in pos], {}
+
+
+class TestPipelinedScan(object):
+
+    def setup_method(self):
+        self.diffcalc = FakeDiffcalc()
+        self.axes = ScannableGroup('axes', [SingleFieldDummyScannable(name)
+                                            for name in ('a', 'b', 'c')])
+        self.hkl = Hkl('hkl', self.axes, self.diffcalc)
+        self.hkl.asynchronousMoveTo([0, 0, 1])
+
+    def test_frange_generator(self):
+        generator = PipelinedScan([])._frangeGenerator(1, 1.3, .1)
+        assert next(generator) == 1
+        assert list(generator) == [1.1, 1.2, 1.3]
+
+    def test_same_points_as_scan(self):
+        scn4 = SingleFieldDummyScannable('scn4')
+        scn5 = SingleFieldDummyScannable('scn5')
+        scn6 = SingleFieldDummyScannable('scn6')
+        scanargs = (scn5, 1, 3, 1, scn6, 1, 2, .5, scn4, 7)
+        expected_handler = RecordingDataHandler(scn6)
+        Scan([expected_handler])(*scanargs)
+        handler = RecordingDataHandler(scn6)
+        PipelinedScan([handler])(*scanargs)
+        assert handler.points == expected_handler.points
+        assert len(handler.points) == 9
+        assert handler.ended
+
+    def test_hkl_solved_on_worker_thread(self):
+        handler = RecordingDataHandler(self.hkl.h)
+        self.diffcalc.calls = []
+        PipelinedScan([handler])(self.hkl.h, 0, 1, .5)
+        assert handler.points == [0, .5, 1]
+        assert [call[0] for call in self.diffcalc.calls] == [
+            (0, 0, 1), (.5, 0, 1), (1, 0, 1)]
+        for _, _, thread, _ in self.diffcalc.calls:
+            assert thread is not threading.currentThread()
+        assert self.axes.getPosition() == [10, 0, 10]
+
+    def test_nested_field_moves_merged(self):
+        h_handler = RecordingDataHandler(self.hkl.h)
+        k_handler = RecordingDataHandler(self.hkl.k)
+        self.diffcalc.calls = []
+        PipelinedScan([h_handler, k_handler])(self.hkl.h, 0, 1, 1,
+                                              self.hkl.k, 0, 1, 1)
+        assert [call[0] for call in self.diffcalc.calls] == [
+            (0, 0, 1), (0, 1, 1), (1, 0, 1), (1, 1, 1)]
+        assert h_handler.points == [0, 0, 1, 1]
+        assert k_handler.points == [0, 1, 0, 1]
+
+    def test_tracking_seeds_with_previous_point(self):
+        self.hkl.tracking = True
+        self.diffcalc.calls = []
+        handler = RecordingDataHandler(self.hkl.h)
+        PipelinedScan([handler])(self.hkl.h, 0, 1, .5)
+        assert [call[1] for call in self.diffcalc.calls] == [
+            [0, 0, 10], [0, 0, 10], [5, 0, 10]]
+
+    def test_energy_scan_solved_ahead(self):
+        en = self.diffcalc.en
+        hkl = Hkl('hkl', self.axes, self.diffcalc, energyScannable=en)
+        handler = RecordingDataHandler(hkl)
+        self.diffcalc.calls = []
+        PipelinedScan([handler])(en, 10, 12, 1, hkl, [1, 0, 1])
+        assert handler.points == [[1, 0, 1]] * 3
+        assert [call[3] for call in self.diffcalc.calls] == [10, 11, 12]
+        for call in self.diffcalc.calls:
+            assert call[2] is not threading.currentThread()
+
+    def test_wavelength_scan_solved_ahead(self):
+        en = self.diffcalc.en
+        wl = Wavelength('wl', en)
+        wl.setLevel(3)
+        hkl = Hkl('hkl', self.axes, self.diffcalc, energyScannable=en)
+        self.diffcalc.calls = []
+        PipelinedScan([RecordingDataHandler(hkl)])(wl, 1, 2, 1,
+                                                   hkl, [1, 0, 1])
+        assert_array_almost_equal([call[3] for call in self.diffcalc.calls],
+                                  (12.39842, 6.19921))
+
+    def test_dependent_scan_solved_in_order(self):
+        # without its energy scannable hkl cannot account for energy moves
+        handler = RecordingDataHandler(self.hkl)
+        self.diffcalc.calls = []
+        PipelinedScan([handler])(self.diffcalc.en, 10, 12, 1,
+                                 self.hkl, [1, 0, 1])
+        assert handler.points == [[1, 0, 1]] * 3
+        assert self.axes.getPosition() == [12, 0, 12]
+        for call in self.diffcalc.calls:
+            assert call[2] is threading.currentThread()
+            assert call[3] is None
+
+    def test_higher_level_scannable_not_a_dependency(self):
+        ct = SingleFieldDummyScannable('ct')
+        ct.setLevel(10)
+        self.diffcalc.calls = []
+        PipelinedScan([RecordingDataHandler(self.hkl.h)])(
+            self.hkl.h, 0, 1, .5, ct, 1)
+        for call in self.diffcalc.calls:
+            assert call[2] is not threading.currentThread()
+
+    def test_unreachable_point(self):
+        handler = RecordingDataHandler(self.hkl.h)
+        with pytest.raises(DiffcalcException):
+            PipelinedScan([handler])(self.hkl.h, 0, 3, 1)
+        # the points before it are recorded
+        assert handler.points == [0, 1]
+        assert not handler.ended
+        assert self.axes.getPosition() == [10, 0, 10]
+
+    def test_data_handler_exception(self):
+        class BadDataHandler(ScanDataHandler):
+            def callWithScanPoint(self, position_dict):
+                raise ValueError('full')
+        with pytest.raises(ValueError):
+            PipelinedScan([BadDataHandler()], queueSize=1)(
+                self.hkl.h, 0, 1, .1)
+
+
+class BatchFakeDiffcalc(FakeDiffcalc):
+    """Also solves lists of hkl together, flipping the first angle by 180
+    for h > .5"""
+
+    def __init__(self):
+        FakeDiffcalc.__init__(self)
+        self.batches = []
+
+    def hkl_list_to_angles(self, hkl_list, energy=None):
+        self.batches.append(hkl_list)
+        if energy is None:
+            energy = self.en.getPosition()
+        results = []
+        for h, k, l in hkl_list:
+            if h > 1:
+                results.append(None)
+            else:
+                results.append(([h * energy + (180 if h > .5 else 0),
+                                 k * energy, l * energy], {}))
+        return results
+
+
+class EnergySeriesFakeDiffcalc(BatchFakeDiffcalc):
+    """Also solves an hkl at a series of energies together"""
+
+    def __init__(self):
+        BatchFakeDiffcalc.__init__(self)
+        self.series = []
+
+    def hkl_to_angles_vs_energy(self, hkl, energies):
+        self.series.append((hkl, energies))
+        return [self.hkl_list_to_angles([hkl], energy)[0]
+                for energy in energies]
+
+
+class DoublingScannable(SingleFieldDummyScannable):
+    """Prepares moves to twice the target, failing beyond 2"""
+
+    def prepareMoveTo(self, target, previous=None):
+        if target > 2:
+            raise DiffcalcException('too far')
+        return target * 2
+
+    def asynchronousMoveToPrepared(self, prepared):
+        self.asynchronousMoveTo(prepared)
+
+
+class WrappingScannable(SingleFieldDummyScannable):
+    """Prepares moves to the target cut to -180 to 180"""
+
+    def prepareMoveTo(self, target, previous=None):
+        return [(target + 180.) % 360. - 180.]
+
+    def asynchronousMoveToPrepared(self, prepared):
+        self.asynchronousMoveTo(prepared[0])
+
+
+class TestPrecomputedScan(object):
+
+    def setup_method(self):
+        self.diffcalc = BatchFakeDiffcalc()
+        self.axes = ScannableGroup('axes', [SingleFieldDummyScannable(name)
+                                            for name in ('a', 'b', 'c')])
+        self.hkl = Hkl('hkl', self.axes, self.diffcalc)
+        self.hkl.asynchronousMoveTo([0, 0, 1])
+        self.handler = RecordingDataHandler(self.hkl.h)
+
+    def test_solved_together_before_moving(self):
+        PrecomputedScan([self.handler])(self.hkl.h, 0, .5, .25)
+        assert self.diffcalc.batches == [
+            [[0, 0, 1], [.25, 0, 1], [.5, 0, 1]]]
+        assert self.handler.points == [0, .25, .5]
+        assert self.handler.ended
+        assert self.axes.getPosition() == [5, 0, 10]
+
+    def test_unreachable_points_fail_before_motion(self):
+        with pytest.raises(DiffcalcException) as e:
+            PrecomputedScan([self.handler])(self.hkl.h, 0, 3, 1)
+        message = str(e.value)
+        assert 'Scan not started: 2 of 4 points could not be reached' in message
+        assert 'hkl (2 0 1)' in message
+        assert 'hkl (3 0 1)' in message
+        assert 'hkl unreachable' in message
+        assert not self.handler.started
+        assert self.axes.getPosition() == [0, 0, 10]
+
+    def test_branch_flip_reported(self, capsys):
+        PrecomputedScan([self.handler])(self.hkl.h, 0, 1, .5)
+        assert 'WARNING: 1 branch flips found' in capsys.readouterr()[0]
+        assert len(self.handler.points) == 3
+        assert self.axes.getPosition() == [190, 0, 10]
+
+    def test_branch_flip_fails(self):
+        with pytest.raises(DiffcalcException) as e:
+            PrecomputedScan([self.handler], failOnBranchFlip=True)(
+                self.hkl.h, 0, 1, .5)
+        assert ('hkl (0.5 0 1) to (1 0 1): a moves -175.0000' in
+                str(e.value))
+        assert self.axes.getPosition() == [0, 0, 10]
+
+    def test_crossing_cut_not_a_branch_flip(self, capsys):
+        scn = WrappingScannable('scn')
+        PrecomputedScan([RecordingDataHandler(scn)], failOnBranchFlip=True)(
+            scn, 170, 190, 10)
+        assert 'branch flip' not in capsys.readouterr()[0]
+        assert scn.getPosition() == -170
+
+    def test_energy_scan_solved_at_each_energy(self):
+        en = self.diffcalc.en
+        hkl = Hkl('hkl', self.axes, self.diffcalc, energyScannable=en)
+        handler = RecordingDataHandler(hkl)
+        self.diffcalc.calls = []
+        PrecomputedScan([handler])(en, 10, 12, 1, hkl, [.5, 0, 1])
+        assert [call[3] for call in self.diffcalc.calls] == [10, 11, 12]
+        assert handler.points == [[.5, 0, 1]] * 3
+        assert self.axes.getPosition() == [6, 0, 12]
+
+    def test_energy_scan_solved_together(self):
+        diffcalc = EnergySeriesFakeDiffcalc()
+        hkl = Hkl('hkl', self.axes, diffcalc, energyScannable=diffcalc.en)
+        handler = RecordingDataHandler(hkl)
+        PrecomputedScan([handler])(diffcalc.en, 10, 12, 1, hkl, [.5, 0, 1])
+        assert diffcalc.series == [([.5, 0, 1], [10, 11, 12])]
+        assert diffcalc.batches == [[[.5, 0, 1]]] * 3
+        assert handler.points == [[.5, 0, 1]] * 3
+        assert self.axes.getPosition() == [6, 0, 12]
+
+    def test_wavelength_scan_solved_together(self):
+        diffcalc = EnergySeriesFakeDiffcalc()
+        wl = Wavelength('wl', diffcalc.en)
+        wl.setLevel(3)
+        hkl = Hkl('hkl', self.axes, diffcalc, energyScannable=diffcalc.en)
+        PrecomputedScan([RecordingDataHandler(hkl)])(wl, 1, 2, 1,
+                                                     hkl, [.5, 0, 1])
+        assert len(diffcalc.series) == 1
+        assert_array_almost_equal(diffcalc.series[0][1], (12.39842, 6.19921))
+
+    def test_dependent_scan_solved_in_order(self):
+        # without its energy scannable hkl cannot account for energy moves
+        handler = RecordingDataHandler(self.hkl)
+        self.diffcalc.calls = []
+        PrecomputedScan([handler])(self.diffcalc.en, 10, 12, 1,
+                                   self.hkl, [.5, 0, 1])
+        assert self.diffcalc.batches == []
+        assert handler.points == [[.5, 0, 1]] * 3
+        assert self.axes.getPosition() == [6, 0, 12]
+
+    def test_tracking_solves_in_turn(self):
+        self.hkl.tracking = True
+        PrecomputedScan([self.handler])(self.hkl.h, 0, .5, .25)
+        assert self.diffcalc.batches == []
+        assert [call[1] for call in self.diffcalc.calls[-2:]] == [
+            [0, 0, 10], [2.5, 0, 10]]
+
+    def test_scannable_preparing_moves_in_turn(self):
+        scn = DoublingScannable('scn')
+        handler = RecordingDataHandler(scn)
+        PrecomputedScan([handler])(scn, 0, 2, 1)
+        assert handler.points == [0, 2, 4]
+        with pytest.raises(DiffcalcException) as e:
+            PrecomputedScan([handler])(scn, 0, 4, 1)
+        assert '2 of 5 points' in str(e.value)
+        assert 'scn 3: too far' in str(e.value)
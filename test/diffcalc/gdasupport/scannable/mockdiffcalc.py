@@ -43,7 +43,7 @@ class MockDiffcalc:
         params['azimuth'] = 12345.
         return ([h] * self.numberAngles, params)
 
-    def angles_to_hkl(self, pos):
+    def angles_to_hkl(self, pos, virtual_angle_names=None):
         if len(pos) != self.numberAngles: raise ValueError
         params = {}
         params['theta'] = 1.
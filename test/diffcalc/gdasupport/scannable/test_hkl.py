@@ -23,6 +23,8 @@ import unittest
 from diffcalc.gdasupport.scannable.diffractometer import \
     DiffractometerScannableGroup
 from diffcalc.gdasupport.scannable.hkl import Hkl
+from diffcalc.gdasupport.scannable.trajectory import line
+from diffcalc.util import DiffcalcException
 from test.diffcalc.gdasupport.scannable.mockdiffcalc import MockDiffcalc
 import pytest
 try:
@@ -63,6 +65,7 @@ class TestHkl(object):
         self.mock_dc_module = mock.Mock()
         self.mockSixc = mock.Mock(spec=DiffractometerScannableGroup)
         self.hkl = Hkl('hkl', self.mockSixc, self.mock_dc_module)
+        self.virtual_angle_names = ()
 
     def testInit(self):
         self.mock_dc_module.angles_to_hkl.return_value = ([1, 2, 3], PARAM_DICT)
@@ -75,11 +78,100 @@ class TestHkl(object):
         self.mock_dc_module.hkl_to_angles.assert_called_with(1, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
 
+    def testAsynchronousMoveToTracking(self):
+        self.hkl.tracking = True
+        self.mockSixc.getPosition.return_value = [7, 5, 4, 3, 2, 1]
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1],
+                                                       None)
+        self.hkl.asynchronousMoveTo([1, 0, 1])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            1, 0, 1, seed=[7, 5, 4, 3, 2, 1])
+        self.mockSixc.asynchronousMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
+
+    def testPrepareMoveTo(self):
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1],
+                                                       None)
+        assert self.hkl.prepareMoveTo([1, 0, 1]) == [6, 5, 4, 3, 2, 1]
+        self.mock_dc_module.hkl_to_angles.assert_called_with(1, 0, 1)
+        self.mockSixc.asynchronousMoveTo.assert_not_called()
+        self.hkl.asynchronousMoveToPrepared([6, 5, 4, 3, 2, 1])
+        self.mockSixc.asynchronousMoveTo.assert_called_with([6, 5, 4, 3, 2, 1])
+
+    def testPrepareMoveToTracking(self):
+        self.hkl.tracking = True
+        self.mockSixc.getPosition.return_value = [7, 5, 4, 3, 2, 1]
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1],
+                                                       None)
+        self.hkl.prepareMoveTo([1, 0, 1])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            1, 0, 1, seed=[7, 5, 4, 3, 2, 1])
+        self.hkl.prepareMoveTo([1, 0, 1.1], previous=[6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            1, 0, 1.1, seed=[6, 5, 4, 3, 2, 1])
+
+    def testPrepareMovesTo(self):
+        self.mock_dc_module.hkl_list_to_angles.return_value = [
+            ([6, 5, 4, 3, 2, 1], None), None]
+        def hkl_to_angles(h, k, l):
+            raise DiffcalcException('beyond the limits')
+        self.mock_dc_module.hkl_to_angles.side_effect = hkl_to_angles
+        results = self.hkl.prepareMovesTo([(1, 0, 1), (9, 0, 1)])
+        self.mock_dc_module.hkl_list_to_angles.assert_called_with(
+            [[1, 0, 1], [9, 0, 1]])
+        assert results[0] == [6, 5, 4, 3, 2, 1]
+        # failures are solved again for the reason
+        assert isinstance(results[1], DiffcalcException)
+        assert 'beyond the limits' in str(results[1])
+
+    def testPrepareMovesToAtEnergies(self):
+        self.mock_dc_module.hkl_to_angles_vs_energy.return_value = [
+            ([6, 5, 4, 3, 2, 1], None), None]
+        self.mock_dc_module.hkl_to_angles.return_value = ([7, 5, 4, 3, 2, 1],
+                                                       None)
+        results = self.hkl.prepareMovesTo([(1, 0, 1), (1, 0, 1)],
+                                          [{'energy': 10}, {'energy': 11}])
+        self.mock_dc_module.hkl_to_angles_vs_energy.assert_called_with(
+            [1, 0, 1], [10, 11])
+        assert results == [[6, 5, 4, 3, 2, 1], [7, 5, 4, 3, 2, 1]]
+        self.mock_dc_module.hkl_to_angles.assert_called_with(1, 0, 1,
+                                                             energy=11)
+        self.mock_dc_module.hkl_list_to_angles.assert_not_called()
+
+    def testPrepareMovesToAtEnergiesTracking(self):
+        self.hkl.tracking = True
+        self.mockSixc.getPosition.return_value = [7, 5, 4, 3, 2, 1]
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1],
+                                                       None)
+        self.hkl.prepareMovesTo([(1, 0, 1), (1, 0, 1)],
+                                [{'energy': 10}, {'energy': 11}])
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            1, 0, 1, seed=[6, 5, 4, 3, 2, 1], energy=11)
+        self.mock_dc_module.hkl_to_angles_vs_energy.assert_not_called()
+
+    def testPrepareMovesToTracking(self):
+        self.hkl.tracking = True
+        self.mockSixc.getPosition.return_value = [7, 5, 4, 3, 2, 1]
+        self.mock_dc_module.hkl_to_angles.return_value = ([6, 5, 4, 3, 2, 1],
+                                                       None)
+        results = self.hkl.prepareMovesTo([(1, 0, 1), (1, 0, 1.1)])
+        assert results == [[6, 5, 4, 3, 2, 1]] * 2
+        self.mock_dc_module.hkl_to_angles.assert_called_with(
+            1, 0, 1.1, seed=[6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.hkl_list_to_angles.assert_not_called()
+
+    def testTrackingRequiresSeed(self):
+        self.hkl = Hkl('hkl', self.mockSixc, MockDiffcalc(6))
+        with pytest.raises(DiffcalcException):
+            self.hkl.tracking = True
+        assert not self.hkl.tracking
+        self.hkl.tracking = False
+
     def testGetPosition(self):
         self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
         self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
         assert self.hkl.getPosition() == [1, 0, 1]
-        self.mock_dc_module.angles_to_hkl.assert_called_with([6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.angles_to_hkl.assert_called_with(
+            [6, 5, 4, 3, 2, 1], virtual_angle_names=self.virtual_angle_names)
 
     def testAsynchronousMoveToWithNonesOutsideScan(self):
         self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
@@ -90,7 +182,8 @@ class TestHkl(object):
 
         self.hkl.asynchronousMoveTo([2, 0, None])
 
-        self.mock_dc_module.angles_to_hkl.assert_called_with([6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.angles_to_hkl.assert_called_with(
+            [6, 5, 4, 3, 2, 1], virtual_angle_names=self.virtual_angle_names)
         self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with(
             [12, 5, 4, 3, 2, 1])
@@ -106,7 +199,8 @@ class TestHkl(object):
                                                        PARAM_DICT)
         self.hkl.asynchronousMoveTo([2, 0, None])
         # atScanStart:
-        self.mock_dc_module.angles_to_hkl.assert_called_with([6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.angles_to_hkl.assert_called_with(
+            [6, 5, 4, 3, 2, 1], virtual_angle_names=self.virtual_angle_names)
         self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with(
             [12, 5, 4, 3, 2, 1])
@@ -124,7 +218,7 @@ class TestHkl(object):
         self.hkl.asynchronousMoveTo([2, 0, None])
 
         self.mock_dc_module.angles_to_hkl.assert_called_with(
-            [6.1, 5.1, 4.1, 3.1, 2.1, 1.1])
+            [6.1, 5.1, 4.1, 3.1, 2.1, 1.1], virtual_angle_names=self.virtual_angle_names)
         self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with(
             [12.1, 5.1, 4.1, 3.1, 2.1, 1.1])
@@ -141,7 +235,7 @@ class TestHkl(object):
         self.hkl.asynchronousMoveTo([2, 0, None])
 
         self.mock_dc_module.angles_to_hkl.assert_called_with(
-            [6.1, 5.1, 4.1, 3.1, 2.1, 1.1])
+            [6.1, 5.1, 4.1, 3.1, 2.1, 1.1], virtual_angle_names=self.virtual_angle_names)
         self.mock_dc_module.hkl_to_angles.assert_called_with(2, 0, 1)
         self.mockSixc.asynchronousMoveTo.assert_called_with(
             [12.1, 5.1, 4.1, 3.1, 2.1, 1.1])
@@ -167,12 +261,51 @@ class TestHkl(object):
     def testDisp(self):
         print self.hkl.__repr__()
 
+    def testTrajectory(self):
+        self.mockSixc.getInputNames.return_value = ['mu', 'delta', 'gam',
+                                                    'eta', 'chi', 'phi']
+        self.mock_dc_module.hkl_to_angles.side_effect = [
+            ([0, 10, 0, 5, 90, 0], None), ([0, 12, 0, 6, 90, 0], None),
+            ([0, 14, 0, 7, 90, 0], None)]
+        trajectory = self.hkl.trajectory(line((0, 0, 1), (0, 0, 2), 3), 4)
+        self.mock_dc_module.hkl_to_angles.assert_called_with(0, 0, 2)
+        assert trajectory.times == [0, .5, 1]
+        assert trajectory.positions['delta'] == [10, 12, 14]
+        assert trajectory.velocities['eta'] == [2, 2, 2]
+        self.mockSixc.asynchronousMoveTo.assert_not_called()
+
+    def testTrajectoryTracking(self):
+        self.hkl.tracking = True
+        self.mockSixc.getInputNames.return_value = ['mu', 'delta', 'gam',
+                                                    'eta', 'chi', 'phi']
+        self.mockSixc.getPosition.return_value = [0, 9, 0, 4, 90, 0]
+        self.mock_dc_module.hkl_to_angles.side_effect = [
+            ([0, 10, 0, 5, 90, 0], None), ([0, 12, 0, 6, 90, 0], None)]
+        self.hkl.trajectory([(0, 0, 1), (0, 0, 2)], 4)
+        calls = self.mock_dc_module.hkl_to_angles.call_args_list
+        assert calls[0] == mock.call(0, 0, 1, seed=[0, 9, 0, 4, 90, 0])
+        assert calls[1] == mock.call(0, 0, 2, seed=[0, 10, 0, 5, 90, 0])
+
+    def testTrajectoryUnreachablePoint(self):
+        self.mockSixc.getInputNames.return_value = ['mu', 'delta', 'gam',
+                                                    'eta', 'chi', 'phi']
+        def hkl_to_angles(h, k, l):
+            if l > 1:
+                raise DiffcalcException('too far')
+            return [0, 10, 0, 5, 90, 0], None
+        self.mock_dc_module.hkl_to_angles.side_effect = hkl_to_angles
+        with pytest.raises(DiffcalcException) as e:
+            self.hkl.trajectory([(0, 0, 1), (0, 0, 9)], 4)
+        assert 'Point 1 of the trajectory, (0 0 9)' in str(e.value)
+        assert 'too far' in str(e.value)
+
 
 class TestHklReturningVirtualangles(TestHkl):
     def setup_method(self):
         TestHkl.setup_method(self)
+        self.virtual_angle_names = ['theta', '2theta', 'Bin', 'Bout', 'azimuth']
         self.hkl = Hkl('hkl', self.mockSixc, self.mock_dc_module,
-                       ['theta', '2theta', 'Bin', 'Bout', 'azimuth'])
+                       self.virtual_angle_names)
 
     def testInit(self):
         self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
@@ -182,13 +315,14 @@ class TestHklReturningVirtualangles(TestHkl):
         self.mockSixc.getPosition.return_value = [6, 5, 4, 3, 2, 1]
         self.mock_dc_module.angles_to_hkl.return_value = ([1, 0, 1], PARAM_DICT)
         assert self.hkl.getPosition() == [1, 0, 1, 1, 12, 123, 1234, 12345]
-        self.mock_dc_module.angles_to_hkl.assert_called_with([6, 5, 4, 3, 2, 1])
+        self.mock_dc_module.angles_to_hkl.assert_called_with(
+            [6, 5, 4, 3, 2, 1], virtual_angle_names=self.virtual_angle_names)
 
 
 class TestHklWithFailingAngleCalculator(object):
     def setup_method(self):
         class BadMockAngleCalculator:
-            def angles_to_hkl(self, pos):
+            def angles_to_hkl(self, pos, virtual_angle_names=None):
                 raise Exception("Problem in angles_to_hkl")
 
         dummy = createDummyAxes(['alpha', 'delta', 'gamma', 'omega', 'chi',
@@ -0,0 +1,130 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import cos, sin
+
+import pytest
+from nose.tools import eq_
+
+from diffcalc.gdasupport.scannable.trajectory import curve, line, \
+    profile_trajectory
+from diffcalc.util import DiffcalcException
+from test.tools import assert_array_almost_equal
+
+NAMES = ('delta', 'eta')
+HKL = [(0, 0, 1), (0, 0, 2), (0, 0, 3), (0, 0, 4)]
+
+
+class TestPaths(object):
+
+    def test_line(self):
+        eq_(line((1, 0, 0), (2, 0, 1), 3),
+            [(1., 0., 0.), (1.5, 0., .5), (2., 0., 1.)])
+
+    def test_line_needs_two_points(self):
+        with pytest.raises(ValueError):
+            line((1, 0, 0), (2, 0, 1), 1)
+
+    def test_curve(self):
+        points = curve(lambda t: (cos(t), sin(t), 1), 3, 0, 3.14159265 / 2)
+        eq_(len(points), 3)
+        assert_array_almost_equal(points[1], (.70710678, .70710678, 1))
+        assert_array_almost_equal(points[2], (0, 1, 1))
+
+
+class TestProfileTrajectory(object):
+
+    def test_constant_velocity(self):
+        positions = [(10, 5), (12, 6), (14, 7), (16, 8)]
+        trajectory = profile_trajectory(NAMES, HKL, positions, 4)
+        # delta is the slowest axis, at 4 degrees/s
+        assert_array_almost_equal(trajectory.times, (0, .5, 1, 1.5))
+        assert_array_almost_equal(trajectory.positions['delta'],
+                                  (10, 12, 14, 16))
+        assert_array_almost_equal(trajectory.velocities['delta'], (4,) * 4)
+        assert_array_almost_equal(trajectory.velocities['eta'], (2,) * 4)
+        eq_(trajectory.ramp_time, 0)
+        eq_(trajectory.run_up, {'delta': 10, 'eta': 5})
+        eq_(len(trajectory), 4)
+
+    def test_per_axis_velocity(self):
+        positions = [(10, 5), (12, 6), (14, 7), (16, 8)]
+        trajectory = profile_trajectory(NAMES, HKL, positions,
+                                        {'delta': 4, 'eta': .5})
+        # now eta is the slowest
+        assert_array_almost_equal(trajectory.times, (0, 2, 4, 6))
+        assert_array_almost_equal(trajectory.velocities['delta'], (1,) * 4)
+
+    def test_missing_axis_velocity(self):
+        with pytest.raises(ValueError):
+            profile_trajectory(NAMES, HKL[:2], [(0, 0), (1, 1)],
+                               {'delta': 4})
+
+    def test_ramps(self):
+        positions = [(10, 5), (12, 6), (14, 7), (16, 8)]
+        trajectory = profile_trajectory(NAMES, HKL, positions, 4,
+                                        {'delta': 8, 'eta': 1})
+        # 4 degrees/s reached in .5s at 8 degrees/s^2, but eta needs 2s
+        eq_(trajectory.ramp_time, 2)
+        assert_array_almost_equal(
+            [trajectory.run_up['delta'], trajectory.run_up['eta']], (6, 3))
+        assert_array_almost_equal(
+            [trajectory.run_down['delta'], trajectory.run_down['eta']],
+            (20, 10))
+        eq_(trajectory.duration, 5.5)
+
+    def test_stretched_for_acceleration(self):
+        positions = [(0, 0), (1, 0), (1, 1), (1, 2)]
+        trajectory = profile_trajectory(NAMES, HKL, positions, 10, 1)
+        times = trajectory.times
+        for j, name in enumerate(NAMES):
+            for k in range(1, len(times) - 1):
+                v_before = ((positions[k][j] - positions[k - 1][j]) /
+                            (times[k] - times[k - 1]))
+                v_after = ((positions[k + 1][j] - positions[k][j]) /
+                           (times[k + 1] - times[k]))
+                dt = (times[k + 1] - times[k - 1]) / 2
+                assert abs(v_after - v_before) / dt <= 1 + 1e-6
+        # without an acceleration limit each segment takes .1s
+        assert times[-1] > .3
+
+    def test_discontinuous(self):
+        positions = [(10, 5), (12, 6), (14, 187), (16, 8)]
+        with pytest.raises(DiffcalcException) as e:
+            profile_trajectory(NAMES, HKL, positions, 4)
+        assert 'between points 1 (0 0 2) and 2 (0 0 3)' in str(e.value)
+        assert 'eta' in str(e.value)
+
+    def test_unwrapped_across_cut(self):
+        positions = [(10, 179), (12, -179.5), (14, -178), (16, -176.5)]
+        trajectory = profile_trajectory(NAMES, HKL, positions, 4)
+        assert_array_almost_equal(trajectory.positions['eta'],
+                                  (179, 180.5, 182, 183.5))
+        assert_array_almost_equal(trajectory.velocities['eta'], (3,) * 4)
+        assert_array_almost_equal(trajectory.times, (0, .5, 1, 1.5))
+
+    def test_max_step(self):
+        positions = [(10, 5), (12, 6), (14, 7), (16, 8)]
+        profile_trajectory(NAMES, HKL, positions, 4, max_step=2)
+        with pytest.raises(DiffcalcException):
+            profile_trajectory(NAMES, HKL, positions, 4,
+                               max_step={'delta': 1.5, 'eta': 2})
+
+    def test_str(self):
+        positions = [(10, 5), (12, 6), (14, 7), (16, 8)]
+        print profile_trajectory(NAMES, HKL, positions, 4, 8)
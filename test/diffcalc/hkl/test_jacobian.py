@@ -0,0 +1,172 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi, sqrt
+
+import pytest
+from mock import Mock
+from nose.tools import eq_
+
+try:
+    import numpy
+    from numpy import matrix
+except ImportError:
+    numpy = None
+    from numjy import matrix
+
+from diffcalc.hkl.vlieg.calc import VliegHklCalculator
+from diffcalc.hkl.vlieg.geometry import VliegPosition
+from diffcalc.hkl.willmott.calc import WillmottHorizontalCalculator, \
+    WillmottHorizontalPosition
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager, NUNAME
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.util import y_rotation, z_rotation
+from test.diffcalc.test_hardware import SimpleHardwareAdapter
+from test.diffcalc.hkl.vlieg.test_calc import \
+    createMockDiffractometerGeometry, createMockHardwareMonitor, \
+    createMockUbcalc
+from test.tools import assert_array_almost_equal, \
+    assert_2darray_almost_equal
+
+TORAD = pi / 180
+UB = (z_rotation(5 * TORAD) * y_rotation(3 * TORAD) *
+      matrix('1 0 0; 0 1.2 0; 0 .1 .9') * 2 * pi)
+WAVELENGTH = 1.2
+STEP = 1e-5  # degrees, for central differences
+
+
+class _BaseJacobianTest(object):
+
+    def _central_differences(self, function, angles):
+        columns = []
+        for j in range(len(angles)):
+            plus, minus = list(angles), list(angles)
+            plus[j] += STEP
+            minus[j] -= STEP
+            f_plus = function(self.position_class(*plus))
+            f_minus = function(self.position_class(*minus))
+            columns.append([(p - m) / (2 * STEP)
+                            for p, m in zip(f_plus, f_minus)])
+        return zip(*columns)
+
+    def test_hkl_jacobian(self):
+        for angles in self.ANGLES:
+            jacobian = self.calc.anglesToHklJacobian(
+                self.position_class(*angles), WAVELENGTH)
+            eq_(jacobian.shape, (3, len(angles)))
+            expected = self._central_differences(
+                lambda pos: self.calc.anglesToHkl(pos, WAVELENGTH, ())[0],
+                angles)
+            assert_2darray_almost_equal(jacobian.tolist(), expected, 7)
+
+    def test_virtual_angles_jacobian(self):
+        for angles in self.ANGLES:
+            jacobian = self.calc.anglesToVirtualAnglesJacobian(
+                self.position_class(*angles), WAVELENGTH)
+            eq_(sorted(jacobian.keys()), sorted(self.VIRTUAL_ANGLE_NAMES))
+            for name in self.VIRTUAL_ANGLE_NAMES:
+                expected = self._central_differences(
+                    lambda pos: [self.calc.anglesToVirtualAngles(
+                        pos, WAVELENGTH, (name,))[name]], angles)
+                assert_array_almost_equal(jacobian[name], expected[0], 6)
+
+    def test_virtual_angles_jacobian_names(self):
+        name = self.VIRTUAL_ANGLE_NAMES[-1]
+        angles = self.ANGLES[0]
+        jacobian = self.calc.anglesToVirtualAnglesJacobian(
+            self.position_class(*angles), WAVELENGTH, (name,))
+        eq_(jacobian.keys(), [name])
+
+    @pytest.mark.skipif(numpy is None, reason='requires numpy')
+    def test_batch(self):
+        hkl_jacobians = self.calc.angles_to_hkl_jacobian_batch(self.ANGLES,
+                                                               WAVELENGTH)
+        virtual_jacobians = self.calc.angles_to_virtual_angles_jacobian_batch(
+            self.ANGLES, WAVELENGTH)
+        eq_(hkl_jacobians.shape, (len(self.ANGLES), 3, len(self.ANGLES[0])))
+        for i, angles in enumerate(self.ANGLES):
+            pos = self.position_class(*angles)
+            assert_2darray_almost_equal(
+                hkl_jacobians[i].tolist(),
+                self.calc.anglesToHklJacobian(pos, WAVELENGTH).tolist(), 12)
+            jacobian = self.calc.anglesToVirtualAnglesJacobian(pos,
+                                                               WAVELENGTH)
+            for name in jacobian:
+                assert_array_almost_equal(virtual_jacobians[name][i],
+                                          jacobian[name], 12)
+
+
+class TestYouJacobian(_BaseJacobianTest):
+
+    # mu, delta, nu, eta, chi, phi; including qaz's flip beyond delta=90
+    ANGLES = ((3, 40, 10, 20, 30, 40),
+              (-5, 120, 20, -30, 60, 170),
+              (2, -130, 15, 10, -20, 5))
+    VIRTUAL_ANGLE_NAMES = ('theta', 'qaz', 'alpha', 'naz', 'tau', 'psi',
+                           'beta')
+    position_class = YouPosition
+
+    def setup_method(self):
+        ubcalc = createMockUbcalc(UB)
+        ubcalc.n_phi = matrix([[.1], [.2], [1]]) * (1 / sqrt(1.05))
+        hardware = SimpleHardwareAdapter(['mu', 'delta', NUNAME, 'eta', 'chi',
+                                          'phi'])
+        self.calc = YouHklCalculator(ubcalc,
+                                     createMockDiffractometerGeometry(),
+                                     hardware, YouConstraintManager(hardware))
+
+    def test_psi_undefined(self):
+        # Q parallel to n
+        pos = YouPosition(0, 0, 0, 0, 0, 0)
+        jacobian = self.calc.anglesToVirtualAnglesJacobian(pos, 1, ('psi',))
+        assert [d for d in jacobian['psi'] if d != d]
+
+
+class TestVliegJacobian(_BaseJacobianTest):
+
+    # alpha, delta, gamma, omega, chi, phi
+    ANGLES = ((3, 40, 10, 20, 30, 40),
+              (-5, 120, 20, -30, 60, 170),
+              (2, -130, 15, 10, -20, 5))
+    VIRTUAL_ANGLE_NAMES = ('Bin', 'Bout', '2theta')
+    position_class = VliegPosition
+
+    def setup_method(self):
+        ubcalc = createMockUbcalc(UB)
+        ubcalc.sigma = 3
+        ubcalc.tau = -4
+        self.calc = VliegHklCalculator(ubcalc,
+                                       createMockDiffractometerGeometry(),
+                                       createMockHardwareMonitor())
+
+
+class TestWillmottJacobian(_BaseJacobianTest):
+
+    # delta, gamma, omegah, phi
+    ANGLES = ((40, 10, 2, 40),
+              (120, -20, 5, 170),
+              (-30, 15, -3, 5))
+    VIRTUAL_ANGLE_NAMES = ('theta', 'betain', 'betaout')
+    position_class = WillmottHorizontalPosition
+
+    def setup_method(self):
+        self.calc = WillmottHorizontalCalculator(
+            createMockUbcalc(UB), createMockDiffractometerGeometry(),
+            SimpleHardwareAdapter(['delta', 'gamma', 'omegah', 'phi']),
+            Mock())
@@ -40,12 +40,21 @@ TORAD = pi / 180
 TODEG = 180 / pi
 
 
+class MockUbcalc(Mock):
+    """A mock UBCalculation whose UB_inv follows UB as tests reassign it"""
+
+    @property
+    def UB_inv(self):
+        return self.UB.I
+
+
 def createMockUbcalc(UB):
-    ubcalc = Mock()
+    ubcalc = MockUbcalc()
     ubcalc.tau = 0
     ubcalc.sigma = 0
     ubcalc.UB = UB
     ubcalc.n_phi = matrix([[0], [0], [1]])
+    ubcalc.version = 0
     return ubcalc
 
 
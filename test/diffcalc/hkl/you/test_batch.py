@@ -0,0 +1,430 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+import pytest
+from nose.tools import eq_, raises
+
+try:
+    import numpy
+    from numpy import matrix
+except ImportError:
+    numpy = None
+    from numjy import matrix
+
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager, NUNAME
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.util import y_rotation, z_rotation, DiffcalcException
+from test.diffcalc.test_hardware import SimpleHardwareAdapter
+from test.diffcalc.hkl.vlieg.test_calc import \
+    createMockDiffractometerGeometry, createMockUbcalc
+from test.tools import assert_array_almost_equal
+
+if numpy is not None:
+    from diffcalc.hkl.you import batch
+    from diffcalc.hkl.you.batch import VIRTUAL_ANGLE_NAMES, STATUS_OK, \
+        STATUS_UNREACHABLE
+
+pytestmark = pytest.mark.skipif(numpy is None, reason='requires numpy')
+
+TORAD = pi / 180
+I = matrix('1 0 0; 0 1 0; 0 0 1')
+
+HKLS = [(h, k, l) for h in (-1, 0, .3, 1) for k in (0, .5, 1)
+        for l in (0, .2, 1, 1.5)]
+
+CONSTRAINTS = (
+    {'a_eq_b': None, 'mu': 0, NUNAME: 0},
+    {'psi': 90 * TORAD, 'mu': 0, NUNAME: 0},
+    {'alpha': 2 * TORAD, 'mu': 0, 'qaz': 90 * TORAD},
+    {'beta': 5 * TORAD, 'eta': 0, 'delta': 0},
+    {'a_eq_b': None, 'eta': 0, 'qaz': 0},
+    {'a_eq_b': None, 'chi': 80 * TORAD, 'delta': 30 * TORAD},
+    {'alpha': 1 * TORAD, 'phi': 10 * TORAD, NUNAME: 0},
+    {'a_eq_b': None, 'chi': 0, 'phi': 0},
+    {'chi': 90 * TORAD, 'phi': 0, 'eta': 0},
+)
+
+
+class _BaseBatchTest(object):
+
+    def setup_method(self):
+        U = z_rotation(5 * TORAD) * y_rotation(3 * TORAD)
+        self.mock_ubcalc = createMockUbcalc(U * I * 2 * pi)
+        n_phi = matrix([[.1], [0], [1]])
+        self.mock_ubcalc.n_phi = n_phi * (1 / numpy.linalg.norm(n_phi))
+        names = ['delta', NUNAME, 'mu', 'eta', 'chi', 'phi']
+        self.mock_hardware = SimpleHardwareAdapter(names)
+        self.constraints = YouConstraintManager(self.mock_hardware)
+        self.calc = YouHklCalculator(self.mock_ubcalc,
+                                     createMockDiffractometerGeometry(),
+                                     self.mock_hardware, self.constraints)
+        self.mock_hardware.set_lower_limit('delta', 0)
+        self.mock_hardware.set_upper_limit('delta', 179.999)
+        self.mock_hardware.set_lower_limit(NUNAME, 0)
+        self.mock_hardware.set_upper_limit(NUNAME, 179.999)
+        self.mock_hardware.set_lower_limit('mu', 0)
+        self.mock_hardware.set_lower_limit('eta', 0)
+        self.mock_hardware.set_lower_limit('chi', -10)
+
+
+class TestHklToAnglesBatch(_BaseBatchTest):
+
+    def _check_against_scalar(self, constraints, wavelength=1.):
+        self.constraints._constrained = constraints
+        positions, virtual_angles, status = self.calc.hkl_to_angles_batch(
+            HKLS, wavelength)
+        eq_(positions.shape, (len(HKLS), 6))
+        eq_(virtual_angles.shape, (len(HKLS), 7))
+        for i, (h, k, l) in enumerate(HKLS):
+            try:
+                pos, virtual = self.calc.hklToAngles(h, k, l, wavelength)
+            except DiffcalcException:
+                eq_(status[i], STATUS_UNREACHABLE)
+                assert numpy.isnan(positions[i]).all()
+                continue
+            except Exception:
+                assert status[i] > STATUS_UNREACHABLE
+                continue
+            eq_(status[i], STATUS_OK)
+            assert_array_almost_equal(positions[i], pos.totuple(), 7)
+            assert_array_almost_equal(
+                virtual_angles[i],
+                [virtual[name] for name in VIRTUAL_ANGLE_NAMES], 7)
+
+    def test_against_scalar(self):
+        for constraints in CONSTRAINTS:
+            self._check_against_scalar(constraints)
+
+    def test_against_scalar_naz(self):
+        # limit delta to avoid pairs of detector solutions
+        self.mock_hardware.set_upper_limit('delta', 90)
+        self._check_against_scalar({'psi': 60 * TORAD, 'mu': 0,
+                                    'naz': 90 * TORAD})
+
+    def test_against_scalar_unreachable(self):
+        self._check_against_scalar({'a_eq_b': None, 'mu': 0, NUNAME: 0}, 5.)
+
+    def test_against_scalar_constrained_outside_limits(self):
+        self.mock_hardware.set_lower_limit('mu', 5)
+        self._check_against_scalar({'a_eq_b': None, 'mu': 0, NUNAME: 0})
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        _, _, status = self.calc.hkl_to_angles_batch([(0, 1, 1)], 1.)
+        eq_(status[0], STATUS_UNREACHABLE)
+
+    def test_against_scalar_tidy_up_outside_limits(self):
+        # (1 0 0) is solved with chi=0, and tidying it to eta = delta/2 = 30
+        # would take eta beyond its limit
+        self.mock_ubcalc.UB = I * 2 * pi
+        self.mock_ubcalc.n_phi = matrix([[0], [0], [1]])
+        self.mock_hardware.set_upper_limit('eta', 10)
+        self._check_against_scalar({'a_eq_b': None, 'mu': 0, NUNAME: 0})
+        positions, _, _ = self.calc.hkl_to_angles_batch([(1, 0, 0)], 1.)
+        assert_array_almost_equal(positions[0], (0, 60, 0, 0, 0, 30), 7)
+
+    def test_empty(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        positions, virtual_angles, status = self.calc.hkl_to_angles_batch(
+            numpy.zeros((0, 3)), 1.)
+        eq_(positions.shape, (0, 6))
+        eq_(len(status), 0)
+
+    def test_verification_override(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        # corrupt the vectorised positions so that verification fails
+        tidy = batch._tidy_degenerate_solutions
+
+        def corrupted_tidy(*args):
+            mu, eta, phi = tidy(*args)
+            return mu, eta + .1, phi
+        batch._tidy_degenerate_solutions = corrupted_tidy
+        scalar_calls = []
+        hkl_to_angles = self.calc.hklToAngles
+
+        def counted_hkl_to_angles(*args):
+            scalar_calls.append(args)
+            return hkl_to_angles(*args)
+        self.calc.hklToAngles = counted_hkl_to_angles
+        try:
+            # rows failing verification are recalculated one at a time
+            self.calc.hkl_to_angles_batch(HKLS[1:4], 1.)
+            eq_(len(scalar_calls), 3)
+            _, _, status = self.calc.hkl_to_angles_batch(HKLS[1:4], 1., 'off')
+            eq_(len(scalar_calls), 3)
+            assert (status == STATUS_OK).all()
+        finally:
+            batch._tidy_degenerate_solutions = tidy
+        eq_(self.calc.verification, 'always')
+
+    def test_cheap_verification(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        positions, _, status = self.calc.hkl_to_angles_batch(HKLS, 1.)
+        cheap_positions, _, cheap_status = self.calc.hkl_to_angles_batch(
+            HKLS, 1., 'cheap')
+        assert (cheap_status == status).all()
+        ok = status == STATUS_OK
+        assert numpy.allclose(cheap_positions[ok], positions[ok])
+        hkl = numpy.array(HKLS[1:4], dtype=float)
+        okay, _, _ = batch._hkl_to_angles_one_sample_constraint(
+            self.calc, hkl, 1., cheap=True)
+        assert okay.all()
+        tidy = batch._tidy_degenerate_solutions
+
+        def corrupted_tidy(*args):
+            mu, eta, phi = tidy(*args)
+            return mu, eta + .1, phi
+        batch._tidy_degenerate_solutions = corrupted_tidy
+        try:
+            okay, _, _ = batch._hkl_to_angles_one_sample_constraint(
+                self.calc, hkl, 1., cheap=True)
+        finally:
+            batch._tidy_degenerate_solutions = tidy
+        assert not okay.any()
+
+    def test_verification_override_leaves_calculator(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        self.calc.set_verification('sampled', 3)
+        self.calc.hklToAngles(0, 1, 1, 1.)
+        self.calc.hkl_to_angles_batch(HKLS, 1., 'off')
+        eq_(self.calc.verification, 'sampled')
+        eq_(self.calc.verification_interval, 3)
+        eq_(self.calc._verification_count, 1)
+
+    @raises(DiffcalcException)
+    def test_unknown_verification_override(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        self.calc.hkl_to_angles_batch(HKLS, 1., 'sometimes')
+
+    @raises(DiffcalcException)
+    def test_not_fully_constrained(self):
+        self.constraints._constrained = {'mu': 0, NUNAME: 0}
+        self.calc.hkl_to_angles_batch(HKLS, 1.)
+
+    @raises(ValueError)
+    def test_bad_shape(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        self.calc.hkl_to_angles_batch([1, 0, 0], 1.)
+
+
+class TestAnglesToHklBatch(_BaseBatchTest):
+
+    def test_against_scalar(self):
+        positions = numpy.random.RandomState(0).uniform(-180, 180, (50, 6))
+        hkl, virtual_angles = self.calc.angles_to_hkl_batch(positions, 1.2)
+        eq_(hkl.shape, (50, 3))
+        eq_(virtual_angles.shape, (50, 7))
+        for i, angles in enumerate(positions):
+            hkl_expected, virtual = self.calc.anglesToHkl(
+                YouPosition(*angles), 1.2)
+            assert_array_almost_equal(hkl[i], hkl_expected, 10)
+            assert_array_almost_equal(
+                virtual_angles[i],
+                [virtual[name] for name in VIRTUAL_ANGLE_NAMES], 8)
+
+    def test_psi_undefined(self):
+        self.mock_ubcalc.n_phi = matrix([[0], [0], [1]])
+        _, virtual_angles = self.calc.angles_to_hkl_batch(
+            [[0, 60, 0, 30, 90, 0]], 1.)
+        assert numpy.isnan(virtual_angles[0, VIRTUAL_ANGLE_NAMES.index('psi')])
+
+    @raises(ValueError)
+    def test_bad_shape(self):
+        self.calc.angles_to_hkl_batch([0, 60, 0, 30, 0, 0], 1.)
+
+
+class TestPsiSweep(_BaseBatchTest):
+
+    HKL = (.3, .5, .7)
+    PSIS = range(-180, 181, 15)
+
+    def _check_against_scalar(self, constraints):
+        self.constraints._constrained = constraints
+        positions, virtual_angles, status, within_limits = \
+            self.calc.psi_sweep(self.HKL, self.PSIS, 1.)
+        eq_(positions.shape, (len(self.PSIS), 6))
+        eq_(within_limits.shape, (len(self.PSIS), 6))
+        eq_(self.constraints.all, constraints)
+        swept = dict((name, value) for name, value in constraints.items()
+                     if name not in ('a_eq_b', 'alpha', 'beta', 'psi'))
+        solved = 0
+        for i, psi in enumerate(self.PSIS):
+            self.constraints._constrained = dict(swept, psi=psi * TORAD)
+            try:
+                pos, virtual = self.calc.hklToAngles(*(self.HKL + (1.,)))
+            except DiffcalcException:
+                eq_(status[i], STATUS_UNREACHABLE)
+                assert not within_limits[i].any()
+                continue
+            except Exception:
+                assert status[i] > STATUS_UNREACHABLE
+                continue
+            eq_(status[i], STATUS_OK)
+            assert within_limits[i].all()
+            assert_array_almost_equal(positions[i], pos.totuple(), 7)
+            assert_array_almost_equal(
+                virtual_angles[i],
+                [virtual[name] for name in VIRTUAL_ANGLE_NAMES], 7)
+            solved += 1
+        assert solved
+
+    def test_against_scalar(self):
+        for constraints in ({'psi': 90 * TORAD, 'mu': 0, NUNAME: 0},
+                            {'a_eq_b': None, 'eta': 0, 'qaz': 0},
+                            {'alpha': 1 * TORAD, 'phi': 10 * TORAD,
+                             NUNAME: 0}):
+            self._check_against_scalar(constraints)
+
+    def test_against_scalar_two_sample_constraints(self):
+        # not vectorised; limit delta to avoid pairs of detector solutions
+        self.mock_hardware.set_upper_limit('delta', 90)
+        self._check_against_scalar({'psi': 0, 'chi': 30 * TORAD, 'phi': 0})
+
+    def test_calculator_untouched(self):
+        # two sample constraints are solved one psi at a time
+        self.mock_hardware.set_upper_limit('delta', 90)
+        constrained = {'psi': 0, 'chi': 30 * TORAD, 'phi': 0}
+        self.constraints._constrained = constrained
+        self.calc.set_cache_size(10)
+        before = self.calc.statistics.snapshot()
+        _, _, status, _ = self.calc.psi_sweep(self.HKL, self.PSIS, 1.)
+        assert (status == STATUS_OK).any()
+        assert self.constraints._constrained is constrained
+        eq_(len(self.calc.cache), 0)
+        eq_(self.calc.statistics.snapshot(), before)
+
+    def test_limit_flags(self):
+        self.constraints._constrained = {'psi': 0, 'mu': 0, NUNAME: 0}
+        _, _, status, within_limits = self.calc.psi_sweep(self.HKL,
+                                                          self.PSIS, 1.)
+        ok = status == STATUS_OK
+        assert ok.any()
+        assert within_limits[ok].all()
+        assert not within_limits[~ok].any()
+
+    def test_constrained_angle_outside_limits(self):
+        # as hklToAngles, a constrained mu below its limit is unreachable
+        self.constraints._constrained = {'psi': 0, 'mu': 0, NUNAME: 0}
+        self.mock_hardware.set_lower_limit('mu', 1)
+        _, _, status, within_limits = self.calc.psi_sweep(self.HKL,
+                                                          self.PSIS, 1.)
+        assert (status == STATUS_UNREACHABLE).all()
+        assert not within_limits.any()
+
+    @raises(DiffcalcException)
+    def test_no_reference_constraint(self):
+        self.constraints._constrained = CONSTRAINTS[-1]
+        self.calc.psi_sweep(self.HKL, self.PSIS, 1.)
+
+    @raises(ValueError)
+    def test_bad_hkl(self):
+        self.constraints._constrained = CONSTRAINTS[1]
+        self.calc.psi_sweep((1, 0), self.PSIS, 1.)
+
+
+class TestHklToAnglesVsWavelength(_BaseBatchTest):
+
+    HKL = (.3, .5, .7)
+    WAVELENGTHS = [.5 + .1 * i for i in range(20)]
+
+    def _check_against_scalar(self, constraints):
+        self.constraints._constrained = constraints
+        positions, virtual_angles, status = \
+            self.calc.hkl_to_angles_vs_wavelength(self.HKL, self.WAVELENGTHS)
+        eq_(positions.shape, (len(self.WAVELENGTHS), 6))
+        solved = 0
+        for i, wavelength in enumerate(self.WAVELENGTHS):
+            try:
+                pos, virtual = self.calc.hklToAngles(
+                    *(self.HKL + (wavelength,)))
+            except DiffcalcException:
+                eq_(status[i], STATUS_UNREACHABLE)
+                assert numpy.isnan(positions[i]).all()
+                continue
+            except Exception:
+                assert status[i] > STATUS_UNREACHABLE
+                continue
+            eq_(status[i], STATUS_OK)
+            assert_array_almost_equal(positions[i], pos.totuple(), 7)
+            assert_array_almost_equal(
+                virtual_angles[i],
+                [virtual[name] for name in VIRTUAL_ANGLE_NAMES], 7)
+            solved += 1
+        return solved
+
+    def test_against_scalar(self):
+        solved = [self._check_against_scalar(constraints)
+                  for constraints in CONSTRAINTS]
+        assert len([n for n in solved if n]) > len(CONSTRAINTS) / 2
+
+    def test_vectorised(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        calls = []
+        hkl_to_angles = self.calc.hklToAngles
+
+        def counted_hkl_to_angles(*args):
+            calls.append(args)
+            return hkl_to_angles(*args)
+        self.calc.hklToAngles = counted_hkl_to_angles
+        _, _, status = self.calc.hkl_to_angles_vs_wavelength(
+            self.HKL, self.WAVELENGTHS)
+        # only the unreachable wavelengths are handed to the scalar code
+        eq_(len(calls), (status != STATUS_OK).sum())
+        assert (status == STATUS_OK).sum() > len(calls)
+
+    @raises(ValueError)
+    def test_bad_wavelengths(self):
+        self.constraints._constrained = CONSTRAINTS[0]
+        self.calc.hkl_to_angles_vs_wavelength(self.HKL, [[1, 2]])
+
+
+class TestReachablePsiIntervals(_BaseBatchTest):
+
+    HKL = (.3, .5, .7)
+
+    def _is_reachable(self, psi):
+        self.constraints._constrained = {'psi': psi * TORAD, 'mu': 0,
+                                         NUNAME: 0}
+        try:
+            pos, _ = self.calc.hklToAngles(*(self.HKL + (1.,)))
+        except DiffcalcException:
+            return False
+        return self.calc._is_position_within_limits(
+            YouPosition(*[v * TORAD for v in pos.totuple()]))
+
+    def test_against_scalar(self):
+        self.mock_hardware.set_lower_limit('phi', -30)
+        self.mock_hardware.set_upper_limit('phi', 60)
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        intervals = self.calc.reachable_psi_intervals(self.HKL, 1.)
+        eq_(self.constraints.all, {'a_eq_b': None, 'mu': 0, NUNAME: 0})
+        assert intervals
+        for start, end in intervals:
+            assert start < end
+            assert self._is_reachable(start)
+            assert self._is_reachable(end)
+            assert not self._is_reachable(start - .01) or start == 0
+            assert not self._is_reachable(end + .01) or end == 180
+        for psi in numpy.arange(.25, 180, .5):
+            inside = [i for i in intervals if i[0] <= psi <= i[1]]
+            eq_(bool(inside), self._is_reachable(psi))
+
+    def test_unreachable(self):
+        self.constraints._constrained = {'psi': 0, 'mu': 0, NUNAME: 0}
+        eq_(self.calc.reachable_psi_intervals(self.HKL, 5.), [])
@@ -29,7 +29,8 @@ from diffcalc.hkl.you.constraints import YouConstraintManager
 from test.tools import assert_array_almost_equal, \
     assert_second_dict_almost_in_first
 from diffcalc.ub.crystal import CrystalUnderTest
-from diffcalc.util import y_rotation, z_rotation, DiffcalcException
+from diffcalc.util import y_rotation, z_rotation, DiffcalcException, \
+    stage_timers
 from test.diffcalc.test_hardware import SimpleHardwareAdapter
 from test.diffcalc.hkl.vlieg.test_calc import \
     createMockDiffractometerGeometry, createMockUbcalc
@@ -734,6 +735,28 @@ class TestConstrain3Sample_ChiPhiEta(_TestCubic):
         self._check((1, 0, .1),
                     P(mu= 30.3314, delta=5.7392, nu= 0.4970, eta=0, chi=0, phi=0))
 
+    def testHkl_all_solutions_include_both_detector_branches(self):
+        self.mock_ubcalc.UB = self.UB
+        self.constraints._constrained = {'chi': 0, 'phi': 0, 'eta': 0}
+        solutions = self.calc.hkl_to_all_angles(.1, 0, .01, 1)
+        detector = set((round(pos.delta, 4), round(pos.nu, 4))
+                       for pos, _ in solutions)
+        # two mu roots, each with two detector branches
+        assert detector == set([(5.7392, .497), (174.2608, -179.503),
+                                (5.7392, -.497), (174.2608, 179.503)])
+        for pos, _ in solutions:
+            hkl, _ = self.calc.anglesToHkl(pos, 1)
+            assert_array_almost_equal(hkl, (.1, 0, .01))
+
+    def testHkl_second_detector_branch_within_limits(self):
+        # only the (180 - delta, nu + 180) branch is within the limits
+        self.mock_ubcalc.UB = self.UB
+        self.constraints._constrained = {'chi': 0, 'phi': 0, 'eta': 0}
+        self.mock_hardware.set_lower_limit('delta', 90)
+        self.mock_hardware.set_lower_limit(NUNAME, None)
+        self.mock_hardware.set_upper_limit(NUNAME, 0)
+        pos, _ = self.calc.hklToAngles(.1, 0, .01, 1)
+        assert_array_almost_equal((pos.delta, pos.nu), (174.2608, -179.503), 4)
 
 
 class TestHorizontalDeltaNadeta0_JiraI16_32_failure(_BaseTest):
@@ -822,3 +845,321 @@ class TestAnglesToHkl_I16Examples():
         pos = posFromI16sEuler(1.9, 2.9, 30.9, 0.9, 60.9, 2.9).inRadians()
         arrayeq_(youAnglesToHkl(pos, self.WL1, self.UB1),
                  [1.01174189, 0.02368622, 0.06627361])
+
+
+class TestSolutionsWithinLimits(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = z_rotation(-20 * TORAD) * I * 2 * pi
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+
+    def test_degenerate_eta_phi_split(self):
+        pos, _ = self.calc.hklToAngles(1, 0, 0, 1)
+        assert_array_almost_equal(pos.totuple(), (0, 60, 0, 30, 0, -20))
+
+    def test_degenerate_eta_phi_split_kept_within_limits(self):
+        self.mock_hardware.set_upper_limit('eta', 25)
+        pos, _ = self.calc.hklToAngles(1, 0, 0, 1)
+        assert_array_almost_equal(pos.totuple(), (0, 60, 0, 0, 0, 10))
+
+    @raises(DiffcalcException)
+    def test_constrained_angle_outside_limits(self):
+        self.mock_hardware.set_lower_limit('mu', 1)
+        self.calc.hklToAngles(1, 0, 0, 1)
+
+
+class TestHklToAnglesCache(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = I * 2 * pi
+        self.mock_ubcalc.version = 0
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc.set_cache_size(10)
+
+    def test_repeated_request_hits_cache(self):
+        pos1, virtual1 = self.calc.hklToAngles(1, 0, 1, 1)
+        pos1.mu = 99
+        pos2, virtual2 = self.calc.hklToAngles(1, 0, 1, 1)
+        assert (self.calc.cache.hits, self.calc.cache.misses) == (1, 1)
+        assert pos2.mu != 99
+        assert_array_almost_equal(pos2.totuple(),
+            self.calc.hklToAngles(1, 0, 1, 1)[0].totuple())
+        assert virtual2 == virtual1
+
+    def test_different_wavelength_misses(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        self.calc.hklToAngles(1, 0, 1, 1.1)
+        assert (self.calc.cache.hits, self.calc.cache.misses) == (0, 2)
+
+    def _check_invalidated_by(self, change):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        change()
+        self.calc.hklToAngles(1, 0, 1, 1)
+        assert self.calc.cache.hits == 0
+        assert self.calc.cache.invalidations == 1
+
+    def test_invalidated_by_constraint_change(self):
+        self._check_invalidated_by(
+            lambda: self.constraints.set_constraint('mu', 1))
+
+    def test_invalidated_by_ub_change(self):
+        def change():
+            self.mock_ubcalc.version += 1
+        self._check_invalidated_by(change)
+
+    def test_invalidated_by_limit_change(self):
+        self._check_invalidated_by(
+            lambda: self.mock_hardware.set_upper_limit('chi', 100))
+
+    def test_invalidated_by_cut_change(self):
+        self._check_invalidated_by(
+            lambda: self.mock_hardware.set_cut('phi', -180))
+
+    def test_failures_not_cached(self):
+        for _ in range(2):
+            try:
+                self.calc.hklToAngles(1, 0, 1, 10)
+            except DiffcalcException:
+                pass
+        assert len(self.calc.cache) == 0
+
+    def test_disable(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        self.calc.set_cache_size(0)
+        self.calc.hklToAngles(1, 0, 1, 1)
+        assert len(self.calc.cache) == 0
+
+
+class TestVerificationPolicy(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = I * 2 * pi
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        # corrupt calculated positions so that any verification fails
+        hkl_to_angles = self.calc._hklToAngles
+
+        def corrupted_hkl_to_angles(*args, **kwargs):
+            pairs = hkl_to_angles(*args, **kwargs)
+            for pos, _ in pairs:
+                pos.eta += .1
+            return pairs
+        self.calc._hklToAngles = corrupted_hkl_to_angles
+
+    def _fails(self):
+        try:
+            self.calc.hklToAngles(1, 0, 1, 1)
+        except DiffcalcException:
+            return True
+        return False
+
+    def test_always(self):
+        assert self._fails()
+
+    def test_cheap(self):
+        self.calc.set_verification('cheap')
+        assert self._fails()
+
+    def test_cheap_passes_correct_positions(self):
+        self.calc._hklToAngles = YouHklCalculator._hklToAngles.__get__(
+            self.calc)
+        self.calc.set_verification('cheap')
+        for hkl in ((1, 0, 1), (0, 1, 1), (1, 1, .5)):
+            self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1)
+            self.calc.hkl_to_all_angles(hkl[0], hkl[1], hkl[2], 1)
+
+    def test_off(self):
+        self.calc.set_verification('off')
+        assert not self._fails()
+
+    def test_sampled(self):
+        self.calc.set_verification('sampled', 3)
+        assert [self._fails() for _ in range(7)] == [
+            True, False, False, True, False, False, True]
+
+    def test_hkl_to_all_angles_off(self):
+        self.calc.set_verification('off')
+        assert self.calc.hkl_to_all_angles(1, 0, 1, 1)
+
+    @raises(DiffcalcException)
+    def test_unknown_policy(self):
+        self.calc.set_verification('sometimes')
+
+    @raises(DiffcalcException)
+    def test_bad_interval(self):
+        self.calc.set_verification('sampled', 0)
+
+    def test_reported_by_str(self):
+        self.calc.set_verification('sampled', 5)
+        assert str(self.calc).endswith('verification: sampled (every 5)')
+
+
+class TestBranchTracking(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = z_rotation(-20 * TORAD) * I * 2 * pi
+        self.mock_ubcalc.version = 0
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.mock_hardware.set_lower_limit('eta', None)
+        self.mock_hardware.set_lower_limit('chi', None)
+        self.seed = P(mu=0, delta=90, nu=0, eta=-130, chi=-130, phi=-20)
+
+    def _eta_chi_phi(self, l):
+        pos, _ = self.calc.hklToAngles(1, 0, l, 1)
+        return pos.eta, pos.chi, pos.phi
+
+    def test_closest_to_zero_by_default(self):
+        assert_array_almost_equal(self._eta_chi_phi(1), (45, 45, -20))
+
+    def test_seed_used_once(self):
+        self.calc.set_reference_position(self.seed)
+        assert_array_almost_equal(self._eta_chi_phi(1), (-135, -135, -20))
+        assert_array_almost_equal(self._eta_chi_phi(1), (45, 45, -20))
+
+    def test_tracking_follows_branch(self):
+        self.calc.set_tracking(True)
+        self.calc.set_reference_position(self.seed)
+        for l in (1, 1.2, 1.4):
+            eta, chi, _ = self._eta_chi_phi(l)
+            assert eta < -90 and chi < -90
+        assert self.calc.branch_switches == 0
+
+    def test_forced_branch_switch_counted(self):
+        self.calc.set_tracking(True)
+        self.calc.set_reference_position(self.seed)
+        self._eta_chi_phi(1)
+        self.mock_hardware.set_lower_limit('eta', -100)
+        eta, chi, _ = self._eta_chi_phi(1.2)
+        assert eta > 0 and chi > 0
+        assert self.calc.branch_switches == 1
+        self.calc.set_tracking(False)
+        assert self.calc.branch_switches == 0
+
+    def test_cache_bypassed(self):
+        self.calc.set_cache_size(10)
+        self.calc.set_tracking(True)
+        self.calc.set_reference_position(self.seed)
+        assert_array_almost_equal(self._eta_chi_phi(1), (-135, -135, -20))
+        assert len(self.calc.cache) == 0
+
+
+class TestSolverStatistics(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = z_rotation(-20 * TORAD) * I * 2 * pi
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.mode = NUNAME + ' a_eq_b mu'
+
+    def test_counts(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        counts = self.calc.statistics.snapshot()['last_call']
+        assert counts['calls'] == 1
+        assert counts['detector_pairs'] >= 1
+        assert counts['sample_tuples'] > counts['sample_rejected']
+        assert counts['verifications'] == 1
+        assert counts['exceptions'] == 0
+
+    def test_totals_and_modes(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        self.calc.hklToAngles(0, 1, 1, 1)
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, 'qaz': 0}
+        self.calc.hklToAngles(1, 0, 1, 1)
+        snapshot = self.calc.statistics.snapshot()
+        assert snapshot['total']['calls'] == 3
+        assert snapshot['modes'][self.mode]['calls'] == 2
+        assert snapshot['modes']['qaz a_eq_b mu']['calls'] == 1
+
+    def test_tidy_up_counted(self):
+        self.calc.hklToAngles(1, 0, 0, 1)  # chi = 0 is degenerate
+        assert self.calc.statistics.last_call['tidy_ups'] == 1
+
+    def test_exception_counted(self):
+        try:
+            self.calc.hklToAngles(1, 0, 1, 10)
+        except DiffcalcException:
+            pass
+        assert self.calc.statistics.last_call['exceptions'] == 1
+        assert self.calc.statistics.modes[self.mode]['exceptions'] == 1
+
+    def test_verification_off_not_counted(self):
+        self.calc.set_verification('off')
+        self.calc.hklToAngles(1, 0, 1, 1)
+        assert self.calc.statistics.last_call['verifications'] == 0
+
+    def test_reset(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        self.calc.statistics.reset()
+        snapshot = self.calc.statistics.snapshot()
+        assert snapshot['total']['calls'] == 0
+        assert snapshot['modes'] == {}
+
+    def test_str(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        lines = str(self.calc.statistics).split('\n')
+        assert len(lines) == 4
+        assert lines[-1].startswith(self.mode)
+
+
+class TestStageTiming(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = I * 2 * pi
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        stage_timers.reset()
+        stage_timers.enabled = True
+
+    def teardown_method(self):
+        stage_timers.enabled = False
+        stage_timers.reset()
+
+    def test_stages_timed(self):
+        self.calc.hklToAngles(1, 0, 1, 1)
+        assert set(stage_timers.stages) >= set([
+            'solve.theta', 'solve.reference', 'solve.detector',
+            'solve.sample', 'solve.position', 'verify.hkl'])
+
+
+class TestTwoSampleAndReference(_BaseTest):
+
+    def setup_method(self):
+        _BaseTest.setup_method(self)
+        self.mock_ubcalc.UB = z_rotation(10 * TORAD) * I * 2 * pi
+        self.constraints._constrained = {'chi': 0, 'phi': 0, 'a_eq_b': None}
+        self.mock_hardware.set_upper_limit('delta', 90)
+
+    def test_all_solutions_valid(self):
+        solutions = self.calc.hkl_to_all_angles(0, 1, 1, 1)
+        assert len(solutions) > 1
+        for pos, virtual in solutions:
+            hkl, _ = self.calc.anglesToHkl(pos, 1)
+            assert_array_almost_equal(hkl, (0, 1, 1))
+            assert abs(virtual['alpha'] - virtual['beta']) < 1e-6
+
+    def test_psi_constrained(self):
+        pos, virtual = self.calc.hklToAngles(0, 1, 1, 1)
+        self.constraints._constrained = {'chi': 0, 'phi': 0,
+                                         'psi': virtual['psi'] * TORAD}
+        pos_psi, virtual_psi = self.calc.hklToAngles(0, 1, 1, 1)
+        assert_array_almost_equal(pos_psi.totuple(), pos.totuple())
+        assert abs(virtual_psi['psi'] - virtual['psi']) < 1e-6
+
+    def test_closest_to_reference_position(self):
+        for name in (NUNAME, 'mu', 'eta'):
+            self.mock_hardware.set_lower_limit(name, None)
+        solutions = [pos for pos, _ in self.calc.hkl_to_all_angles(0, 1, 1, 1)
+                     if pos.delta > 0]
+        assert len(solutions) == 2
+        for pos in solutions:
+            self.calc.set_reference_position(pos)
+            chosen, _ = self.calc.hklToAngles(0, 1, 1, 1)
+            assert_array_almost_equal(chosen.totuple(), pos.totuple())
+
+    @raises(DiffcalcException)
+    def test_unreachable(self):
+        self.mock_hardware.set_upper_limit('delta', 1)
+        self.calc.hklToAngles(0, 1, 1, 1)
@@ -240,6 +240,27 @@ class Test_anglesToVirtualAngles():
         self.check_angle(
             'psi', 88, mu=0, delta=0.00000001, nu=0, eta=90, chi=-2, phi=0)
 
+    # selected names
+
+    def test_selected_names(self):
+        pos = YouPosition(1, 11, 2, 3, 4, 5)
+        pos.changeToRadians()
+        all_angles = self.calc._anglesToVirtualAngles(pos, None)
+        for names in ((), ('qaz',), ('naz', 'theta'), ('beta',),
+                      ('psi', 'alpha')):
+            angles = self.calc._anglesToVirtualAngles(pos, None, names)
+            eq_(sorted(angles.keys()), sorted(names))
+            for name in names:
+                assert_almost_equal(angles[name], all_angles[name])
+
+    def test_selected_names_skip_psi(self):
+        # psi is undefined here, but not required
+        pos = YouPosition(0, 0, 0, 0, 0, 0)
+        self.calc._calc_psi = Mock()
+        angles = self.calc.anglesToVirtualAngles(pos, 1, ('alpha', 'beta'))
+        eq_(angles, {'alpha': 0, 'beta': 0})
+        assert not self.calc._calc_psi.called
+
 
 class Test_calc_theta():
 
@@ -16,6 +16,7 @@
 # along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
 ###
 
+from math import sin, cos
 
 from nose.tools import eq_  # @UnresolvedImport
 from mock import Mock
@@ -25,7 +26,8 @@ from diffcalc.util import DiffcalcException
 from nose.tools import raises
 from nose.tools import assert_raises  # @UnresolvedImport
 
-from diffcalc.hkl.you.constraints import NUNAME
+from diffcalc.hkl.you.constraints import NUNAME, ONE_SAMPLE, \
+    TWO_SAMPLE_AND_REFERENCE, THREE_SAMPLE, NUMERICAL
 import diffcalc.util
 
 def joined(d1, d2):
@@ -456,6 +458,48 @@ class TestConstraintManager:
         eq_(self.cm.set_constraint('alpha', 1.), 'alpha : --- --> 1.0')
         eq_(self.cm.set_constraint('alpha', 2.), 'alpha : 1.0 --> 2.0')
 
+    def test_mode_plan_cached_until_constraints_change(self):
+        plan = self.cm.mode_plan
+        assert self.cm.mode_plan is plan
+        self.cm.constrain('alpha')
+        assert self.cm.mode_plan is not plan
+        plan = self.cm.mode_plan
+        self.cm.set_constraint('alpha', 2.)
+        assert self.cm.mode_plan is not plan
+        plan = self.cm.mode_plan
+        self.cm.unconstrain('alpha')
+        assert self.cm.mode_plan is not plan
+        plan = self.cm.mode_plan
+        self.cm._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        assert self.cm.mode_plan is not plan
+
+    def test_mode_plan(self):
+        self.cm._constrained = {'alpha': .5, 'mu': 0, NUNAME: .2}
+        plan = self.cm.mode_plan
+        eq_(plan.all, {'alpha': .5, 'mu': 0, NUNAME: .2})
+        eq_(plan.detector, {NUNAME: .2})
+        eq_(plan.reference, {'alpha': .5})
+        eq_(plan.sample, {'mu': 0})
+        eq_(plan.reference_constraint, ('alpha', .5))
+        eq_(plan.trig['alpha'], (sin(.5), cos(.5)))
+        eq_(plan.kind, ONE_SAMPLE)
+        eq_(plan.fully_constrained, True)
+
+    def test_mode_plan_kinds(self):
+        for names, kind in ((('alpha', 'mu'), None),
+                            (('a_eq_b', 'mu', 'qaz'), ONE_SAMPLE),
+                            (('psi', 'chi', 'phi'), TWO_SAMPLE_AND_REFERENCE),
+                            (('eta', 'chi', 'phi'), THREE_SAMPLE),
+                            (('mu', 'chi', 'phi'), NUMERICAL),
+                            (('qaz', 'chi', 'phi'), NUMERICAL)):
+            self.cm._constrained = dict((name, 0) for name in names)
+            eq_(self.cm.mode_plan.kind, kind)
+        eq_(self.cm.mode_plan.reference_constraint, (None, None))
+
+    @raises(AttributeError)
+    def test_mode_plan_immutable(self):
+        self.cm.mode_plan.kind = ONE_SAMPLE
+
 
 
 #    def test_track_fails(self):
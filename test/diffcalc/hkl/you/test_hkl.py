@@ -93,3 +93,39 @@ def test_con_message_display_whenn_selecting_an_unimplmented_mode():
     hkl.hklcalc.constraints.is_fully_constrained.return_value = True
     hkl.hklcalc.constraints.is_current_mode_implemented.return_value = False
     hkl.con('phi', 'chi', 'eta')
+
+def test_psirange():
+    hkl.hklcalc.reachable_psi_intervals.return_value = [(10., 20.5)]
+    hkl.psirange([1, 0, 1], 1.5)
+    hkl.hklcalc.reachable_psi_intervals.assert_called_with([1, 0, 1], 1.5)
+
+def test_psirange_unreachable():
+    hkl.hklcalc.reachable_psi_intervals.return_value = []
+    hkl.psirange([1, 0, 1], 1.5)
+
+def test_conplan():
+    evaluation = Mock(coverage=1)
+    evaluation.con_command.return_value = 'con qaz 90 a_eq_b mu 0'
+    hkl.planner = Mock()
+    hkl.planner.evaluate_modes.return_value = [evaluation]
+    hkl.conplan([[1, 0, 1], [1, 0, 2]], 1.5)
+    hkl.planner.evaluate_modes.assert_called_with(
+        hkl.hklcalc, [[1, 0, 1], [1, 0, 2]], 1.5)
+
+def test_sector_commands():
+    hkl.sector(1)
+    hkl.hklcalc.transform_selector.set_sector.assert_called_with(1)
+
+def test_calcstats():
+    hkl.calcstats()
+    hkl.calcstats('reset')
+    hkl.hklcalc.statistics.reset.assert_called_with()
+
+def test_hkltiming():
+    hkl.stage_timers = Mock()
+    hkl.hkltiming('on')
+    assert hkl.stage_timers.enabled
+    hkl.hkltiming('reset')
+    hkl.stage_timers.reset.assert_called_with()
+    hkl.hkltiming('dump', 'timing.json')
+    hkl.stage_timers.dump_json.assert_called_with('timing.json')
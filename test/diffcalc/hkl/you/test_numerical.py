@@ -0,0 +1,231 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+import time
+from math import pi, sqrt
+
+import pytest
+from nose.tools import raises
+
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager, NUNAME
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.hkl.you.numerical import YouEquations
+from diffcalc.util import y_rotation, z_rotation, DiffcalcException
+from test.diffcalc.test_hardware import SimpleHardwareAdapter
+from test.diffcalc.hkl.vlieg.test_calc import \
+    createMockDiffractometerGeometry, createMockUbcalc
+from test.tools import assert_array_almost_equal
+
+TORAD = pi / 180
+I = matrix('1 0 0; 0 1 0; 0 0 1')
+
+X = (.3, .7, -.2, 1.1, -.5, 2.)  # mu, delta, nu, eta, chi, phi
+
+
+def _create_calculator():
+    U = z_rotation(5 * TORAD) * y_rotation(3 * TORAD)
+    ubcalc = createMockUbcalc(U * I * 2 * pi)
+    ubcalc.n_phi = matrix([[.1], [0], [1]]) * (1 / sqrt(1.01))
+    names = ['delta', NUNAME, 'mu', 'eta', 'chi', 'phi']
+    hardware = SimpleHardwareAdapter(names)
+    constraints = YouConstraintManager(hardware)
+    calc = YouHklCalculator(ubcalc, createMockDiffractometerGeometry(),
+                            hardware, constraints)
+    hardware.set_lower_limit('delta', 0)
+    hardware.set_upper_limit('delta', 179)
+    return calc, ubcalc, hardware, constraints
+
+
+class TestYouEquations(object):
+
+    def setup_method(self):
+        self.calc = _create_calculator()[0]
+
+    def _check_jacobian(self, constraints):
+        equations = YouEquations(self.calc, (.3, -.2, .5), 1.2, constraints)
+        f, jacobian = equations(X)
+        assert len(f) == len(jacobian) == 6
+        step = 1e-6
+        for j in range(6):
+            x_plus, x_minus = list(X), list(X)
+            x_plus[j] += step
+            x_minus[j] -= step
+            f_plus, f_minus = equations(x_plus)[0], equations(x_minus)[0]
+            assert_array_almost_equal(
+                [row[j] for row in jacobian],
+                [(p - m) / (2 * step) for p, m in zip(f_plus, f_minus)], 7)
+
+    def test_jacobian(self):
+        for constraints in ({'alpha': .1, 'psi': .5, 'mu': .2},
+                            {'a_eq_b': None, 'qaz': .3, 'naz': .2},
+                            {'beta': .1, 'mu_is_' + NUNAME: None, 'chi': .4},
+                            {'delta': .1, NUNAME: .2, 'eta': .3}):
+            self._check_jacobian(constraints)
+
+    def test_residuals_vanish_at_solution(self):
+        pos = YouPosition(*X)
+        hkl = self.calc._anglesToHkl(pos, 1.2)
+        virtual_angles = self.calc._anglesToVirtualAngles(pos, 1.2)
+        constraints = {'alpha': virtual_angles['alpha'],
+                       'psi': -virtual_angles['psi'], 'eta': X[3]}
+        f, _ = YouEquations(self.calc, hkl, 1.2, constraints)(X)
+        assert max(abs(f_i) for f_i in f) < 1e-12
+
+
+class TestNumericalSolution(object):
+
+    def setup_method(self):
+        (self.calc, self.mock_ubcalc, self.mock_hardware,
+         self.constraints) = _create_calculator()
+
+    def _all_numerical_solutions(self, h, k, l):
+        h_phi = self.mock_ubcalc.UB * matrix([[h], [k], [l]])
+        theta = self.calc._calc_theta(h_phi, 1)
+        return self.calc._calc_angles_numerically(
+            self.constraints.mode_plan, h, k, l, 1, True, h_phi, theta)
+
+    def test_agrees_with_analytic_modes(self):
+        # avoid multiple detector solutions in the analytic modes
+        self.mock_hardware.set_lower_limit(NUNAME, 0)
+        self.mock_hardware.set_upper_limit(NUNAME, 179)
+        self.mock_hardware.set_lower_limit('mu', 0)
+        for constraints in ({'a_eq_b': None, 'mu': 0, NUNAME: 0},
+                            {'psi': 90 * TORAD, 'mu': 0, NUNAME: 0},
+                            {'alpha': 2 * TORAD, 'mu': 0, 'qaz': 90 * TORAD},
+                            {'beta': 2 * TORAD, 'delta': 0, 'eta': 0}):
+            self.constraints._constrained = constraints
+            checked = 0
+            for hkl in ((1, 0, .2), (0, .8, .6), (.3, .5, .7), (.7, .1, .3)):
+                try:
+                    pos, _ = self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1)
+                except DiffcalcException:
+                    continue
+                expected = [v * TORAD for v in pos.totuple()]
+                solutions = self._all_numerical_solutions(*hkl)
+                assert [s for s in solutions if
+                        max(abs(a - b) for a, b in zip(s, expected)) < 1e-8]
+                checked += 1
+            assert checked >= 2
+
+    def _check_unimplemented_mode(self, constraints, hkl):
+        self.constraints._constrained = constraints
+        assert not self.constraints.is_current_mode_implemented()
+        pos, virtual_angles = self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1)
+        hkl_readback, _ = self.calc.anglesToHkl(pos, 1)
+        assert_array_almost_equal(hkl_readback, hkl)
+        return pos, virtual_angles
+
+    def test_three_sample_constraints(self):
+        pos, _ = self._check_unimplemented_mode(
+            {'mu': 0, 'eta': 10 * TORAD, 'chi': 30 * TORAD}, (.3, .4, .5))
+        assert_array_almost_equal((pos.mu, pos.eta, pos.chi), (0, 10, 30))
+
+    def test_two_sample_and_reference_constraints(self):
+        pos, virtual_angles = self._check_unimplemented_mode(
+            {'psi': 30 * TORAD, 'eta': 0, 'phi': 20 * TORAD}, (.3, .4, .5))
+        assert_array_almost_equal((pos.eta, pos.phi), (0, 20))
+        assert abs(virtual_angles['psi'] - 30) < 1e-8
+
+    def test_two_sample_and_detector_constraints(self):
+        pos, _ = self._check_unimplemented_mode(
+            {'mu': 0, 'chi': 10 * TORAD, NUNAME: 0}, (.3, .4, .1))
+        assert_array_almost_equal((pos.mu, pos.chi, pos.nu), (0, 10, 0))
+
+    @raises(DiffcalcException)
+    def test_unreachable(self):
+        # Q cannot be brought into the horizontal plane with chi fixed at 10
+        self.constraints._constrained = {'mu': 0, 'chi': 10 * TORAD, NUNAME: 0}
+        self.calc.hklToAngles(.3, .4, .5, 1)
+
+    def _scan(self, constraints, hkls):
+        """Return the time per point and, for each point, the number of
+        iterations taken from each start tried"""
+        self.constraints._constrained = constraints
+        solver = self.calc.numerical_solver
+        solve = solver.solve
+        starts = []
+
+        def counted_solve(equations, x0):
+            x = solve(equations, x0)
+            starts[-1].append(solver.last_iterations)
+            return x
+        solver.solve = counted_solve
+        t0 = time.time()
+        for hkl in hkls:
+            starts.append([])
+            self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1)
+        per_point = (time.time() - t0) / len(hkls)
+        del solver.solve
+        return per_point, starts
+
+    def test_scan_warm_started(self):
+        per_point, starts = self._scan(
+            {'mu': 0, 'eta': 10 * TORAD, 'chi': 30 * TORAD},
+            [(.3, .4, .5 + i * .005) for i in range(50)])
+        assert max(iterations for point in starts[1:]
+                   for iterations in point) <= 6
+
+    def test_scans_need_no_restarts(self):
+        # After the first point each converges from the last, without
+        # falling back to the spread of starting positions
+        scan = [(.3, .8, .5 + i * .015) for i in range(30)]
+        for constraints in ({'alpha': 2 * TORAD, 'eta': 0, 'phi': 0},
+                            {'mu': 0, 'chi': 30 * TORAD, 'psi': 30 * TORAD},
+                            {'mu': 0, 'eta': 0, NUNAME: 0}):
+            _, starts = self._scan(constraints, scan)
+            assert [len(point) for point in starts[1:]] == [1] * 29
+            assert max(point[0] for point in starts[1:]) <= 6
+
+    def test_unreachable_fails_quickly(self):
+        # no start at (.3, .8, 1.2) reaches the alpha constraint; each
+        # should be abandoned long before the iteration limit
+        self.constraints._constrained = {'alpha': 2 * TORAD, 'eta': 0,
+                                         'phi': 0}
+        solver = self.calc.numerical_solver
+        solve = solver.solve
+        iterations = []
+
+        def counted_solve(equations, x0):
+            x = solve(equations, x0)
+            iterations.append(solver.last_iterations)
+            return x
+        solver.solve = counted_solve
+        with pytest.raises(DiffcalcException):
+            self.calc.hklToAngles(.3, .8, 1.2, 1)
+        assert iterations
+        assert max(iterations) < solver.max_iterations / 2
+
+    def test_scan_benchmark(self):
+        # Benchmark against an analytic mode: the numerical per point cost
+        # in a scan should be comparable (generous to avoid timing noise)
+        scan = [(.3, .8, .5 + i * .015) for i in range(30)]
+        per_point = min(self._scan({'mu': 0, 'chi': 30 * TORAD,
+                                    'psi': 30 * TORAD}, scan)[0]
+                        for _ in range(3))
+        analytic_per_point = min(self._scan({'a_eq_b': None, 'mu': 0,
+                                             NUNAME: 0}, scan)[0]
+                                 for _ in range(3))
+        print 'per point: numerical %.2fms, analytic %.2fms' % (
+            per_point * 1000, analytic_per_point * 1000)
+        assert per_point < 3 * analytic_per_point
@@ -0,0 +1,149 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+import pytest
+from nose.tools import eq_
+
+try:
+    import numpy
+    from numpy import matrix
+except ImportError:
+    numpy = None
+    from numjy import matrix
+
+from diffcalc.hkl.you import planner
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager, ModePlan, \
+    NUNAME
+from diffcalc.util import y_rotation, z_rotation
+from test.diffcalc.test_hardware import SimpleHardwareAdapter
+from test.diffcalc.hkl.vlieg.test_calc import \
+    createMockDiffractometerGeometry, createMockUbcalc
+
+TORAD = pi / 180
+
+PATH = [(.3, .5, .7 + .05 * i) for i in range(5)]
+
+
+class TestCandidateModes(object):
+
+    def setup_method(self):
+        self.hardware = SimpleHardwareAdapter(
+            ['mu', 'delta', NUNAME, 'eta', 'chi', 'phi'])
+
+    def test_all_implemented(self):
+        modes = planner.candidate_modes(YouConstraintManager(self.hardware))
+        assert len(modes) > 80
+        for mode in modes:
+            eq_(len(mode), 3)
+            assert ModePlan(planner._in_radians(mode)).implemented
+        assert {'a_eq_b': None, 'mu': 0, NUNAME: 0} in modes
+        assert {'eta': 0, 'chi': 90, 'phi': 0} in modes
+
+    def test_candidate_values(self):
+        modes = planner.candidate_modes(YouConstraintManager(self.hardware),
+                                        {'psi': (10, 20)})
+        eq_(len([mode for mode in modes if mode.get('psi') == 10]),
+            len([mode for mode in modes if mode.get('psi') == 20]))
+        assert {'psi': 10, 'mu': 0, NUNAME: 0} in modes
+        assert not [mode for mode in modes if mode.get('psi') == 90]
+
+    def test_fixed_constraints(self):
+        # as for a four-circle
+        manager = YouConstraintManager(self.hardware,
+                                       {'mu': 0, NUNAME: 0})
+        modes = planner.candidate_modes(manager)
+        assert modes
+        for mode in modes:
+            eq_(mode['mu'], 0)
+            eq_(mode[NUNAME], 0)
+
+
+class TestModeEvaluation(object):
+
+    def test_con_command(self):
+        evaluation = planner.ModeEvaluation(
+            {'mu': 0, 'a_eq_b': None, 'qaz': 90}, 1, 10., 0)
+        eq_(evaluation.con_command(), 'con qaz 90 a_eq_b mu 0')
+
+    def test_sort_key(self):
+        a = planner.ModeEvaluation({'mu': 0}, 1, 20., 0)
+        b = planner.ModeEvaluation({'mu': 0}, 1, 10., 1)
+        c = planner.ModeEvaluation({'mu': 0}, .5, 1., 0)
+        eq_(sorted([c, b, a], key=planner.ModeEvaluation.sort_key),
+            [a, b, c])
+
+
+@pytest.mark.skipif(numpy is None, reason='requires numpy')
+class TestEvaluateModes(object):
+
+    def setup_method(self):
+        U = z_rotation(5 * TORAD) * y_rotation(3 * TORAD)
+        self.ubcalc = createMockUbcalc(U * matrix('1 0 0; 0 1 0; 0 0 1') *
+                                       2 * pi)
+        self.ubcalc.n_phi = matrix([[0], [0], [1]])
+        self.hardware = SimpleHardwareAdapter(
+            ['delta', NUNAME, 'mu', 'eta', 'chi', 'phi'])
+        self.hardware.set_lower_limit('delta', 0)
+        self.hardware.set_upper_limit('delta', 179.999)
+        self.hardware.set_lower_limit(NUNAME, 0)
+        self.hardware.set_upper_limit(NUNAME, 179.999)
+        self.constraints = YouConstraintManager(self.hardware)
+        self.calc = YouHklCalculator(self.ubcalc,
+                                     createMockDiffractometerGeometry(),
+                                     self.hardware, self.constraints)
+
+    def test_ranked(self):
+        self.constraints._constrained = {'psi': 10 * TORAD, 'mu': 0,
+                                         'delta': 0}
+        self.calc.set_tracking(True)
+        evaluations = planner.evaluate_modes(self.calc, PATH, 1.)
+        eq_(self.constraints.all, {'psi': 10 * TORAD, 'mu': 0, 'delta': 0})
+        assert self.calc.tracking
+        best = evaluations[0]
+        eq_(best.coverage, 1)
+        keys = [evaluation.sort_key() for evaluation in evaluations]
+        eq_(keys, sorted(keys))
+
+        # the recommended mode reaches the whole path
+        self.constraints._constrained = planner._in_radians(best.constraints)
+        self.calc.set_tracking(False)
+        for hkl in PATH:
+            self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1.)
+
+    def test_calculator_untouched(self):
+        constrained = {'psi': 10 * TORAD, 'mu': 0, 'delta': 0}
+        self.constraints._constrained = constrained
+        self.calc.set_cache_size(10)
+        self.calc.hklToAngles(.3, .5, .7, 1.)
+        before = self.calc.statistics.snapshot()
+        planner.evaluate_modes(self.calc, PATH, 1.)
+        assert self.constraints._constrained is constrained
+        eq_(len(self.calc.cache), 1)
+        eq_(self.calc.statistics.snapshot(), before)
+
+    def test_travel(self):
+        evaluation = planner._evaluate_path(
+            self.calc, {}, [[0, 10, 10, 0, 0, 0], [0, 20, 10, 0, 0, 170],
+                            [0, 20, 10, 0, 0, -170], [0, 0, 0, 0, 0, 0]],
+            [0, 0, 0, 1])
+        eq_(evaluation.coverage, .75)
+        assert abs(evaluation.travel - 200) < 1e-10
+        eq_(evaluation.branch_flips, 1)
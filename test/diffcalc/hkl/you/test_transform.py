@@ -0,0 +1,187 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+import pytest
+from nose.tools import eq_, raises
+
+try:
+    import numpy
+    from numpy import matrix
+except ImportError:
+    numpy = None
+    from numjy import matrix
+
+from diffcalc.hkl.you.calc import YouHklCalculator
+from diffcalc.hkl.you.constraints import YouConstraintManager, NUNAME
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.hkl.you.transform import SECTORS, YouTransformSelector
+from diffcalc.util import y_rotation, z_rotation
+from test.diffcalc.test_hardware import SimpleHardwareAdapter
+from test.diffcalc.hkl.vlieg.test_calc import \
+    createMockDiffractometerGeometry, createMockUbcalc
+from test.tools import assert_array_almost_equal
+
+if numpy is not None:
+    from diffcalc.hkl.you.transform import equivalent_positions
+
+pytestmark = pytest.mark.skipif(numpy is None, reason='requires numpy')
+
+TORAD = pi / 180
+
+POSITIONS = [(3, 40, 10, 20, 30, 40), (-5, 120, 20, -30, 60, 170),
+             (2, -130, 15, 10, -20, 5)]
+
+NO_LIMITS = {}
+
+
+class TestEquivalentPositions(object):
+
+    def setup_method(self):
+        ubcalc = createMockUbcalc(z_rotation(5 * TORAD) *
+                                  y_rotation(3 * TORAD) * 2 * pi)
+        ubcalc.n_phi = matrix([[.1], [.2], [1]]) * (1 / numpy.sqrt(1.05))
+        hardware = SimpleHardwareAdapter(['mu', 'delta', NUNAME, 'eta', 'chi',
+                                          'phi'])
+        self.calc = YouHklCalculator(ubcalc,
+                                     createMockDiffractometerGeometry(),
+                                     hardware, YouConstraintManager(hardware))
+
+    def test_same_hkl_and_virtual_angles(self):
+        sectors = sorted(SECTORS)
+        equivalents = equivalent_positions(POSITIONS, sectors)
+        eq_(equivalents.shape, (len(POSITIONS), len(sectors), 6))
+        for angles, row in zip(POSITIONS, equivalents):
+            hkl, virtual = self.calc.anglesToHkl(YouPosition(*angles), 1.)
+            for equivalent in row:
+                hkl_, virtual_ = self.calc.anglesToHkl(
+                    YouPosition(*equivalent), 1.)
+                assert_array_almost_equal(hkl_, hkl, 10)
+                for name in virtual:
+                    assert abs(virtual_[name] - virtual[name]) < 1e-8
+
+
+class TestYouTransformSelector(object):
+
+    def setup_method(self):
+        self.selector = YouTransformSelector()
+
+    def test_selected_sector(self):
+        self.selector.set_sector(1)
+        chosen, sectors = self.selector.select(POSITIONS, NO_LIMITS)
+        assert_array_almost_equal(chosen[0], (3, 40, 10, 200, -30, 220))
+        eq_(list(sectors), [1, 1, 1])
+
+    def test_constrained_angles_unchanged(self):
+        self.selector.set_sector(1)
+        chosen, sectors = self.selector.select(POSITIONS[:1], NO_LIMITS,
+                                               ('eta',))
+        assert_array_almost_equal(chosen[0], POSITIONS[0])
+        eq_(sectors[0], 0)
+        # chi = 0 is left at 0 by the sample flip
+        chosen, sectors = self.selector.select([(0, 10, 0, 5, 0, 10)],
+                                               NO_LIMITS, ('chi',))
+        eq_(sectors[0], 1)
+
+    def test_outside_limits_unchanged(self):
+        self.selector.set_sector(1)
+        limits = {'chi': (None, -90, 0)}
+        chosen, sectors = self.selector.select(POSITIONS, limits)
+        # the third position's flip has chi = 20
+        eq_(list(sectors), [1, 1, 0])
+        assert_array_almost_equal(chosen[2], POSITIONS[2])
+
+    def test_cuts(self):
+        self.selector.set_sector(1)
+        limits = {'phi': (0, 0, 200)}
+        chosen, sectors = self.selector.select([(0, 10, 0, 5, 10, -100)],
+                                               limits)
+        eq_(sectors[0], 1)
+        assert_array_almost_equal(chosen[0], (0, 10, 0, 185, -10, 80))
+
+    @raises(ValueError)
+    def test_bad_sector(self):
+        self.selector.set_sector(2)
+
+
+class TestHklToAnglesInSectors(object):
+
+    def setup_method(self):
+        U = z_rotation(5 * TORAD) * y_rotation(3 * TORAD)
+        ubcalc = createMockUbcalc(U * 2 * pi)
+        ubcalc.n_phi = matrix([[0], [0], [1]])
+        self.hardware = SimpleHardwareAdapter(
+            ['delta', NUNAME, 'mu', 'eta', 'chi', 'phi'])
+        self.hardware.set_lower_limit('delta', 0)
+        self.hardware.set_upper_limit('delta', 179.999)
+        self.hardware.set_lower_limit(NUNAME, 0)
+        self.hardware.set_upper_limit(NUNAME, 179.999)
+        self.constraints = YouConstraintManager(self.hardware)
+        self.constraints._constrained = {'a_eq_b': None, 'mu': 0, NUNAME: 0}
+        self.calc = YouHklCalculator(ubcalc,
+                                     createMockDiffractometerGeometry(),
+                                     self.hardware, self.constraints)
+
+    def test_sector(self):
+        pos, virtual = self.calc.hklToAngles(.3, .5, .7, 1.)
+        self.calc.set_cache_size(10)
+        self.calc.hklToAngles(.3, .5, .7, 1.)
+        self.calc.transform_selector.set_sector(1)
+        pos1, virtual1 = self.calc.hklToAngles(.3, .5, .7, 1.)
+        assert_array_almost_equal(
+            pos1.totuple(), equivalent_positions([pos.totuple()], [1])[0, 0])
+        assert abs(virtual1['psi'] - virtual['psi']) < 1e-8
+        # the sample flip would change a constrained eta
+        self.constraints._constrained = {'a_eq_b': None, 'eta': 0, NUNAME: 0}
+        pos, _ = self.calc.hklToAngles(.3, .5, .7, 1.)
+        self.calc.transform_selector.set_sector(0)
+        pos0, _ = self.calc.hklToAngles(.3, .5, .7, 1.)
+        assert_array_almost_equal(pos.totuple(), pos0.totuple())
+
+    def test_tracked_scan(self):
+        hkls = [(0, 1, .5 + .1 * i) for i in range(6)]
+        self.calc.transform_selector.set_sector(1)
+        first, _ = self.calc.hklToAngles(*(hkls[0] + (1.,)))
+        self.calc.set_tracking(True)
+        positions = [self.calc.hklToAngles(h, k, l, 1.)[0].totuple()
+                     for h, k, l in hkls]
+        # the first point is in the selected sector, the rest follow it
+        assert_array_almost_equal(positions[0], first.totuple())
+        eq_(self.calc.branch_switches, 0)
+        for previous, pos in zip(positions[:-1], positions[1:]):
+            assert abs((pos[3] - previous[3] + 180) % 360 - 180) < 10  # eta
+            assert pos[4] * previous[4] > 0  # chi keeps its sign
+
+    def test_seeded(self):
+        self.calc.transform_selector.set_sector(1)
+        flipped, _ = self.calc.hklToAngles(0, 1, .5, 1.)
+        self.calc.set_reference_position(flipped)
+        pos, _ = self.calc.hklToAngles(0, 1, .6, 1.)
+        assert abs((pos.eta - flipped.eta + 180) % 360 - 180) < 10
+
+    def test_batch(self):
+        self.calc.transform_selector.set_sector(1)
+        self.hardware.set_upper_limit('chi', 0)
+        hkls = [(.3, .5, .7), (0, 1, .5), (1, 0, .2)]
+        positions, _, status = self.calc.hkl_to_angles_batch(hkls, 1.)
+        for i, hkl in enumerate(hkls):
+            pos, _ = self.calc.hklToAngles(hkl[0], hkl[1], hkl[2], 1.)
+            eq_(status[i], 0)
+            assert pos.chi <= 0
+            assert_array_almost_equal(positions[i], pos.totuple(), 7)
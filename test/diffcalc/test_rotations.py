@@ -0,0 +1,85 @@
+###
+# Copyright 2008-2011 Diamond Light Source Ltd.
+# This file is part of Diffcalc.
+#
+# Diffcalc is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Diffcalc is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Diffcalc.  If not, see <http://www.gnu.org/licenses/>.
+###
+
+from math import pi
+
+try:
+    from numpy import matrix
+except ImportError:
+    from numjy import matrix
+
+from diffcalc import rotations
+from diffcalc.hkl.you.geometry import create_you_matrices
+from diffcalc.hkl.vlieg.geometry import createVliegMatrices
+from diffcalc.hkl.willmott.calc import create_matrices
+from test.tools import assert_matrix_almost_equal
+
+I = matrix('1 0 0; 0 1 0; 0 0 1')
+y = matrix('0; 1; 0')
+
+ANGLES = ((0, 0, 0, 0, 0, 0),
+          (10, 20, 30, 40, 50, 60),
+          (-170, 95, -45, 180, -90, 270),
+          (90, -90, 90, 90, -90, 90))
+
+
+class TestRotations(object):
+
+    def _each_position_in_radians(self):
+        for angles in ANGLES:
+            yield [a * pi / 180 for a in angles]
+
+    def test_you(self):
+        for mu, delta, nu, eta, chi, phi in self._each_position_in_radians():
+            MU, DELTA, NU, ETA, CHI, PHI = create_you_matrices(
+                mu, delta, nu, eta, chi, phi)
+            Z = MU * ETA * CHI * PHI
+            assert_matrix_almost_equal(
+                rotations.you_sample_rotation(mu, eta, chi, phi), Z)
+            assert_matrix_almost_equal(
+                rotations.you_sample_rotation_inverse(mu, eta, chi, phi), Z.I)
+            assert_matrix_almost_equal(
+                rotations.column(rotations.you_q_lab(delta, nu)),
+                (NU * DELTA - I) * y)
+
+    def test_vlieg(self):
+        for angles in self._each_position_in_radians():
+            ALPHA, DELTA, GAMMA, OMEGA, CHI, PHI = createVliegMatrices(*angles)
+            alpha, delta, gamma, omega, chi, phi = angles
+            R = OMEGA * CHI * PHI
+            assert_matrix_almost_equal(
+                rotations.vlieg_sample_rotation(omega, chi, phi), R)
+            assert_matrix_almost_equal(
+                rotations.vlieg_sample_rotation_inverse(omega, chi, phi), R.I)
+            assert_matrix_almost_equal(
+                rotations.column(rotations.vlieg_q_alpha(alpha, delta, gamma)),
+                (DELTA * GAMMA - ALPHA.I) * y)
+
+    def test_willmott(self):
+        for angles in self._each_position_in_radians():
+            delta, gamma, omegah, phi = angles[:4]
+            DELTA, GAMMA, OMEGAH, PHI = create_matrices(
+                delta, gamma, omegah, phi)
+            R = OMEGAH * PHI
+            assert_matrix_almost_equal(
+                rotations.willmott_sample_rotation(omegah, phi), R)
+            assert_matrix_almost_equal(
+                rotations.willmott_sample_rotation_inverse(omegah, phi), R.I)
+            assert_matrix_almost_equal(
+                rotations.column(rotations.willmott_h_lab(delta, gamma)),
+                (GAMMA * DELTA - I) * y)
@@ -19,9 +19,15 @@
 import unittest
 
 from diffcalc.hkl.vlieg.geometry import VliegPosition
+from diffcalc.hkl.you.geometry import YouPosition
+from diffcalc.hkl.willmott.calc import WillmottHorizontalPosition
 from diffcalc.util import MockRawInput, \
-    getInputWithDefault, differ, nearlyEqual, degreesEquivilant
+    getInputWithDefault, differ, nearlyEqual, degreesEquivilant, LRUCache, \
+    StageTimers, TimingHistogram, TIMING_BIN_EDGES, stage_timers, timed
+import json
+import pickle
 import diffcalc.util  # @UnusedImport
+from test.tools import assert_array_almost_equal
 import pytest
 
 
@@ -103,6 +109,96 @@ class TestUtils(object):
         assert not degreesEquivilant(359.1, -1, tol)
 
 
+class TestLRUCache(object):
+
+    def test_disabled_by_default(self):
+        cache = LRUCache()
+        cache.put('a', 1)
+        assert cache.get('a') is None
+        assert len(cache) == 0
+        assert cache.hits == cache.misses == 0
+
+    def test_hits_and_misses(self):
+        cache = LRUCache(2)
+        assert cache.get('a') is None
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_shrink_and_clear(self):
+        cache = LRUCache(3)
+        for i in range(3):
+            cache.put(i, i)
+        cache.maxsize = 1
+        assert len(cache) == 1
+        assert cache.get(2) == 2
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.invalidations == 1
+
+    def test_negative_size(self):
+        with pytest.raises(ValueError):
+            LRUCache(-1)
+
+
+class TestStageTimers(object):
+
+    def test_histogram(self):
+        histogram = TimingHistogram()
+        for seconds in (1.5e-6, 1.5e-6, 3e-3, 100):
+            histogram.add(seconds)
+        assert histogram.count == 4
+        assert (histogram.min, histogram.max) == (1.5e-6, 100)
+        assert histogram.todict()['histogram'] == [
+            (2e-6, 2), (TIMING_BIN_EDGES[12], 1), (None, 1)]
+
+    def test_disabled_records_nothing(self):
+        timers = StageTimers()
+        with timers.time('stage'):
+            pass
+        assert timers.stages == {}
+
+    def test_enabled(self):
+        timers = StageTimers()
+        timers.enabled = True
+        for _ in range(2):
+            with timers.time('stage'):
+                pass
+        assert timers.snapshot()['stage']['count'] == 2
+        assert str(timers).split('\n')[1].split()[:2] == ['stage', '2']
+        timers.reset()
+        assert str(timers) == 'no stages timed'
+
+    def test_timed_decorator(self):
+        @timed('test.double')
+        def double(x):
+            return 2 * x
+        stage_timers.enabled = True
+        try:
+            assert double(2) == 4
+        finally:
+            stage_timers.enabled = False
+        assert stage_timers.stages.pop('test.double').count == 1
+
+    def test_dump_json(self, tmpdir):
+        timers = StageTimers()
+        timers.record('stage', 1e-3)
+        filename = str(tmpdir.join('timing.json'))
+        timers.dump_json(filename)
+        with open(filename) as f:
+            assert json.load(f)['stage']['total'] == 1e-3
+
+
 class TestPosition(object):
 
     def testCompare(self):
@@ -125,3 +221,29 @@ class TestPosition(object):
         assert pos == copy
         pos.alpha = 10
         pos.omega = 4.1
+
+    def testConversionsReturnNewPositions(self):
+        for pos in (VliegPosition(1, 2, 3, 4, 5, 6),
+                    YouPosition(1, 2, 3, 4, 5, 6),
+                    WillmottHorizontalPosition(1, 2, 3, 4)):
+            radians = pos.inRadians()
+            assert type(radians) is type(pos)
+            assert radians.totuple()[0] != 1
+            assert pos.totuple()[0] == 1
+            assert_array_almost_equal(radians.inDegrees().totuple(),
+                                      pos.totuple())
+
+    def testPickle(self):
+        for pos in (VliegPosition(1, 2, 3, 4, 5, 6),
+                    YouPosition(1, 2, 3, 4, 5, 6),
+                    WillmottHorizontalPosition(1, 2, 3, 4)):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                copy = pickle.loads(pickle.dumps(pos, protocol))
+                assert type(copy) is type(pos)
+                assert copy.totuple() == pos.totuple()
+
+    def testSlots(self):
+        pos = YouPosition(1, 2, 3, 4, 5, 6)
+        assert not hasattr(pos, '__dict__')
+        with pytest.raises(AttributeError):
+            pos.alpha = 1
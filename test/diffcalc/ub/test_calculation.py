@@ -172,3 +172,36 @@ class TestUBCalculationWithYouStrategy():
         matrixeq_(self.ubcalc.UB, U * 2 * pi)
 
 
+
+    def test_version_changes_with_ub_lattice_and_reference(self):
+        self.ubcalc.start_new('test_version')
+        versions = [self.ubcalc.version]
+        self.ubcalc.set_lattice('latt', 1, 1, 1, 90, 90, 90)
+        versions.append(self.ubcalc.version)
+        self.ubcalc.add_reflection(1, 0, 0, REF1a, EN1, '100', None)
+        self.ubcalc.add_reflection(0, 0, 1, REF1b, EN1, '001', None)
+        versions.append(self.ubcalc.version)
+        self.ubcalc.set_n_hkl_configured(matrix('0; 1; 1'))
+        versions.append(self.ubcalc.version)
+        self.ubcalc.set_UB_manually(UB1)
+        versions.append(self.ubcalc.version)
+        eq_(sorted(set(versions)), versions)
+
+    def test_derived_state(self):
+        self.ubcalc.start_new('test_derived_state')
+        self.ubcalc.set_lattice('latt', 2, 2, 2, 90, 90, 90)
+        self.ubcalc.add_reflection(1, 0, 0, REF1a, EN1, '100', None)
+        self.ubcalc.add_reflection(0, 0, 1, REF1b, EN1, '001', None)
+        UB = self.ubcalc.UB
+        matrixeq_(self.ubcalc.UB_inv, UB.I)
+        matrixeq_(self.ubcalc.U_inv, self.ubcalc.U.I)
+        matrixeq_(self.ubcalc.B_inv, self.ubcalc._state.crystal.B.I)
+        matrixeq_(self.ubcalc.metric_tensor, matrix('1 0 0; 0 1 0; 0 0 1') * pi ** 2)
+        assert self.ubcalc.UB_inv is self.ubcalc.UB_inv
+        matrixeq_(self.ubcalc.n_phi, matrix('0; 0; 1'))
+
+        self.ubcalc.set_n_hkl_configured(matrix('0; 0; 1'))
+        n_phi = UB * matrix('0; 0; 1')
+        matrixeq_(self.ubcalc.n_phi, n_phi * (1 / (n_phi.T * n_phi)[0, 0] ** .5))
+        self.ubcalc.set_UB_manually(UB1)
+        matrixeq_(self.ubcalc.UB_inv, UB1.I)